@@ -1,151 +1,196 @@
 """
 This file controls the ftp client
-It receives commands from the user and sends/receives data to/from the server
+It receives commands from the user, runs them with the asynchronous client
+and prints their results
 """
 
-import os
-import socket
+import asyncio
 import sys
 import typing
 import functools
 import pathlib
+import time
 
-from SockMonkey.Domain.Client.helpers import receive_all, send_all
+from SockMonkey.Domain.Client import checksum, compression
+from SockMonkey.Domain.Client.client import ftp_client, ftp_error, server_error
+from SockMonkey.Domain.Client.helpers import VERSION
 
 
 class command_line_interface:
     def __init__(self, server_name: str = "127.0.0.1", server_port: int = 1233,
-                 directory: pathlib.Path = pathlib.Path.cwd()):
+                 directory: pathlib.Path = pathlib.Path.cwd(), persistent: bool = False,
+                 version: int = VERSION):
         if not(isinstance(server_name, str)
                and isinstance(server_port, int)
-               and isinstance(directory, pathlib.Path)):
+               and isinstance(directory, pathlib.Path)
+               and isinstance(persistent, bool)
+               and isinstance(version, int)):
             raise ValueError(
                 f'mismatched constructor: command_line_interface({list(locals().values())[1:]})')
         self.server_name = server_name
         self.server_port = server_port
         self.directory = directory
-        self.control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
+        # every command is a coroutine of the client, run one at a time on this loop
+        self.event_loop = asyncio.new_event_loop()
+        self.client = ftp_client(server_name, server_port, version, persistent)
+
         try:
-            self.control.connect((self.server_name, self.server_port))
-        except:
+            self.event_loop.run_until_complete(self.client.connect())
+        except (ftp_error, OSError):
             print(
                 f'{self.server_name} on port {self.server_port} not found. Make sure to run the server before the client.')
             sys.exit(1)
 
-    def get(self, file_name: str) -> int:
-        """requests a file from the server"""
-        # send the 'get' command and file name to the server over the 'control' channel
-        send_all(self.control, '1')
-        send_all(self.control, file_name)
-
-        # listen to the 'control' channel for the server's response
-        response = receive_all(self.control)
-        if response == 'ERR':
-            err_msg = receive_all(self.control)
-            print(f'[SERVER ERROR] {err_msg}')
-            return
+        if version > 1:
+            if self.client.control.version == 1:
+                print('[INFO] The server only speaks version 1 of the protocol')
+            else:
+                print(f'[INFO] Speaking version {self.client.control.version} of the protocol')
 
-        print("Receiving the data port number...")
-        data_port = int(receive_all(self.control))
+        if self.client.data is not None:
+            print('[INFO] The data channel will stay open for the rest of the session')
 
-        print(f'Connecting to the server on port {data_port}...')
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        data_socket.connect((self.server_name, data_port))
+    def run(self, command: typing.Awaitable) -> typing.Any:
+        """
+        runs a command of the client to completion
+        @return - the command's result, None if it failed and the error was printed
+        """
+        try:
+            return self.event_loop.run_until_complete(command)
+        except server_error as error:
+            print(f'[SERVER ERROR] {error}')
+        except (ftp_error, OSError) as error:
+            print(f'[Client ERROR] {error}')
 
-        # receive the output over the 'data' channel
+    def get(self, file_name: str) -> None:
+        """requests a file from the server"""
         print(f'Receiving [{file_name}]...')
-        file_content: str = receive_all(data_socket)
-
+        if self.run(self.client.get(file_name)) is not None:
+            print(f'[{file_name}] has been written to {self.directory}')
 
-        print(f'Writing...')
-        with open(file_name, "w") as fp:
-            fp.writelines(file_content)
+    def pget(self, file_name: str, connections: int) -> None:
+        """requests a file from the server over several 'data' connections at once"""
+        print(f'Receiving [{file_name}] over up to {connections} connections...')
+        if self.run(self.client.pget(file_name, connections)) is not None:
+            print(f'[{file_name}] has been written to {self.directory}')
 
-        print(f'[{file_name}] has been written to {self.directory}')
-
-        # close the 'data' channel
-        data_socket.close()
-
-    def put(self, file_name: str) -> int:
+    def put(self, file_name: str) -> None:
         """sends a file to the server"""
-
-        # check if the file exists in the current dir
-        if not pathlib.Path(f'{self.directory}/{file_name}').is_file():
-                err_msg = (
-                    f'[Client ERROR] File {file_name} does not exist. '
-                    f'Path = {self.directory}'
-                )
-                print(err_msg)
-                return
-
-
-        # .basename() is in case file_name is a path to a file
-        # send command code and file name
-        send_all(self.control, '2')
-        send_all(self.control, os.path.basename(file_name))
-
-        # listen to the 'control' channel for the server's response
-        response = receive_all(self.control)
-
-        if response == 'ERR':
-            err_msg = receive_all(self.control)
-            print(f'[SERVER ERROR] {err_msg}')
+        print(f'Sending [{file_name}]...')
+        if self.run(self.client.put(file_name)) is not None:
+            print(f'[{file_name}] has been sent!')
+
+    def reget(self, file_name: str) -> None:
+        """resumes a get, only the bytes missing from the local file are requested"""
+        print(f'Resuming [{file_name}]...')
+        if self.run(self.client.reget(file_name)) is not None:
+            print(f'[{file_name}] has been written to {self.directory} and verified')
+
+    def reput(self, file_name: str) -> None:
+        """resumes a put, only the bytes the server does not have are sent"""
+        print(f'Resuming [{file_name}]...')
+        if self.run(self.client.reput(file_name)) is not None:
+            print(f'[{file_name}] has been sent and verified!')
+
+    def dget(self, file_name: str) -> None:
+        """requests a file as a delta against the local copy"""
+        print(f'Receiving the delta of [{file_name}]...')
+        if (result := self.run(self.client.dget(file_name))) is not None:
+            copied, literal = result
+            print(f'[{file_name}] has been written to {self.directory}, '
+                  f'{copied} bytes reused and {literal} bytes received')
+
+    def dput(self, file_name: str) -> None:
+        """sends a file as a delta against the server's copy"""
+        print(f'Sending the delta of [{file_name}]...')
+        if (bytes_sent := self.run(self.client.dput(file_name))) is not None:
+            print(f'[{file_name}] has been sent in {bytes_sent} of {pathlib.Path(file_name).stat().st_size} bytes!')
+
+    def zget(self, file_name: str, codec: str) -> None:
+        """requests a file compressed with codec, decompressing it as it arrives"""
+        print(f'Receiving [{file_name}]...')
+        if (codec := self.run(self.client.zget(file_name, codec))) is not None:
+            print(f'[{file_name}] has been written to {self.directory}, it was sent with {codec}')
+
+    def zput(self, file_name: str, codec: str) -> None:
+        """sends a file compressed with codec"""
+        print(f'Sending [{file_name}]...')
+        if (bytes_sent := self.run(self.client.zput(file_name, codec))) is not None:
+            print(f'[{file_name}] has been sent in {bytes_sent} of {pathlib.Path(file_name).stat().st_size} bytes!')
+
+    def rget(self, directory_name: str) -> None:
+        """requests a directory and everything under it"""
+        print(f'Receiving [{directory_name}]...')
+        if (counts := self.run(self.client.rget(directory_name))) is not None:
+            print(f'[{directory_name}] has been written to {self.directory}, '
+                  f'{counts["files"]} files in {counts["directories"]} directories')
+
+    def rput(self, directory_name: str) -> None:
+        """sends a directory and everything under it as one stream"""
+        print(f'Sending [{directory_name}]...')
+        if (counts := self.run(self.client.rput(directory_name))) is not None:
+            print(f'[{directory_name}] has been sent, {counts["files"]} files '
+                  f'in {counts["directories"]} directories')
+
+    def mget(self, patterns: typing.List[str]) -> None:
+        """requests every file matching the patterns from the server in one batch"""
+        if (result := self.run(self.client.mget(patterns))) is None:
             return
 
-        print("Receiving the data port number...")
-        data_port = int(receive_all(self.control))
-
-        print(f'Connecting to the server on port {data_port}...')
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        data_socket.connect((self.server_name, data_port))
-
-        print(f'Reading [{file_name}]...')
-        with open(file_name, "r") as fp:
-            contents = ''.join(fp.readlines())
-        
-        print(f'Sending...')
-        send_all(data_socket, contents)
-
-        print(f'[{file_name}] has been sent!')
-
-        data_socket.close()
-
-    def ls(self) -> int:
-        """lists the files located at the server"""
-        # send the 'ls' command to the server over the 'control' channel
-        send_all(self.control, '3')
-
-        # server responds with OK if there are no errors
-        response = receive_all(self.control)
-        if response == 'ERR':
-            err_msg = receive_all(self.control)
+        written, errors = result
+        for err_msg in errors:
             print(f'[SERVER ERROR] {err_msg}')
-            return
-
-        # receive the data port num
-        print("Receiving the data port number...")
-        data_port = int(receive_all(self.control))
-
-        # connect to the server over 'data'
-        print(f'Connecting to the server on port {data_port}...')
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        data_socket.connect((self.server_name, data_port))
-
-
-        # receive the output over the 'data' channel
-        print("Receiving the file list...")
-        file_list: str = receive_all(data_socket)
-
-        print("Receiving the list's directory...")
-        server_dir: str = receive_all(data_socket)
-
-        # close the 'data' channel
-        data_socket.close()
-
-        # display the output
-        print(f'[INFO] Server path = {server_dir}')
-        print(file_list)
+        for file_name in written:
+            print(f'[{file_name}] has been written to {self.directory}')
+
+    def mput(self, patterns: typing.List[str]) -> None:
+        """sends every local file matching the patterns to the server in one batch"""
+        self.print_sent(self.run(self.client.mput(patterns)))
+
+    def sync(self, directory: str = '.') -> None:
+        """mirrors the files of a local directory to the server"""
+        print("Receiving the server's manifest...")
+        if (results := self.run(self.client.sync(directory))) is not None:
+            print(f'{len(results)} files were new or changed')
+            self.print_sent(results)
+
+    def print_sent(self, results: typing.Optional[typing.Dict[str, typing.Optional[str]]]) -> None:
+        """prints the outcome of every file of a batch"""
+        for file_name, err_msg in (results or {}).items():
+            print(f'[ERROR] {err_msg}' if err_msg is not None else f'[{file_name}] has been sent!')
+
+    def ls(self, pattern: str = '*') -> None:
+        """lists the files located at the server, only the names matching pattern"""
+        # every page is shown as it arrives
+        def show(page: typing.List[typing.Dict[str, typing.Any]]) -> None:
+            for entry in page:
+                print(self.render_entry(entry))
+
+        if (entries := self.run(self.client.ls(pattern, on_page=show))) is not None:
+            print(f'[INFO] {len(entries)} entries')
+
+    def render_entry(self, entry: typing.Dict[str, typing.Any]) -> str:
+        """formats a listing entry like a line of ls -l"""
+        kind = {'dir': 'd', 'link': 'l', 'file': '-'}.get(entry['type'], '?')
+        modified = time.strftime('%b %d %H:%M', time.localtime(entry['mtime']))
+        return f"{kind} {entry['size']:>12} {modified} {entry['name']}"
+
+    def prioritize(self, priority: int) -> None:
+        """sets the priority of this session's transfers on the server"""
+        self.run(self.client.prioritize(priority))
+
+    def choose_checksum(self, offered: typing.List[str]) -> None:
+        """asks the server to check every following transfer with the first offered algorithm it supports"""
+        if (name := self.run(self.client.choose_checksum(offered))) == 'none':
+            print('[INFO] Transfers will not be checked, the server supports none of the algorithms')
+        elif name is not None:
+            print(f'[INFO] Every transfer will be checked with {name}')
+
+    def persist(self) -> None:
+        """asks the server to keep one 'data' channel open for the rest of the session"""
+        self.run(self.client.persist())
+        if self.client.data is not None:
+            print('[INFO] The data channel will stay open for the rest of the session')
 
     def missing_arg(self, cmd: typing.List[str]) -> bool:
         """checks get and put commands for a missing argument"""
@@ -154,42 +199,115 @@ class command_line_interface:
     def cmd_list(self) -> None:
         """prints out the list of available commands"""
         print('get [file name]')
+        print('get --parallel [connections] [file name]')
         print('put [file name]')
-        print('ls')
+        print('get -r [directory]')
+        print('put -r [directory]')
+        print('get --delta [file name]')
+        print('put --delta [file name]')
+        print('get --compress [zlib|lzma|bz2] [file name]')
+        print('put --compress [zlib|lzma|bz2] [file name]')
+        print('reget [file name]')
+        print('reput [file name]')
+        print('mget [pattern ...]')
+        print('mput [pattern ...]')
+        print('ls [pattern]')
+        print('sync [directory]')
+        print('persist')
+        print('priority [1-8]')
+        print('checksum [algorithm ...]')
         print('help')
         print('quit')
 
     def __del__(self):
         """clean up the object once we're done"""
-        # tell the server to shut down
+        # tell the server we are done and terminate the connections,
+        # an object collected while another loop runs leaves its sockets to the garbage collector
         try:
-            send_all(self.control, '4')
-        except BrokenPipeError:
-            # server is not running but client is
-            pass
-
-        # terminate connection
-        self.control.close()
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if not self.event_loop.is_closed():
+                self.run(self.client.close())
+                self.event_loop.close()
 
         print(f"deleting object at {self}")
 
     def parse_args(self, arguments: typing.List[str]) -> typing.Callable:
         def empty(): return None  # void function
 
+        prefix = arguments[0]
+
+        # batch commands take any number of file names or glob patterns
+        if prefix in ('mget', 'mput') and (patterns := [arg for arg in arguments[1:] if arg]):
+            return functools.partial(self.mget if prefix == 'mget' else self.mput, patterns)
+
+        # checksum [algorithm ...], every algorithm this side supports when none is named
+        if prefix == 'checksum':
+            if unknown := [name for name in arguments[1:] if name and name not in checksum.ALGORITHMS]:
+                print(f'[ERROR] Unknown algorithm {unknown[0]}, expected one of {", ".join(checksum.ALGORITHMS)}')
+                return empty
+
+            return functools.partial(self.choose_checksum, [name for name in arguments[1:] if name]
+                                     or list(checksum.ALGORITHMS))
+
+        # get --parallel N [file name]
+        if prefix == 'get' and len(arguments) == 4 and arguments[1] == '--parallel':
+            try:
+                if (connections := int(arguments[2])) < 1:
+                    raise ValueError
+            except ValueError:
+                print(f'[ERROR] The number of connections should be a positive number, received {arguments[2]}')
+                return empty
+
+            return functools.partial(self.pget, arguments[3], connections)
+
+        # get -r [directory] and put -r [directory]
+        if prefix in ('get', 'put') and len(arguments) == 3 and arguments[1] == '-r':
+            return functools.partial(self.rget if prefix == 'get' else self.rput, arguments[2])
+
+        # get --delta [file name] and put --delta [file name]
+        if prefix in ('get', 'put') and len(arguments) == 3 and arguments[1] == '--delta':
+            return functools.partial(self.dget if prefix == 'get' else self.dput, arguments[2])
+
+        # get --compress [codec] [file name] and put --compress [codec] [file name]
+        if prefix in ('get', 'put') and len(arguments) == 4 and arguments[1] == '--compress':
+            if arguments[2] not in compression.CODECS:
+                print(f'[ERROR] Unknown codec {arguments[2]}, expected one of {", ".join(compression.CODECS)}')
+                return empty
+
+            return functools.partial(self.zget if prefix == 'get' else self.zput, arguments[3], arguments[2])
+
         if len(arguments) > 2:
             print('Too many arguments. Type \'help\' for the command list')
             return empty
 
-        prefix = arguments[0]
-
         if prefix == 'get' and not self.missing_arg(arguments):
             return functools.partial(self.get, arguments[1])
 
         if prefix == 'put' and not self.missing_arg(arguments):
             return functools.partial(self.put, arguments[1])
 
+        if prefix == 'reget' and not self.missing_arg(arguments):
+            return functools.partial(self.reget, arguments[1])
+
+        if prefix == 'reput' and not self.missing_arg(arguments):
+            return functools.partial(self.reput, arguments[1])
+
         if prefix == 'ls':
-            return self.ls
+            return functools.partial(self.ls, *arguments[1:2])
+
+        if prefix == 'sync':
+            return functools.partial(self.sync, *arguments[1:2])
+
+        if prefix == 'persist':
+            return self.persist
+
+        if prefix == 'priority' and not self.missing_arg(arguments):
+            if not arguments[1].isdigit():
+                print(f'[ERROR] The priority should be a positive number, received {arguments[1]}')
+                return empty
+
+            return functools.partial(self.prioritize, int(arguments[1]))
 
         if prefix == "help":
             return self.cmd_list
@@ -0,0 +1,1057 @@
+"""
+Asynchronous ftp client library
+Every command is a coroutine that returns its result or raises one of the
+errors below, nothing is printed. A client holds one control connection and
+runs one command at a time on it, many clients share one event loop to run
+transfers side by side
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import glob
+import json
+import mmap
+import os
+import tempfile
+import time
+import typing
+
+from SockMonkey.Domain.Client import archive, checksum, compression, delta, metrics
+from SockMonkey.Domain.Client.helpers import (CHUNK_SIZE, FIELD, FRAME, HEADER_SIZE, MAX_MESSAGE,
+                                              MESSAGE, STATUSES, VERSION, hash_file, pad_str,
+                                              prepend_size, split_range)
+from SockMonkey.Domain.Client.throttle import flow, throttle, token_bucket
+
+# the reader and writer of one connection
+channel = typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+# bytes of a file mapped at a time by a checksummed upload
+MAP_WINDOW = 16 * CHUNK_SIZE
+
+
+class ftp_error(Exception):
+    """base of the errors raised by ftp_client"""
+
+
+class connection_failed(ftp_error):
+    """the server could not be reached"""
+
+
+class server_error(ftp_error):
+    """the server refused a command, the message is the server's"""
+
+
+class transfer_error(ftp_error):
+    """the 'data' channel closed or sent something malformed in the middle of a transfer"""
+
+
+class integrity_error(ftp_error):
+    """a file does not match the other side's hash after a transfer"""
+
+
+async def read_message(reader: asyncio.StreamReader) -> str:
+    """receives a message sent behind its 10 byte size"""
+    return (await read_exactly(reader, await read_header(reader))).decode('utf-8')
+
+
+async def read_header(reader: asyncio.StreamReader) -> int:
+    """
+    receives the size header that precedes a message body
+    @raise transfer_error - the header is malformed or the connection closed early
+    """
+    header = await read_exactly(reader, HEADER_SIZE)
+
+    if not header.isdigit():
+        raise transfer_error(f'received a malformed size header {header!r}')
+
+    return int(header)
+
+
+async def read_exactly(reader: asyncio.StreamReader, size: int) -> bytes:
+    """
+    receives exactly size bytes
+    @raise transfer_error - the connection closed first
+    """
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as error:
+        raise transfer_error(f'the connection closed after {len(error.partial)} of {size} bytes') from error
+
+
+async def pace(transfer: typing.Optional[flow], call: str, sent: int = 0, received: int = 0) -> None:
+    """
+    records the bytes a call moved on the 'data' channel and waits until as
+    many may move again under the bandwidth limits of the transfer
+    """
+    if transfer is None:
+        return
+
+    transfer.moved(call, sent, received)
+    if wait := transfer.delay(sent + received):
+        await asyncio.sleep(wait)
+
+
+async def read_stream(reader: asyncio.StreamReader, fp: typing.BinaryIO,
+                      transfer: typing.Optional[flow] = None,
+                      digest: typing.Optional[typing.Any] = None) -> int:
+    """
+    receives a size prefixed body and writes it to fp one chunk at a time
+    @digest - a running checksum updated with every chunk received
+    @return - the num of bytes received
+    """
+    size = remaining = await read_header(reader)
+
+    while remaining:
+        if not (chunk := await reader.read(min(remaining, CHUNK_SIZE))):
+            raise transfer_error(f'the connection closed after {size - remaining} of {size} bytes')
+        if digest is not None:
+            digest.update(chunk)
+        fp.write(chunk)
+        remaining -= len(chunk)
+        await pace(transfer, 'read', received=len(chunk))
+
+    return size
+
+
+async def read_trailer(reader: asyncio.StreamReader, digest: typing.Optional[typing.Any]) -> typing.Optional[str]:
+    """receives the sender's checksum that trails a body, None when transfers are not checked"""
+    return None if digest is None else await read_message(reader)
+
+
+def verify(name: str, digest: typing.Optional[typing.Any], expected: typing.Optional[str]) -> None:
+    """
+    compares the receiver's checksum of a body with the sender's
+    @raise integrity_error - they differ
+    """
+    if digest is not None and expected != digest.hexdigest():
+        raise integrity_error(f'{name} does not match its checksum, expected {expected} and computed {digest.hexdigest()}')
+
+
+def batches(names: typing.List[str]) -> typing.Iterator[typing.List[str]]:
+    """
+    splits the names of a batch command so that every request, the count
+    and its names, fits in one frame the server accepts
+    """
+    # the frame header and the count, at most ten digits
+    room = MAX_MESSAGE - FRAME.size - FIELD.size - HEADER_SIZE
+    batch: typing.List[str] = []
+    used = 0
+    for name in names:
+        size = FIELD.size + len(name.encode('utf-8'))
+        if batch and used + size > room:
+            yield batch
+            batch, used = [], 0
+        batch.append(name)
+        used += size
+    if batch:
+        yield batch
+
+
+def map_range(fp: typing.BinaryIO, offset: int, size: int) -> typing.Tuple[mmap.mmap, memoryview]:
+    """
+    maps size bytes of fp, starting at offset, read only
+    @return - the mapping and a view of exactly the range
+    @raise ValueError - the file ends before the range does
+    """
+    # a mapping starts on a multiple of the allocation granularity
+    skip = offset % mmap.ALLOCATIONGRANULARITY
+    mapping = mmap.mmap(fp.fileno(), skip + size, access=mmap.ACCESS_READ, offset=offset - skip)
+    return mapping, memoryview(mapping)[skip:]
+
+
+def unmap(mapping: mmap.mmap, view: memoryview) -> None:
+    """
+    unmaps a window that was written. A transport that still queues part of it
+    holds the mapping open, it is then unmapped with the last of those chunks
+    """
+    view.release()
+    with contextlib.suppress(BufferError):
+        mapping.close()
+
+
+async def write_window(writer: asyncio.StreamWriter, view: memoryview,
+                       transfer: typing.Optional[flow], digest: typing.Any) -> None:
+    """hashes and writes a mapped window one chunk at a time, no chunk is copied"""
+    for start in range(0, len(view), CHUNK_SIZE):
+        chunk = view[start:start + CHUNK_SIZE]
+        digest.update(chunk)
+        await pace(transfer, 'write', sent=len(chunk))
+        writer.write(chunk)
+        await writer.drain()
+
+
+async def write_file(writer: asyncio.StreamWriter, fp: typing.BinaryIO, size: int,
+                     offset: int = 0, transfer: typing.Optional[flow] = None,
+                     digest: typing.Optional[typing.Any] = None) -> int:
+    """
+    sends size bytes of fp, starting at offset, behind their size.
+    The event loop hands the file to the kernel with sendfile where it can,
+    a limited transfer hands it over one chunk at a time and a checksummed
+    one maps the file and writes it a window at a time, hashing every window on the way
+    @return - the num of bytes sent
+    """
+    writer.write(pad_str(str(size)).encode('ascii'))
+    await writer.drain()
+    loop = asyncio.get_running_loop()
+
+    if digest is not None:
+        # one window of the file is mapped at a time and unmapped once it is written,
+        # the resident size of the client does not grow with the file
+        for start in range(0, size, MAP_WINDOW):
+            try:
+                mapping, view = map_range(fp, offset + start, min(MAP_WINDOW, size - start))
+            except ValueError:
+                raise transfer_error(f'{getattr(fp, "name", fp)} ended before {offset + size} bytes') from None
+            try:
+                await write_window(writer, view, transfer, digest)
+            finally:
+                unmap(mapping, view)
+        return size
+
+    if transfer is None or not transfer.limited():
+        if size:
+            await loop.sendfile(writer.transport, fp, offset, size)
+            if transfer is not None:
+                transfer.moved('sendfile', sent=size)
+        return size
+
+    for start in range(0, size, CHUNK_SIZE):
+        await pace(transfer, 'sendfile', sent=(length := min(CHUNK_SIZE, size - start)))
+        await loop.sendfile(writer.transport, fp, offset + start, length)
+
+    return size
+
+
+async def write_chunks(writer: asyncio.StreamWriter, chunks: typing.AsyncIterable[bytes],
+                       transfer: typing.Optional[flow] = None) -> int:
+    """
+    sends a body of unknown size as size prefixed chunks, an empty chunk ends it
+    @return - the num of bytes sent, headers included
+    """
+    bytes_sent = 0
+
+    async for chunk in chunks:
+        if chunk:
+            await pace(transfer, 'write', sent=HEADER_SIZE + len(chunk))
+            writer.write(prepend_size(chunk))
+            bytes_sent += HEADER_SIZE + len(chunk)
+            await writer.drain()
+
+    writer.write(prepend_size(b''))
+    await writer.drain()
+    return bytes_sent + HEADER_SIZE
+
+
+async def read_chunks(reader: asyncio.StreamReader,
+                      transfer: typing.Optional[flow] = None) -> typing.AsyncIterator[bytes]:
+    """receives a body sent as size prefixed chunks, one chunk at a time"""
+    while size := await read_header(reader):
+        chunk = await read_exactly(reader, size)
+        await pace(transfer, 'read', received=HEADER_SIZE + size)
+        yield chunk
+
+
+async def from_thread(chunks: typing.Iterator[bytes]) -> typing.AsyncIterator[bytes]:
+    """
+    yields the chunks of a blocking generator, each one is produced in a worker thread
+    so hashing and compressing never hold up the event loop
+    """
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+        yield chunk
+
+
+async def in_thread(consume: typing.Callable, chunks: typing.AsyncIterator[bytes], *args) -> typing.Any:
+    """
+    runs consume(chunks, *args) in a worker thread, for the blocking consumers
+    of a chunk stream (patching, decompressing, extracting).
+    The chunks are still received on the event loop
+    """
+    loop = asyncio.get_running_loop()
+
+    def pull() -> typing.Iterator[bytes]:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(chunks.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+
+    return await asyncio.to_thread(consume, pull(), *args)
+
+
+class stream_channel:
+    """
+    The 'control' channel over asyncio streams.
+    It speaks both versions of the protocol like helpers.control_channel
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, version: int = 1):
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+        self.request_id = 0
+        self.fields: typing.Deque[str] = collections.deque()
+
+    def send_request(self, opcode: int, *fields: str) -> None:
+        """queues a command code and its arguments"""
+        if self.version == 1:
+            return self.send(str(opcode), *fields)
+
+        self.request_id = (self.request_id + 1) % 2 ** 32
+        self.send_frame(opcode, fields)
+
+    def send(self, *fields: str) -> None:
+        """queues fields that are not a request"""
+        if self.version == 1:
+            self.writer.write(b''.join(prepend_size(field.encode('utf-8')) for field in fields))
+        else:
+            self.send_frame(MESSAGE, fields)
+
+    def send_frame(self, opcode: int, fields: typing.Iterable[str]) -> None:
+        payload = b''.join(FIELD.pack(len(encoded)) + encoded
+                           for encoded in (field.encode('utf-8') for field in fields))
+        self.writer.write(FRAME.pack(opcode, 0, self.request_id, len(payload)) + payload)
+
+    async def receive(self) -> str:
+        """
+        receives the next field
+        @raise ftp_error - the server closed the connection or sent something malformed
+        """
+        await self.writer.drain()
+
+        if self.version == 1:
+            try:
+                return await read_message(self.reader)
+            except transfer_error as error:
+                raise ftp_error(f'the control channel broke: {error}') from error
+
+        while not self.fields:
+            await self.receive_frame()
+
+        return self.fields.popleft()
+
+    async def receive_frame(self) -> None:
+        try:
+            opcode, _, request_id, size = FRAME.unpack(await self.reader.readexactly(FRAME.size))
+            payload = memoryview(await self.reader.readexactly(size))
+        except asyncio.IncompleteReadError as error:
+            raise ftp_error('the server closed the control channel') from error
+
+        if opcode in STATUSES.values():
+            if request_id != self.request_id:
+                raise ftp_error(f'received the reply to request {request_id} while waiting for {self.request_id}')
+            self.fields.append('OK' if opcode == STATUSES['OK'] else 'ERR')
+
+        offset = 0
+        while offset < size:
+            (length,) = FIELD.unpack_from(payload, offset)
+            offset += FIELD.size
+            self.fields.append(str(payload[offset:offset + length], 'utf-8'))
+            offset += length
+
+
+def exclusive(command: typing.Callable) -> typing.Callable:
+    """
+    runs a command alone on the connection, the server answers one command at a time.
+    The command is measured and reported to the metrics registry
+    """
+    @functools.wraps(command)
+    async def locked(self: 'ftp_client', *args, **kwargs):
+        async with self.lock:
+            self.measurement = metrics.measurement(command.__name__)
+            outcome = 'failed'
+            try:
+                result = await command(self, *args, **kwargs)
+                outcome = 'ok'
+                return result
+            except server_error:
+                outcome = 'refused'
+                raise
+            finally:
+                metrics.default.finish(self.measurement, outcome)
+                self.measurement = None
+    return locked
+
+
+class ftp_client:
+    def __init__(self, server_name: str = "127.0.0.1", server_port: int = 1233,
+                 version: int = VERSION, persistent: bool = False,
+                 limits: typing.Optional[throttle] = None,
+                 checksums: typing.Optional[typing.List[str]] = None):
+        self.server_name = server_name
+        self.server_port = server_port
+        self.version = version
+        self.persistent = persistent
+        self.control: typing.Optional[stream_channel] = None
+        # the 'data' channel kept open between transfers in persistent mode
+        self.data: typing.Optional[channel] = None
+        self.lock = asyncio.Lock()
+        # bandwidth limits, the same limits may be shared by many clients
+        self.limits = limits
+        self.bucket: typing.Optional[token_bucket] = limits.client_bucket() if limits else None
+        # the command being run, measured for the metrics
+        self.measurement: typing.Optional[metrics.measurement] = None
+        # checksum algorithms to offer the server, in order of preference, and the one agreed on
+        self.checksums = checksums
+        self.checksum: typing.Optional[str] = None
+
+    async def __aenter__(self) -> 'ftp_client':
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def connect(self) -> 'ftp_client':
+        """
+        opens the control connection and agrees on the protocol
+        @raise connection_failed - the server could not be reached
+        """
+        try:
+            self.control = stream_channel(*await self.open_connection(self.server_port))
+        except OSError as error:
+            raise connection_failed(f'{self.server_name} on port {self.server_port} not found: {error}') from error
+
+        # every connection starts on version 1 of the control protocol
+        if self.version > 1:
+            await self.negotiate(self.version)
+
+        if self.persistent:
+            await self.persist()
+
+        if self.checksums:
+            await self.choose_checksum(self.checksums)
+
+        return self
+
+    async def close(self) -> None:
+        """tells the server we are done and closes every connection"""
+        if self.control is None:
+            return
+
+        with contextlib.suppress(OSError):
+            self.control.send_request(4)
+            await self.control.writer.drain()
+
+        for _, writer in filter(None, (self.data, (self.control.reader, self.control.writer))):
+            writer.close()
+        self.control = self.data = None
+
+    async def open_connection(self, port: int) -> channel:
+        """opens a connection to the server on port, the control connection included"""
+        return await asyncio.open_connection(self.server_name, port)
+
+    async def request(self, opcode: int, *fields: str) -> None:
+        """
+        sends a command and waits for the server to accept it
+        @raise server_error - the server refused the command
+        """
+        self.control.send_request(opcode, *fields)
+
+        if await self.control.receive() == 'ERR':
+            raise server_error(await self.control.receive())
+
+    async def open_data_channel(self) -> channel:
+        """
+        returns the 'data' channel for the next transfer.
+        In persistent mode the open channel is reused, otherwise the server
+        sends the port of a fresh channel over 'control'
+        """
+        if self.data is not None:
+            return self.data
+
+        data_port = int(await self.control.receive())
+        start = time.perf_counter()
+        data = await self.open_connection(data_port)
+        if self.measurement is not None:
+            self.measurement.connected(start)
+        return data
+
+    def close_data_channel(self, data: channel, broken: bool = False) -> None:
+        """
+        ends a transfer on the 'data' channel.
+        A persistent channel stays open unless the transfer broke its framing
+        """
+        if data is self.data:
+            if not broken:
+                return
+            self.data = None
+
+        data[1].close()
+
+    def new_digest(self) -> typing.Optional[typing.Any]:
+        """a running checksum of the next body, None when transfers are not checked"""
+        return checksum.new(self.checksum)
+
+    def new_flow(self) -> flow:
+        """a new transfer, paced by the bandwidth limits if there are any and measured as part of its command"""
+        # the event loop cannot wait in the scheduler, so there are no priorities on this side
+        transfer = self.limits.new_flow(self.bucket, fair=False) if self.limits else flow([])
+        transfer.meter = self.measurement
+        return transfer
+
+    @contextlib.asynccontextmanager
+    async def transfer(self) -> typing.AsyncIterator[channel]:
+        """
+        opens the 'data' channel for one transfer and closes it afterwards.
+        A transfer that fails half way breaks the channel
+        @raise transfer_error - the channel failed
+        """
+        data = await self.open_data_channel()
+
+        try:
+            yield data
+        except (OSError, ValueError) as error:
+            self.close_data_channel(data, broken=True)
+            raise transfer_error(str(error)) from error
+        except BaseException:
+            self.close_data_channel(data, broken=True)
+            raise
+
+        self.close_data_channel(data)
+
+    async def negotiate(self, version: int) -> int:
+        """
+        asks the server to speak a newer version of the control protocol.
+        A server that only knows version 1 refuses and the client stays on version 1
+        @return - the version spoken from now on
+        """
+        try:
+            await self.request(18)
+        except server_error:
+            return 1
+
+        # the newest version both sides speak
+        version = min(version, int(await self.control.receive()))
+        self.control.send(str(version))
+        self.control.version = version
+        return version
+
+    @exclusive
+    async def noop(self) -> None:
+        """
+        checks that the session is still alive with a command that does nothing.
+        A server without the command refuses it, which answers the question as well
+        """
+        with contextlib.suppress(server_error):
+            await self.request(19)
+
+    @exclusive
+    async def prioritize(self, priority: int) -> None:
+        """
+        sets the priority of this session's transfers on the server, from 1 to 8.
+        Under the server's global limit a transfer's share grows with its priority
+        """
+        await self.request(20, str(priority))
+
+    @exclusive
+    async def choose_checksum(self, offered: typing.List[str]) -> str:
+        """
+        asks the server to check every following transfer with the first offered algorithm
+        both sides support, e.g. ['crc32', 'sha256']. A server that does not check
+        transfers refuses and they stay unchecked
+        @return - the algorithm agreed on, 'none' if there is none
+        """
+        try:
+            await self.request(21, ','.join(offered))
+        except server_error:
+            name = 'none'
+        else:
+            name = await self.control.receive()
+
+        self.checksum = None if name == 'none' else name
+        return name
+
+    @exclusive
+    async def persist(self) -> None:
+        """asks the server to keep one 'data' channel open for the rest of the session"""
+        await self.request(5)
+        self.data = await self.open_data_channel()
+
+    @exclusive
+    async def get(self, file_name: str) -> int:
+        """
+        downloads a file into the current directory
+        @return - the num of bytes received
+        """
+        await self.request(1, file_name)
+        digest = self.new_digest()
+
+        async with self.transfer() as (reader, _):
+            with open(file_name, "wb") as fp:
+                size = await read_stream(reader, fp, self.new_flow(), digest)
+            expected = await read_trailer(reader, digest)
+
+        try:
+            verify(file_name, digest, expected)
+        except integrity_error:
+            os.unlink(file_name)
+            raise
+        return size
+
+    @exclusive
+    async def pget(self, file_name: str, connections: int) -> int:
+        """
+        downloads a file over several 'data' connections at once.
+        Each connection asks for one byte range and writes it at its offset
+        in the preallocated local file
+        @return - the num of bytes received
+        @raise integrity_error - byte ranges do not match the server's checksums of them
+        """
+        await self.request(8, file_name, str(connections))
+
+        # the server may allow fewer connections than were asked for
+        size = int(await self.control.receive())
+        connections = int(await self.control.receive())
+        data_port = int(await self.control.receive())
+
+        # the segments are one transfer as far as the limits go
+        transfer = self.new_flow()
+        fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, size)
+            results = await asyncio.gather(
+                *(self.receive_segment(data_port, fd, offset, length, transfer, self.new_digest())
+                  for offset, length in split_range(size, connections)),
+                return_exceptions=True)
+        finally:
+            os.close(fd)
+
+        if errors := [result for result in results if isinstance(result, BaseException)]:
+            # every range is checked on its own, the message names the bad ones
+            if all(isinstance(error, integrity_error) for error in errors):
+                raise integrity_error(f'{len(errors)} segments of {file_name} do not match: '
+                                      + '; '.join(map(str, errors)))
+            raise transfer_error(f'{len(errors)} segments failed, first error: {errors[0]}')
+
+        return size
+
+    async def receive_segment(self, data_port: int, fd: int, offset: int, length: int,
+                              transfer: typing.Optional[flow] = None,
+                              digest: typing.Optional[typing.Any] = None) -> None:
+        """
+        receives one byte range of a parallel get and writes it at its offset
+        @raise integrity_error - the range does not match the server's checksum of it
+        """
+        segment = f'bytes {offset}-{offset + length}'
+        start = time.perf_counter()
+        reader, writer = await self.open_connection(data_port)
+        if transfer is not None and transfer.meter is not None:
+            transfer.meter.connected(start)
+
+        try:
+            writer.write(prepend_size(str(offset).encode('ascii')) + prepend_size(str(length).encode('ascii')))
+
+            if (size := await read_header(reader)) != length:
+                raise transfer_error(f'asked for {length} bytes at {offset}, the server sent {size}')
+
+            while length:
+                if not (chunk := await reader.read(min(length, CHUNK_SIZE))):
+                    raise transfer_error(f'the connection closed with {length} bytes missing at {offset}')
+                if digest is not None:
+                    digest.update(chunk)
+                offset += os.pwrite(fd, chunk, offset)
+                length -= len(chunk)
+                await pace(transfer, 'read', received=len(chunk))
+
+            expected = await read_trailer(reader, digest)
+        finally:
+            writer.close()
+
+        verify(segment, digest, expected)
+
+    @exclusive
+    async def put(self, file_name: str) -> int:
+        """
+        uploads a file under its base name.
+        A checked transfer waits for the server's checksum of what it received
+        @return - the num of bytes sent
+        @raise FileNotFoundError - there is no such local file
+        @raise integrity_error - the server received something else and kept its old copy
+        """
+        if not os.path.isfile(file_name):
+            raise FileNotFoundError(f'{file_name} does not exist')
+
+        await self.request(2, os.path.basename(file_name))
+        digest = self.new_digest()
+
+        try:
+            async with self.transfer() as (_, writer):
+                with open(file_name, "rb") as fp:
+                    size = await write_file(writer, fp, os.fstat(fp.fileno()).st_size,
+                                            transfer=self.new_flow(), digest=digest)
+                if digest is not None:
+                    writer.write(prepend_size(digest.hexdigest().encode('ascii')))
+                    await writer.drain()
+        except transfer_error:
+            # the server answers a checked transfer even when the body did not arrive
+            if digest is not None:
+                with contextlib.suppress(ftp_error):
+                    await self.control.receive()
+                    await self.control.receive()
+            raise
+
+        if digest is not None:
+            if await self.control.receive() == 'ERR':
+                raise server_error(await self.control.receive())
+            verify(os.path.basename(file_name), digest, await self.control.receive())
+
+        return size
+
+    @exclusive
+    async def reget(self, file_name: str) -> int:
+        """
+        resumes a download, only the bytes missing from the local file are requested.
+        The server compares the digests of the local blocks with its copy and
+        sends everything from the first one that differs, checksummed
+        @return - the num of bytes received
+        @raise integrity_error - the bytes received do not match the server's copy
+        """
+        offset = os.path.getsize(file_name) if os.path.isfile(file_name) else 0
+        algorithm = self.checksum or checksum.RESUME_ALGORITHM
+        digests = await asyncio.to_thread(lambda: list(checksum.block_digests(file_name, offset, algorithm)))
+
+        await self.request(9, file_name, str(offset))
+        self.control.send(str(len(digests)), *digests)
+        digest = checksum.new(algorithm)
+
+        async with self.transfer() as (reader, _):
+            offset = int(await self.control.receive())
+            # append mode keeps the part that matched, truncate drops anything past it
+            with open(file_name, "ab") as fp:
+                fp.truncate(offset)
+                size = await read_stream(reader, fp, self.new_flow(), digest)
+            expected = await read_message(reader)
+
+        # the file is kept, the next reget sends the blocks that differ again
+        verify(file_name, digest, expected)
+        return size
+
+    @exclusive
+    async def reput(self, file_name: str) -> int:
+        """
+        resumes an upload, the server reports how much it already has and the
+        digests of its blocks, everything from the first block that differs from
+        the local file is sent. The server checks what it received against our checksum
+        @return - the num of bytes sent
+        @raise FileNotFoundError - there is no such local file
+        @raise server_error - the bytes sent do not match
+        """
+        if not os.path.isfile(file_name):
+            raise FileNotFoundError(f'{file_name} does not exist')
+
+        algorithm = self.checksum or checksum.RESUME_ALGORITHM
+        await self.request(10, os.path.basename(file_name))
+
+        partial = int(await self.control.receive())
+        digests = [await self.control.receive() for _ in range(int(await self.control.receive()))]
+        # a partial file bigger than ours only matches up to where ours ends
+        offset = await asyncio.to_thread(checksum.matching_prefix, file_name, partial, algorithm, digests)
+        self.control.send(str(offset))
+        size = os.path.getsize(file_name)
+        digest = checksum.new(algorithm)
+
+        async with self.transfer() as (_, writer):
+            with open(file_name, "rb") as fp:
+                bytes_sent = await write_file(writer, fp, size - offset, offset, self.new_flow(), digest)
+            writer.write(prepend_size(digest.hexdigest().encode('ascii')))
+
+        if await self.control.receive() == 'ERR':
+            raise server_error(await self.control.receive())
+
+        return bytes_sent
+
+    @exclusive
+    async def dget(self, file_name: str) -> typing.Tuple[int, int]:
+        """
+        downloads a file as a delta against the local copy.
+        Only the blocks the local copy does not have cross the network,
+        the rebuilt file replaces the local one once it matches the server's hash
+        @return - the num of bytes reused from the local copy and received
+        @raise integrity_error - the rebuilt file does not match the server's copy
+        """
+        await self.request(12, file_name)
+
+        # describe the local copy, block by block
+        block_size = delta.block_size_for(os.path.getsize(file_name) if os.path.isfile(file_name) else 0)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                         prefix=f'.{os.path.basename(file_name)}.', suffix='.part')
+
+        try:
+            async with self.transfer() as (reader, writer):
+                writer.write(prepend_size(str(block_size).encode('ascii')))
+                await write_chunks(writer, from_thread(delta.signature(file_name, block_size)), self.new_flow())
+
+                with open(fd, "wb") as fp, (
+                        open(file_name, "rb") if os.path.isfile(file_name) else contextlib.nullcontext()) as basis:
+                    copied, literal = await in_thread(
+                        lambda chunks: delta.patch(basis, chunks, block_size, fp), read_chunks(reader, self.new_flow()))
+
+            if await self.control.receive() != await asyncio.to_thread(hash_file, temporary):
+                raise integrity_error(f'{file_name} does not match the server\'s copy after patching, get it again')
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+        os.replace(temporary, file_name)
+        return copied, literal
+
+    @exclusive
+    async def dput(self, file_name: str) -> int:
+        """
+        uploads a file as a delta against the server's copy.
+        The server describes its copy block by block and only the blocks it
+        does not have cross the network
+        @return - the num of bytes sent
+        @raise FileNotFoundError - there is no such local file
+        @raise server_error - the rebuilt file does not match
+        """
+        if not os.path.isfile(file_name):
+            raise FileNotFoundError(f'{file_name} does not exist')
+
+        await self.request(13, os.path.basename(file_name))
+
+        async with self.transfer() as (reader, writer):
+            block_size = int(await read_message(reader))
+            table = await in_thread(delta.load_signature, read_chunks(reader, self.new_flow()))
+            bytes_sent = await write_chunks(writer, from_thread(delta.delta(file_name, table, block_size)), self.new_flow())
+
+        self.control.send(await asyncio.to_thread(hash_file, file_name))
+        if await self.control.receive() == 'ERR':
+            raise server_error(await self.control.receive())
+
+        return bytes_sent
+
+    @exclusive
+    async def zget(self, file_name: str, codec: str) -> str:
+        """
+        downloads a file compressed with codec, decompressing it as it arrives.
+        The server sends files that are compressed already as they are
+        @return - the codec the server picked
+        """
+        await self.request(14, file_name, f'{codec},none')
+        codec = await self.control.receive()
+
+        def write(chunks: typing.Iterator[bytes], fp: typing.BinaryIO) -> None:
+            for chunk in compression.decompress_chunks(chunks, codec):
+                fp.write(chunk)
+
+        async with self.transfer() as (reader, _):
+            with open(file_name, "wb") as fp:
+                try:
+                    await in_thread(write, read_chunks(reader, self.new_flow()), fp)
+                except compression.DECODE_ERRORS as error:
+                    raise transfer_error(str(error)) from error
+
+        return codec
+
+    @exclusive
+    async def zput(self, file_name: str, codec: str) -> int:
+        """
+        uploads a file compressed with codec.
+        Files that are compressed already are sent as they are
+        @return - the num of bytes sent
+        @raise FileNotFoundError - there is no such local file
+        """
+        if not os.path.isfile(file_name):
+            raise FileNotFoundError(f'{file_name} does not exist')
+
+        await self.request(15, os.path.basename(file_name), compression.choose_codec([codec], file_name))
+        codec = await self.control.receive()
+
+        async with self.transfer() as (_, writer):
+            with open(file_name, "rb") as fp:
+                return await write_chunks(writer, from_thread(compression.compress_chunks(fp, codec)), self.new_flow())
+
+    @exclusive
+    async def rget(self, directory_name: str) -> typing.Dict[str, int]:
+        """
+        downloads a directory and everything under it, extracting it as it arrives
+        @return - the num of files and directories written
+        """
+        await self.request(16, directory_name)
+
+        # .basename() keeps the tree inside the current dir
+        directory_name = os.path.basename(os.path.normpath(directory_name))
+
+        async with self.transfer() as (reader, _):
+            return await in_thread(archive.extract_chunks, read_chunks(reader, self.new_flow()), '.', directory_name)
+
+    @exclusive
+    async def rput(self, directory_name: str) -> typing.Dict[str, int]:
+        """
+        uploads a directory and everything under it as one stream
+        @return - the num of files and directories sent
+        @raise NotADirectoryError - there is no such local directory
+        @raise server_error - the server could not write the tree
+        """
+        if not os.path.isdir(directory_name):
+            raise NotADirectoryError(f'{directory_name} is not a directory')
+
+        await self.request(17, os.path.basename(os.path.normpath(directory_name)))
+
+        counts: typing.Dict[str, int] = {}
+        data = await self.open_data_channel()
+
+        try:
+            await write_chunks(data[1], from_thread(archive.tree_chunks(directory_name, counts)), self.new_flow())
+        except (OSError, ValueError):
+            # the stream is cut short, the server sees a broken tree and says so
+            self.close_data_channel(data, broken=True)
+            await self.control.receive()
+            raise server_error(await self.control.receive())
+
+        # the server answers once every file is written,
+        # after an error it drops the 'data' channel
+        response = await self.control.receive()
+        self.close_data_channel(data, broken=response == 'ERR')
+        if response == 'ERR':
+            raise server_error(await self.control.receive())
+
+        return counts
+
+    @exclusive
+    async def mget(self, patterns: typing.List[str]) -> typing.Tuple[typing.List[str], typing.List[str]]:
+        """
+        downloads every file matching the patterns in as few batches as the request size allows
+        @return - the files written and the errors, one per pattern or file that failed or did not match its checksum
+        """
+        written: typing.List[str] = []
+        errors: typing.List[str] = []
+        for batch in batches(patterns):
+            await self.get_batch(batch, written, errors)
+        return written, errors
+
+    async def get_batch(self, patterns: typing.List[str], written: typing.List[str], errors: typing.List[str]) -> None:
+        """downloads the files of patterns that fit in one request, adding them to written and errors"""
+        # every pattern goes out at once, the server streams the files back in order
+        await self.request(6, str(len(patterns)), *patterns)
+
+        async with self.transfer() as (reader, _):
+            for _ in range(int(await self.control.receive())):
+                if await self.control.receive() == 'ERR':
+                    errors.append(await self.control.receive())
+                    continue
+
+                # .basename() keeps the file inside the current dir
+                file_name = os.path.basename(await self.control.receive())
+                digest = self.new_digest()
+                with open(file_name, "wb") as fp:
+                    await read_stream(reader, fp, self.new_flow(), digest)
+
+                try:
+                    verify(file_name, digest, await read_trailer(reader, digest))
+                except integrity_error as error:
+                    os.unlink(file_name)
+                    errors.append(str(error))
+                    continue
+                written.append(file_name)
+
+    @exclusive
+    async def mput(self, patterns: typing.List[str]) -> typing.Dict[str, typing.Optional[str]]:
+        """
+        uploads every local file matching the patterns in one batch
+        @return - every file sent and every pattern that matched nothing,
+        with None or the error
+        """
+        file_names: typing.List[str] = []
+        results: typing.Dict[str, typing.Optional[str]] = {}
+
+        for pattern in patterns:
+            if not (matches := sorted(filter(os.path.isfile, glob.glob(pattern)))):
+                results[pattern] = f'{pattern} does not match any file'
+            file_names.extend(matches)
+
+        results.update(await self.send_files(file_names))
+        return results
+
+    async def send_files(self, file_names: typing.List[str]) -> typing.Dict[str, typing.Optional[str]]:
+        """uploads local files in as few batches as the request size allows"""
+        results: typing.Dict[str, typing.Optional[str]] = {}
+        for batch in batches(file_names):
+            results.update(await self.send_batch(batch))
+        return results
+
+    async def send_batch(self, file_names: typing.List[str]) -> typing.Dict[str, typing.Optional[str]]:
+        """uploads local files in one batch, without waiting between files"""
+        # .basename() is in case a file name is a path to a file
+        await self.request(7, str(len(file_names)), *[os.path.basename(file_name) for file_name in file_names])
+
+        data = await self.open_data_channel()
+        broken = False
+
+        # send every file without waiting, the server answers each one afterwards
+        try:
+            for file_name in file_names:
+                digest = self.new_digest()
+                with open(file_name, "rb") as fp:
+                    await write_file(data[1], fp, os.fstat(fp.fileno()).st_size,
+                                     transfer=self.new_flow(), digest=digest)
+                if digest is not None:
+                    data[1].write(prepend_size(digest.hexdigest().encode('ascii')))
+        except (OSError, ftp_error):
+            # the server reads a file cut short and answers the rest of the batch with errors
+            broken = True
+            self.close_data_channel(data, broken=True)
+
+        results: typing.Dict[str, typing.Optional[str]] = {}
+        for file_name in file_names:
+            results[file_name] = await self.control.receive() if await self.control.receive() == 'ERR' else None
+
+        if not broken:
+            self.close_data_channel(data)
+
+        return results
+
+    @exclusive
+    async def sync(self, directory: str = '.') -> typing.Dict[str, typing.Optional[str]]:
+        """
+        mirrors the files of a local directory to the server.
+        The server sends the manifest of its files and only the files that are
+        new or changed are sent
+        @return - every file sent, with None or the server's error
+        @raise NotADirectoryError - there is no such local directory
+        """
+        if not os.path.isdir(directory):
+            raise NotADirectoryError(f'{directory} is not a directory')
+
+        await self.request(11)
+
+        # one JSON object per line: name, size, mtime and hash
+        async with self.transfer() as (reader, _):
+            remote = {item['name']: item for item in map(
+                json.loads, filter(None, (await read_message(reader)).split('\n')))}
+
+        def changed() -> typing.List[str]:
+            with os.scandir(directory) as entries:
+                # a different size is enough, only files of the same size are hashed
+                return [entry.path for entry in sorted(filter(os.DirEntry.is_file, entries),
+                                                        key=lambda entry: entry.name)
+                        if (theirs := remote.get(entry.name)) is None
+                        or theirs['size'] != entry.stat().st_size
+                        or theirs['hash'] != hash_file(entry.path)]
+
+        return await self.send_files(await asyncio.to_thread(changed))
+
+    @exclusive
+    async def ls(self, pattern: str = '*',
+                 on_page: typing.Optional[typing.Callable[[typing.List[typing.Dict[str, typing.Any]]], None]] = None
+                 ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        lists the server's directory, only the names matching pattern
+        @param on_page - called with every page of entries as it arrives
+        @return - the name, size, mtime and type of every entry
+        """
+        # a plain ls has no argument, the way version 1 servers expect it
+        if pattern == '*':
+            await self.request(3)
+        else:
+            await self.request(22, pattern)
+        entries: typing.List[typing.Dict[str, typing.Any]] = []
+
+        async with self.transfer() as (reader, _):
+            async for page in read_chunks(reader, self.new_flow()):
+                entries.extend(page := [json.loads(line) for line in page.decode('utf-8').split('\n')])
+                if on_page is not None:
+                    on_page(page)
+
+        return entries
@@ -0,0 +1,108 @@
+"""
+Streaming compression of the 'data' channel, negotiated per transfer
+Bodies are compressed and decompressed one chunk at a time, so memory stays
+bounded whatever the size of the file
+"""
+
+import bz2
+import collections
+import lzma
+import math
+import os
+import typing
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+# codec name -> (compressor factory, decompressor factory)
+CODECS: typing.Dict[str, typing.Tuple[typing.Callable, typing.Callable]] = {
+    'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj),
+    'lzma': (lambda: lzma.LZMACompressor(preset=1), lzma.LZMADecompressor),
+    'bz2': (lambda: bz2.BZ2Compressor(9), bz2.BZ2Decompressor),
+}
+
+# formats that are compressed already, compressing them again only costs CPU
+COMPRESSED_EXTENSIONS = frozenset({
+    '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.jar',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.mov', '.pdf',
+})
+# bits per byte above which a sample is treated as incompressible
+ENTROPY_LIMIT = 7.5
+# what a corrupt stream raises while it is decompressed
+DECODE_ERRORS = (ValueError, EOFError, OSError, zlib.error, lzma.LZMAError)
+
+
+def entropy(sample: bytes) -> float:
+    """Shannon entropy of a sample in bits per byte"""
+    if not sample:
+        return 0.0
+    return -sum(count / len(sample) * math.log2(count / len(sample))
+                for count in collections.Counter(sample).values())
+
+
+def first_supported(offered: typing.List[str]) -> str:
+    """picks the first offered codec this side supports"""
+    return next((codec for codec in offered if codec in CODECS), 'none')
+
+
+def choose_codec(offered: typing.List[str], path: typing.Union[str, os.PathLike]) -> str:
+    """
+    Picks the codec the sender of a file uses.
+    Files that look compressed already, by extension or by the entropy of
+    their first chunk, are sent as they are
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return 'none'
+
+    with open(path, "rb") as fp:
+        if entropy(fp.read(CHUNK_SIZE)) > ENTROPY_LIMIT:
+            return 'none'
+
+    return first_supported(offered)
+
+
+def compress_chunks(fp: typing.BinaryIO, codec: str,
+                    chunk_size: int = CHUNK_SIZE) -> typing.Iterator[bytes]:
+    """reads a binary file one chunk at a time and yields it compressed with codec"""
+    if codec == 'none':
+        while chunk := fp.read(chunk_size):
+            yield chunk
+        return
+
+    compressor = CODECS[codec][0]()
+    while chunk := fp.read(chunk_size):
+        if output := compressor.compress(chunk):
+            yield output
+    yield compressor.flush()
+
+
+def decompress_chunks(chunks: typing.Iterable[bytes], codec: str,
+                      chunk_size: int = CHUNK_SIZE) -> typing.Iterator[bytes]:
+    """
+    yields the decompressed contents of chunks compressed with codec, at most
+    chunk_size bytes at a time, so a small chunk that expands a lot is never
+    held in memory all at once
+    """
+    if codec == 'none':
+        yield from chunks
+        return
+
+    decompressor = CODECS[codec][1]()
+    for chunk in chunks:
+        while not decompressor.eof:
+            if output := decompressor.decompress(chunk, chunk_size):
+                yield output
+
+            if hasattr(decompressor, 'unconsumed_tail'):
+                # zlib hands back the input it did not get to, a full output
+                # may leave more pending even when all of it was consumed
+                if not (chunk := decompressor.unconsumed_tail) and len(output) < chunk_size:
+                    break
+            elif decompressor.needs_input:
+                break
+            else:
+                # lzma and bz2 keep the input, they are called with nothing until they need more
+                chunk = b''
+
+    if not decompressor.eof:
+        raise ValueError(f'the {codec} stream ended early')
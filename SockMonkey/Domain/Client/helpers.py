@@ -1,6 +1,75 @@
+import collections
+import hashlib
+import io
+import os
 import socket
+import struct
+import time
 import typing
 
+from . import metrics
+
+# number of bytes moved per read/send when streaming file bodies
+CHUNK_SIZE = 64 * 1024
+# every message is preceded by its size, padded to 10 bytes
+HEADER_SIZE = 10
+
+# highest version of the control protocol spoken
+VERSION = 2
+# version 2 frame header: opcode, flags, request id and payload size
+FRAME = struct.Struct('!BBIQ')
+# every field of a version 2 payload is preceded by its size
+FIELD = struct.Struct('!I')
+# version 2 opcodes of replies and of plain messages, commands use their code
+MESSAGE = 0
+STATUSES = {'OK': 0xFE, 'ERR': 0xFF}
+# the largest message or frame accepted on 'control', its size comes from the peer
+MAX_MESSAGE = 1 << 20
+
+def no_delay(sock: socket.socket) -> socket.socket:
+    """
+    Disables Nagle's algorithm on sock.
+    Messages are written as a header and a body, without this the
+    second write waits for the peer's delayed ACK
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def receive_into(socket: socket.socket, view: memoryview,
+                 chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Fills a preallocated buffer from the specified socket
+    Each recv_into asks for at most chunk_size bytes,
+    so large messages never cause huge recv requests
+    @param socket - the socket from which to receive
+    @param view - the buffer to fill
+    @return - the num of bytes received, less than len(view) if the socket closed
+    """
+    bytes_received = 0
+
+    while bytes_received < len(view):
+        if not (n := socket.recv_into(view[bytes_received:bytes_received + chunk_size])):
+            break
+        bytes_received += n
+
+    return bytes_received
+
+def receive_buffer(socket: socket.socket, size: int) -> bytearray:
+    """
+    Receives up to size bytes into a new buffer
+    The size comes from the peer, past the first chunk the buffer
+    only grows as bytes actually arrive, doubling every time it fills
+    @return - the bytes received, fewer than size if the socket closed
+    """
+    buffer = bytearray(min(size, CHUNK_SIZE))
+    n = receive_into(socket, memoryview(buffer))
+
+    while n == len(buffer) < size:
+        buffer.extend(bytes(min(len(buffer), size - n)))
+        n += receive_into(socket, memoryview(buffer)[n:])
+
+    del buffer[n:]
+    return buffer
 
 def receive_bytes(socket: socket.socket, buffer_size: int) -> str:
     """
@@ -10,56 +79,220 @@ def receive_bytes(socket: socket.socket, buffer_size: int) -> str:
     @param buffer_size - the number of bytes to receive
     @return - string
     """
-    receiver_buffer: bytes = b''
+    return receive_buffer(socket, buffer_size).decode('utf-8')
 
-    while len(receiver_buffer) < buffer_size:
-        if not (t := socket.recv(buffer_size)):
-            break
-        receiver_buffer += t
+def iter_bytes(socket: socket.socket, size: int,
+               chunk_size: int = CHUNK_SIZE) -> typing.Iterator[memoryview]:
+    """
+    Receives the specified number of bytes one chunk at a time
+    The chunks are views into a single reused buffer, they are only
+    valid until the next chunk is requested
+    @param socket - the socket from which to receive
+    @param size - the number of bytes to receive
+    @raise ConnectionError - the socket closed before size bytes arrived
+    """
+    view = memoryview(bytearray(min(chunk_size, size)))
+    bytes_received = 0
 
-    return receiver_buffer.decode('utf-8')
+    while bytes_received < size:
+        if not (n := socket.recv_into(view, min(chunk_size, size - bytes_received))):
+            raise ConnectionError(
+                f'{socket} closed after {bytes_received} of {size} bytes')
+        bytes_received += n
+        yield view[:n]
 
 def receive_all(socket: socket.socket) -> str:
     """
     Receive the entire message from socket.
     The first 10 bytes must indicate the size of the message.
     """
+    start = time.perf_counter()
     try:
         if (size := int(receive_bytes(socket, 10))) < 0:
             return f'receive_all() received the wrong message format from {socket}. The message size was negative'
     except:
         return f'receive_all() received the wrong message format from {socket}. The first 10 bytes must be the message\'s size'
 
-    return receive_bytes(socket, size)
+    msg = receive_bytes(socket, size)
+    metrics.default.message('receive_all', HEADER_SIZE + size, time.perf_counter() - start)
+    return msg
 
-def send_all(socket: socket.socket, msg: str, prepend: bool = True) -> None:
+def send_all(socket: socket.socket, msg: typing.Union[str, bytes], prepend: bool = True) -> None:
     """
     Sends msg encoded using utf-8 over socket.
+    The message is encoded once and its size is counted in bytes, not characters
     @prepend - msg should be prepended with its size (size is padded to 10 bytes)
+    """
+    payload = msg.encode('utf-8') if isinstance(msg, str) else bytes(msg)
+
+    if prepend:
+        payload = prepend_size(payload)
+
+    # sendall keeps sending until all the data is sent
+    start = time.perf_counter()
+    socket.sendall(payload)
+    metrics.default.message('send_all', len(payload), time.perf_counter() - start)
+
+def split_range(size: int, parts: int) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Splits size bytes into at most parts contiguous segments
+    @return - the (offset, length) of every non-empty segment
+    """
+    step = -(-size // max(parts, 1)) or 1
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+
+def send_header(socket: socket.socket, size: int) -> None:
+    """Sends the size header that precedes a message body"""
+    socket.sendall(pad_str(str(size)).encode('ascii'))
+
+def receive_header(socket: socket.socket) -> int:
+    """
+    Receives the size header that precedes a message body
+    @return - the size of the body in bytes
+    @raise ValueError - the header is malformed or the socket closed early
+    """
+    header = receive_bytes(socket, HEADER_SIZE)
+
+    if len(header) != HEADER_SIZE or not header.isdigit():
+        raise ValueError(
+            f'received the wrong message format from {socket}. The first {HEADER_SIZE} bytes must be the message\'s size')
+
+    return int(header)
+
+def send_stream(socket: socket.socket, fp: typing.BinaryIO, size: int,
+                prepend: bool = True, chunk_size: int = CHUNK_SIZE,
+                digest: typing.Optional[typing.Any] = None) -> int:
+    """
+    Sends size bytes read from the binary file fp over socket.
+    The body is moved through one reusable buffer, so memory use
+    does not depend on the size of the file
+    @prepend - the body should be prepended with its size
+    @digest - a running checksum updated with every chunk sent
     @return - the num of bytes sent
     """
     if prepend:
-        msg = prepend_size(msg)
+        send_header(socket, size)
+
+    view = memoryview(bytearray(chunk_size))
+    bytes_sent = 0
+
+    while bytes_sent < size:
+        if not (n := fp.readinto(view[:min(chunk_size, size - bytes_sent)])):
+            raise EOFError(
+                f'{getattr(fp, "name", fp)} ended after {bytes_sent} of {size} bytes')
+        if digest is not None:
+            digest.update(view[:n])
+        socket.sendall(view[:n])
+        bytes_sent += n
+
+    return bytes_sent
+
+def send_file(socket: socket.socket, fp: typing.BinaryIO, size: int,
+              offset: int = 0, prepend: bool = True,
+              digest: typing.Optional[typing.Any] = None) -> int:
+    """
+    Sends size bytes of the binary file fp, starting at offset, over socket.
+    The kernel copies the body straight from the page cache with sendfile,
+    files without a descriptor (or platforms without sendfile)
+    fall back to send_stream, as does a body that is checksummed on the way
+    @prepend - the body should be prepended with its size
+    @digest - a running checksum updated with every chunk sent
+    @return - the num of bytes sent
+    """
+    if prepend:
+        send_header(socket, size)
+
+    try:
+        use_sendfile = hasattr(os, 'sendfile') and fp.fileno() >= 0
+    except (AttributeError, io.UnsupportedOperation):
+        use_sendfile = False
+
+    if not use_sendfile or digest is not None:
+        fp.seek(offset)
+        return send_stream(socket, fp, size, prepend=False, digest=digest)
+
+    # sendfile reads a count of 0 as "up to the end of the file"
+    if size == 0:
+        return 0
+
+    # socket.sendfile loops over os.sendfile until count bytes are sent
+    if (bytes_sent := socket.sendfile(fp, offset, size)) < size:
+        raise EOFError(
+            f'{getattr(fp, "name", fp)} ended after {bytes_sent} of {size} bytes')
+
+    return bytes_sent
+
+def receive_stream(socket: socket.socket, fp: typing.BinaryIO,
+                   chunk_size: int = CHUNK_SIZE,
+                   digest: typing.Optional[typing.Any] = None) -> int:
+    """
+    Receives a size prefixed body from socket and writes it to the binary file fp
+    one chunk at a time, without holding the body in memory
+    @digest - a running checksum updated with every chunk received
+    @return - the num of bytes received
+    @raise ConnectionError - the socket closed before the whole body arrived
+    """
+    bytes_received = 0
+
+    for chunk in iter_bytes(socket, receive_header(socket), chunk_size):
+        if digest is not None:
+            digest.update(chunk)
+        fp.write(chunk)
+        bytes_received += len(chunk)
 
+    return bytes_received
+
+def hash_file(path: typing.Union[str, os.PathLike], algorithm: str = 'sha256',
+              chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    Hashes a file one chunk at a time
+    @return - the hex digest of the file
+    """
+    digest = hashlib.new(algorithm)
+    view = memoryview(bytearray(chunk_size))
+
+    with open(path, "rb") as fp:
+        while n := fp.readinto(view):
+            digest.update(view[:n])
+
+    return digest.hexdigest()
+
+def send_chunks(socket: socket.socket, chunks: typing.Iterable[bytes]) -> int:
+    """
+    Sends a body of unknown size as a series of size prefixed chunks,
+    an empty chunk marks the end of the body
+    @return - the num of bytes sent, headers included
+    """
     bytes_sent = 0
 
-    # keep sending until all the data is sent
-    while len(msg) > bytes_sent:
-        bytes_sent += socket.send(msg[bytes_sent:].encode('utf-8'))
+    for chunk in chunks:
+        # an empty chunk would end the body early
+        if chunk:
+            send_header(socket, len(chunk))
+            socket.sendall(chunk)
+            bytes_sent += HEADER_SIZE + len(chunk)
 
-def send_err(socket: socket.socket, err_msg: str) -> None:
-    """sends an error signal and message to socket"""
-    send_all(socket, 'ERR')
-    send_all(socket, err_msg)
+    send_header(socket, 0)
+    return bytes_sent + HEADER_SIZE
 
-def prepend_size(s: str) -> str:
-    """Prepends a string with its size"""
-    size = str(len(s))
+def iter_chunks(socket: socket.socket) -> typing.Iterator[bytearray]:
+    """
+    Receives a body sent by send_chunks, one chunk at a time
+    @raise ConnectionError - the socket closed in the middle of a chunk
+    """
+    while size := receive_header(socket):
+        if len(chunk := receive_buffer(socket, size)) < size:
+            raise ConnectionError(f'{socket} closed after {len(chunk)} of {size} bytes')
+        yield chunk
+
+def prepend_size(payload: bytes) -> bytes:
+    """Prepends an encoded message with its size in bytes"""
+    size = str(len(payload))
 
-    # first 10 bytes of a string will be its size e.g. 0000000004DONE
+    # first 10 bytes of a message will be its size e.g. 0000000004DONE
     size = pad_str(size)
 
-    return size + s
+    return size.encode('ascii') + payload
 
 def pad_str(s: str, pad: str = '0', length: int = 10) -> str:
     """
@@ -67,6 +300,127 @@ def pad_str(s: str, pad: str = '0', length: int = 10) -> str:
     @pad - the charater to prepend the string with
     @length - the total length desired
     """
-    while len(s) < length:
-        s = pad + s
-    return s
\ No newline at end of file
+    return s.rjust(length, pad)
+
+def unpack_fields(payload: typing.Union[bytes, memoryview]) -> typing.List[str]:
+    """
+    Splits the payload of a version 2 frame into its size prefixed fields
+    @raise ValueError - a field overruns the frame
+    """
+    fields = []
+    size = len(payload)
+    offset = 0
+
+    while offset < size:
+        if offset + FIELD.size > size:
+            raise ValueError(f'a field header overruns the frame of {size} bytes')
+        (length,) = FIELD.unpack_from(payload, offset)
+        offset += FIELD.size
+        if offset + length > size:
+            raise ValueError(f'a field of {length} bytes overruns the frame of {size} bytes')
+        fields.append(str(payload[offset:offset + length], 'utf-8'))
+        offset += length
+
+    return fields
+
+class control_channel:
+    """
+    The 'control' channel of one connection, in either version of the protocol.
+    Both versions carry the same fields in the same order.
+    Version 1 sends every field as a size prefixed message, version 2 packs a
+    request, a reply or a message with all its fields into a single frame,
+    so a command and its reply cost one write and one read each
+    """
+
+    def __init__(self, socket: socket.socket, version: int = 1):
+        self.socket = socket
+        self.version = version
+        # the request being answered, replies carry the id of their request
+        self.request_id = 0
+        # fields of the last frame that were not read yet
+        self.fields: typing.Deque[str] = collections.deque()
+        # 'OK' or 'ERR', the status of the last reply sent
+        self.status: typing.Optional[str] = None
+
+    def send_request(self, opcode: int, *fields: str) -> None:
+        """sends a command code and its arguments"""
+        if self.version == 1:
+            return self.send_messages(str(opcode), *fields)
+
+        self.request_id = (self.request_id + 1) % 2 ** 32
+        self.send_frame(opcode, fields)
+
+    def send_reply(self, status: str, *fields: str) -> None:
+        """sends 'OK' or 'ERR' and the fields that go with it"""
+        self.status = status
+        if self.version == 1:
+            return self.send_messages(status, *fields)
+
+        self.send_frame(STATUSES[status], fields)
+
+    def send(self, *fields: str) -> None:
+        """sends fields that are neither a request nor a reply"""
+        if self.version == 1:
+            return self.send_messages(*fields)
+
+        self.send_frame(MESSAGE, fields)
+
+    def send_messages(self, *fields: str) -> None:
+        """version 1: every field is its own message, all of them in a single write"""
+        self.socket.sendall(b''.join(prepend_size(field.encode('utf-8')) for field in fields))
+
+    def send_frame(self, opcode: int, fields: typing.Iterable[str], flags: int = 0) -> None:
+        """version 2: one header and the size prefixed fields, in a single write"""
+        payload = b''.join(FIELD.pack(len(encoded)) + encoded
+                           for encoded in (field.encode('utf-8') for field in fields))
+        self.socket.sendall(FRAME.pack(opcode, flags, self.request_id, len(payload)) + payload)
+
+    def receive(self) -> str:
+        """
+        Receives the next field.
+        A version 2 request starts with its command code and a reply with its status,
+        like the separate messages of version 1
+        @raise ConnectionError - the socket closed in the middle of a frame
+        @raise ValueError - a reply does not belong to the last request or a frame is larger than MAX_MESSAGE
+        """
+        if self.version == 1:
+            return receive_all(self.socket)
+
+        while not self.fields:
+            self.receive_frame()
+
+        return self.fields.popleft()
+
+    def receive_list(self) -> typing.List[str]:
+        """
+        Receives the number of items followed by each item
+        @raise ValueError - the number of items is malformed
+        """
+        if (count := int(self.receive())) < 0:
+            raise ValueError(f'received a negative list size from {self.socket}')
+
+        return [self.receive() for _ in range(count)]
+
+    def receive_frame(self) -> None:
+        """version 2: reads one frame and queues its fields"""
+        header = bytearray(FRAME.size)
+        if (n := receive_into(self.socket, memoryview(header))) < FRAME.size:
+            raise ConnectionError(f'{self.socket} closed after {n} of {FRAME.size} header bytes')
+        opcode, flags, request_id, size = FRAME.unpack(header)
+        if FRAME.size + size > MAX_MESSAGE:
+            raise ValueError(f'received a frame of {FRAME.size + size} bytes, at most {MAX_MESSAGE} are accepted')
+
+        payload = memoryview(bytearray(size))
+        if (n := receive_into(self.socket, payload)) < size:
+            raise ConnectionError(f'{self.socket} closed after {n} of {size} bytes')
+
+        if opcode in STATUSES.values():
+            if request_id != self.request_id:
+                raise ValueError(f'received the reply to request {request_id} while waiting for {self.request_id}')
+            self.fields.append('OK' if opcode == STATUSES['OK'] else 'ERR')
+        elif opcode != MESSAGE:
+            # the id of a request is echoed by every reply to it
+            self.request_id = request_id
+            self.fields.append(str(opcode))
+
+        self.fields.extend(unpack_fields(payload))
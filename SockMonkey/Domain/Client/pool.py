@@ -0,0 +1,155 @@
+"""
+Pool of control sessions to one server
+Sessions are opened on demand up to a fixed number and taken back after
+every use, so a batch of jobs pays for the connection and the protocol
+handshake once instead of once per job. A session that sat idle for a
+while is checked with a no-op before it is handed out again
+"""
+
+import asyncio
+import contextlib
+import time
+import typing
+
+from SockMonkey.Domain.Client.client import ftp_client, ftp_error, server_error
+from SockMonkey.Domain.Client.helpers import VERSION
+from SockMonkey.Domain.Client.throttle import throttle
+
+
+class connection_pool:
+    def __init__(self, server_name: str = "127.0.0.1", server_port: int = 1233, size: int = 4,
+                 version: int = VERSION, persistent: bool = False, check_after: float = 5.0,
+                 client: typing.Type[ftp_client] = ftp_client,
+                 limits: typing.Optional[throttle] = None):
+        if size < 1:
+            raise ValueError(f'the pool needs room for at least one session, received {size}')
+        self.server_name = server_name
+        self.server_port = server_port
+        self.size = size
+        self.version = version
+        self.persistent = persistent
+        # an idle session older than this is checked before it is handed out
+        self.check_after = check_after
+        # the class of the sessions, a subclass can route them differently
+        self.client = client
+        # bandwidth limits shared by every session of the pool
+        self.limits = limits
+        self.slots = asyncio.Semaphore(size)
+        self.closed = False
+
+        # idle sessions and when they were last given back, the most recent last
+        self.idle: typing.List[typing.Tuple[ftp_client, float]] = []
+
+        # sessions handed out, how many of them were reused and how long callers waited
+        self.checkouts = 0
+        self.reused = 0
+        self.opened = 0
+        self.failed_checks = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def __aenter__(self) -> 'connection_pool':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @contextlib.asynccontextmanager
+    async def session(self) -> typing.AsyncIterator[ftp_client]:
+        """
+        hands out a session for the caller's commands and takes it back afterwards.
+        A session is only kept if its commands succeeded or the server refused them,
+        after any other error its state is unknown and it is closed
+        """
+        client = await self.acquire()
+
+        try:
+            yield client
+        except server_error:
+            await self.release(client)
+            raise
+        except BaseException:
+            await self.discard(client)
+            raise
+
+        await self.release(client)
+
+    async def acquire(self) -> ftp_client:
+        """
+        waits for a free slot and returns an idle session, or a new one while
+        the pool is not full
+        @raise ftp_error - the pool is closed or the server could not be reached
+        """
+        if self.closed:
+            raise ftp_error('the pool is closed')
+
+        # the wait covers the slot, the health check and the connection if one was opened
+        start = time.perf_counter()
+        await self.slots.acquire()
+
+        try:
+            client = await self.checkout()
+        except BaseException:
+            self.slots.release()
+            raise
+
+        waited = time.perf_counter() - start
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return client
+
+    async def checkout(self) -> ftp_client:
+        """returns the most recently used healthy session, or a new one"""
+        while self.idle:
+            client, released = self.idle.pop()
+
+            if time.monotonic() - released >= self.check_after:
+                try:
+                    await client.noop()
+                except (ftp_error, OSError):
+                    self.failed_checks += 1
+                    await client.close()
+                    continue
+                except BaseException:
+                    await client.close()
+                    raise
+
+            self.reused += 1
+            return client
+
+        client = await self.client(self.server_name, self.server_port, self.version,
+                                   self.persistent, self.limits).connect()
+        self.opened += 1
+        return client
+
+    async def release(self, client: ftp_client) -> None:
+        """takes a session back, it is closed instead once the pool is"""
+        if self.closed:
+            return await self.discard(client)
+
+        self.idle.append((client, time.monotonic()))
+        self.slots.release()
+
+    async def discard(self, client: ftp_client) -> None:
+        """closes a session that cannot be trusted and frees its slot"""
+        try:
+            await client.close()
+        finally:
+            self.slots.release()
+
+    async def close(self) -> None:
+        """closes the idle sessions, those in use are closed when they are given back"""
+        self.closed = True
+
+        while self.idle:
+            await self.idle.pop()[0].close()
+
+    def counters(self) -> typing.Dict[str, typing.Any]:
+        """how often sessions were reused and how long callers waited for one, in seconds"""
+        return {'size': self.size, 'idle': len(self.idle), 'opened': self.opened,
+                'checkouts': self.checkouts, 'reused': self.reused,
+                'reuse_ratio': self.reused / self.checkouts if self.checkouts else 0.0,
+                'failed_checks': self.failed_checks,
+                'wait_mean': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max': self.wait_max}
@@ -0,0 +1,315 @@
+"""
+Bandwidth limits on the 'data' channel
+Every limit is a token bucket of bytes per second, a transfer draws from
+its own bucket, the bucket of its client and the global bucket before it
+moves a chunk. The global bucket is shared out by a fair scheduler, so a
+large transfer cannot starve the others and a transfer of priority 2 moves
+twice as much as one of priority 1 while both are waiting
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import typing
+import weakref
+
+log = logging.getLogger(__name__)
+
+# the most bytes moved between two checks of the limits
+CHUNK_SIZE = 64 * 1024
+# priorities a transfer may have, its share of the global limit grows with it
+PRIORITIES = range(1, 9)
+# a rate such as 500K, 10M or 1.5G bytes per second
+RATE = re.compile(r'(\d+(?:\.\d+)?)([KMG]?)', re.IGNORECASE)
+
+
+def parse_rate(text: str) -> float:
+    """
+    reads a rate in bytes per second, with an optional K, M or G suffix
+    @raise ValueError - the rate is malformed
+    """
+    if not (match := RATE.fullmatch(text.strip())):
+        raise ValueError(f'expected a rate such as 500K, 10M or 0 for no limit, received {text}')
+
+    number, suffix = match.groups()
+    return float(number) * 1024 ** ' KMG'.index(suffix.upper() or ' ')
+
+
+class token_bucket:
+    """
+    Bytes per second with a burst allowance, a rate of 0 is no limit.
+    Tokens are reserved before they are available, the caller sleeps off
+    the debt, so concurrent users of one bucket queue up in order
+    """
+
+    def __init__(self, rate: float = 0, burst: typing.Optional[int] = None):
+        self.lock = threading.Lock()
+        self.rate = 0.0
+        self.burst = 0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.configure(rate, burst)
+
+    def configure(self, rate: float, burst: typing.Optional[int] = None) -> None:
+        """changes the rate, the bucket starts full again"""
+        with self.lock:
+            self.rate = float(rate)
+            # a tenth of a second of data by default, at least one chunk
+            self.burst = burst if burst is not None else max(CHUNK_SIZE, int(rate / 10))
+            self.tokens = self.burst
+            self.stamp = time.monotonic()
+
+    def reserve(self, size: int) -> float:
+        """
+        takes size tokens
+        @return - the seconds to wait before the bytes may move
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class scheduler:
+    """
+    Shares the global bucket among the transfers waiting for it, by priority.
+    Self-clocked fair queueing: every request is stamped with the virtual
+    time at which its transfer would finish it at its share, and requests
+    are granted in stamp order, one at a time
+    """
+
+    def __init__(self, bucket: token_bucket):
+        self.bucket = bucket
+        self.condition = threading.Condition()
+        self.queue: typing.List[typing.List[float]] = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.busy = False
+
+    def acquire(self, transfer: 'flow', size: int) -> None:
+        """waits until the transfer may move size bytes under the global limit"""
+        if self.bucket.rate <= 0:
+            return
+
+        with self.condition:
+            transfer.finish = max(self.virtual_time, transfer.finish) + size / transfer.priority
+            request = [transfer.finish, next(self.sequence)]
+            heapq.heappush(self.queue, request)
+
+            while self.busy or self.queue[0] is not request:
+                self.condition.wait()
+            self.busy = True
+            self.virtual_time = request[0]
+
+        try:
+            time.sleep(self.bucket.reserve(size))
+        finally:
+            with self.condition:
+                heapq.heappop(self.queue)
+                self.busy = False
+                self.condition.notify_all()
+
+
+class flow:
+    """one transfer, with the buckets it draws from and its priority"""
+
+    def __init__(self, buckets: typing.Iterable[token_bucket],
+                 scheduler: typing.Optional[scheduler] = None, priority: int = 1):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+        self.scheduler = scheduler
+        self.priority = priority
+        # virtual finish time of the last request, kept by the scheduler
+        self.finish = 0.0
+        # the measurement of the command the transfer belongs to, if any
+        self.meter = None
+
+    def moved(self, call: str, sent: int = 0, received: int = 0) -> None:
+        """reports a socket call and the bytes it moved to the meter"""
+        if self.meter is not None:
+            self.meter.moved(call, sent, received)
+
+    def limited(self) -> bool:
+        """True while any limit applies to the transfer"""
+        return any(bucket.rate > 0 for bucket in self.buckets) or bool(
+            self.scheduler and self.scheduler.bucket.rate > 0)
+
+    def delay(self, size: int) -> float:
+        """takes size tokens from every bucket, returns the seconds until all of them allow it"""
+        return max((bucket.reserve(size) for bucket in self.buckets), default=0.0)
+
+    def take(self, size: int) -> None:
+        """waits until size bytes may move"""
+        if wait := self.delay(size):
+            time.sleep(wait)
+
+        if self.scheduler is not None:
+            self.scheduler.acquire(self, size)
+
+
+class throttled_socket:
+    """
+    A 'data' socket whose sends and receives are paced by a flow.
+    Everything but the data path goes straight to the socket
+    """
+
+    def __init__(self, sock: socket.socket, transfer: flow):
+        self.socket = sock
+        self.flow = transfer
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self.socket, name)
+
+    def __enter__(self) -> 'throttled_socket':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.socket.close()
+
+    def sendall(self, data: typing.Union[bytes, bytearray, memoryview]) -> None:
+        view = memoryview(data)
+        if not self.flow.limited():
+            self.socket.sendall(view)
+            return self.flow.moved('sendall', sent=view.nbytes)
+
+        for start in range(0, view.nbytes, CHUNK_SIZE):
+            piece = view[start:start + CHUNK_SIZE]
+            self.flow.take(len(piece))
+            self.socket.sendall(piece)
+            self.flow.moved('sendall', sent=len(piece))
+
+    def sendfile(self, fp: typing.BinaryIO, offset: int = 0, count: typing.Optional[int] = None) -> int:
+        if not self.flow.limited():
+            bytes_sent = self.socket.sendfile(fp, offset, count)
+            self.flow.moved('sendfile', sent=bytes_sent)
+            return bytes_sent
+
+        bytes_sent = 0
+        while count is None or bytes_sent < count:
+            size = CHUNK_SIZE if count is None else min(CHUNK_SIZE, count - bytes_sent)
+            self.flow.take(size)
+            n = self.socket.sendfile(fp, offset + bytes_sent, size)
+            self.flow.moved('sendfile', sent=n)
+            if not n:
+                break
+            bytes_sent += n
+
+        return bytes_sent
+
+    def recv_into(self, buffer: typing.Union[bytearray, memoryview], nbytes: int = 0) -> int:
+        if not self.flow.limited():
+            n = self.socket.recv_into(buffer, nbytes)
+            self.flow.moved('recv_into', received=n)
+            return n
+
+        # the bytes are charged once they arrived, a full receive window
+        # makes the sender wait while this side sleeps
+        n = self.socket.recv_into(buffer, min(nbytes or len(buffer), CHUNK_SIZE))
+        self.flow.moved('recv_into', received=n)
+        self.flow.take(n)
+        return n
+
+
+class throttle:
+    """
+    The limits of one server: per transfer, per client and global.
+    Changing a limit applies to the transfers already running
+    """
+
+    def __init__(self, transfer_rate: float = 0, client_rate: float = 0, total_rate: float = 0):
+        self.lock = threading.Lock()
+        self.transfer_rate = transfer_rate
+        self.client_rate = client_rate
+        self.total = token_bucket(total_rate)
+        self.scheduler = scheduler(self.total)
+
+        # the buckets handed out, so that new limits reach them
+        self.transfer_buckets: 'weakref.WeakSet[token_bucket]' = weakref.WeakSet()
+        self.client_buckets: 'weakref.WeakSet[token_bucket]' = weakref.WeakSet()
+        self.closed = threading.Event()
+
+    def configure(self, transfer_rate: typing.Optional[float] = None,
+                  client_rate: typing.Optional[float] = None,
+                  total_rate: typing.Optional[float] = None) -> None:
+        """changes the limits that are given, in bytes per second, 0 is no limit"""
+        with self.lock:
+            if transfer_rate is not None:
+                self.transfer_rate = transfer_rate
+                for bucket in list(self.transfer_buckets):
+                    bucket.configure(transfer_rate)
+            if client_rate is not None:
+                self.client_rate = client_rate
+                for bucket in list(self.client_buckets):
+                    bucket.configure(client_rate)
+            if total_rate is not None:
+                self.total.configure(total_rate)
+
+    def client_bucket(self) -> token_bucket:
+        """the bucket shared by every transfer of one client"""
+        with self.lock:
+            self.client_buckets.add(bucket := token_bucket(self.client_rate))
+        return bucket
+
+    def new_flow(self, client_bucket: typing.Optional[token_bucket] = None, priority: int = 1,
+                 fair: bool = True) -> flow:
+        """
+        a new transfer of a client
+        @param fair - share the global limit through the scheduler, which blocks its thread.
+        Otherwise the transfer draws from the global bucket directly, as an event loop must
+        """
+        with self.lock:
+            self.transfer_buckets.add(bucket := token_bucket(self.transfer_rate))
+
+        if fair:
+            return flow([bucket, client_bucket], self.scheduler, priority)
+        return flow([bucket, client_bucket, self.total], priority=priority)
+
+    def limits(self) -> typing.Dict[str, float]:
+        with self.lock:
+            return {'transfer': self.transfer_rate, 'client': self.client_rate, 'total': self.total.rate}
+
+    def load(self, path: typing.Union[str, os.PathLike]) -> None:
+        """
+        applies the limits in a JSON file, e.g. {"transfer": "1M", "client": "4M", "total": "20M"}.
+        Limits missing from the file are left as they are
+        @raise ValueError - the file or a rate in it is malformed
+        """
+        with open(path) as fp:
+            limits = json.load(fp)
+
+        if not isinstance(limits, dict) or set(limits) - {'transfer', 'client', 'total'}:
+            raise ValueError(f'{path} should only hold the transfer, client and total limits')
+
+        self.configure(*(parse_rate(str(limits[name])) if name in limits else None
+                         for name in ('transfer', 'client', 'total')))
+
+    def watch(self, path: typing.Union[str, os.PathLike], interval: float = 1.0) -> None:
+        """applies the limits file whenever it changes, until close()"""
+        def poll() -> None:
+            mtime_ns = None
+            while True:
+                try:
+                    if (current := os.stat(path).st_mtime_ns) != mtime_ns:
+                        mtime_ns = current
+                        self.load(path)
+                        log.info('[INFO] Bandwidth limits: %s', self.limits())
+                except (OSError, ValueError) as error:
+                    log.error('[SERVER ERROR] could not apply %s: %s', path, error)
+                if self.closed.wait(interval):
+                    return
+
+        threading.Thread(target=poll, name='limits', daemon=True).start()
+
+    def close(self) -> None:
+        """stops watching the limits file"""
+        self.closed.set()
@@ -0,0 +1,163 @@
+"""
+Directory trees sent as one stream over the 'data' channel
+Every member is a small fixed header, its name and its contents, packed
+back to back into chunks, so thousands of small files cost a handful of
+sends. The receiver writes every file in place as its bytes arrive,
+nothing is staged on disk or in memory
+"""
+
+import os
+import stat
+import struct
+import typing
+
+CHUNK_SIZE = 64 * 1024
+
+# type, permission bits, length of the name, size and mtime of a member
+MEMBER = struct.Struct('!cHHQd')
+FILE = b'F'
+DIRECTORY = b'D'
+
+
+class chunk_reader:
+    """reads a stream of members across the chunks it arrives in"""
+
+    def __init__(self, chunks: typing.Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+
+    def at_end(self) -> bool:
+        """True once the last chunk was read"""
+        if not self.chunk:
+            self.chunk = memoryview(next(self.chunks, b''))
+        return not self.chunk
+
+    def pieces(self, size: int) -> typing.Iterator[memoryview]:
+        """
+        yields the next size bytes, one piece per chunk they span
+        @raise ValueError - the stream ended before size bytes
+        """
+        while size:
+            if self.at_end():
+                raise ValueError(f'the stream ended {size} bytes early')
+            piece, self.chunk = self.chunk[:size], self.chunk[size:]
+            size -= len(piece)
+            yield piece
+
+    def read(self, size: int) -> bytes:
+        return b''.join(self.pieces(size))
+
+
+def walk(path: str) -> typing.Iterator[os.DirEntry]:
+    """yields the directories and regular files under path, parents before children"""
+    with os.scandir(path) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_dir(follow_symlinks=False):
+                yield entry
+                yield from walk(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def header(kind: bytes, name: str, info: os.stat_result) -> bytes:
+    encoded = name.encode('utf-8')
+    size = info.st_size if kind == FILE else 0
+    return MEMBER.pack(kind, stat.S_IMODE(info.st_mode), len(encoded), size, info.st_mtime) + encoded
+
+
+def tree_chunks(path: typing.Union[str, os.PathLike],
+                counts: typing.Optional[typing.Dict[str, int]] = None) -> typing.Iterator[bytes]:
+    """
+    Yields a directory tree as a stream of members, in chunks of about CHUNK_SIZE bytes.
+    Members are named relative to the parent of path, so the tree keeps its name
+    @param counts - if given, receives the number of files and directories sent
+    @raise ValueError - a file shrank while it was sent
+    """
+    path = os.path.normpath(path)
+    root = os.path.basename(path)
+    counts = counts if counts is not None else {}
+    counts.update(files=0, directories=1)
+    buffer = bytearray(header(DIRECTORY, root, os.stat(path)))
+
+    for entry in walk(path):
+        name = f'{root}/{os.path.relpath(entry.path, path)}'
+
+        if entry.is_dir(follow_symlinks=False):
+            buffer += header(DIRECTORY, name, entry.stat(follow_symlinks=False))
+            counts['directories'] += 1
+        else:
+            with open(entry.path, "rb") as fp:
+                # the size in the header is the size when the file was opened
+                info = os.fstat(fp.fileno())
+                buffer += header(FILE, name, info)
+
+                remaining = info.st_size
+                while remaining:
+                    if not (piece := fp.read(min(remaining, CHUNK_SIZE))):
+                        raise ValueError(f'{name} shrank while it was sent')
+                    buffer += piece
+                    remaining -= len(piece)
+
+                    if len(buffer) >= CHUNK_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+            counts['files'] += 1
+
+        if len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+
+    if buffer:
+        yield bytes(buffer)
+
+
+def extract_chunks(chunks: typing.Iterable[bytes], destination: typing.Union[str, os.PathLike],
+                   root: str) -> typing.Dict[str, int]:
+    """
+    Writes a stream of members into destination as it arrives.
+    The first member has to be the directory root and every other member has
+    to sit in a directory received before it, so no name can leave the tree.
+    Links already in destination are never followed
+    @return - the number of files and directories written
+    @raise ValueError - the stream is corrupt or a member was refused
+    """
+    counts = {'files': 0, 'directories': 0}
+    reader = chunk_reader(chunks)
+    # the directories of the tree that were created or checked
+    directories: typing.Set[str] = set()
+
+    while not reader.at_end():
+        kind, mode, name_length, size, mtime = MEMBER.unpack(reader.read(MEMBER.size))
+        name = reader.read(name_length).decode('utf-8')
+        parent, _, base = name.rpartition('/')
+        # only the permission bits are kept, never setuid, setgid or sticky
+        mode &= 0o777
+
+        if (parent not in directories if parent else (name != root or kind != DIRECTORY)) \
+                or base in ('', '.', '..') or '\0' in name:
+            raise ValueError(f'{name} is outside of {root}')
+
+        path = os.path.join(destination, name)
+
+        if kind == DIRECTORY:
+            try:
+                os.mkdir(path, mode | stat.S_IRWXU)
+            except FileExistsError:
+                if not stat.S_ISDIR(os.lstat(path).st_mode):
+                    raise ValueError(f'{name} exists and is not a directory')
+            directories.add(name)
+            counts['directories'] += 1
+
+        elif kind == FILE:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, mode)
+            with open(fd, "wb") as fp:
+                for piece in reader.pieces(size):
+                    fp.write(piece)
+                fp.flush()
+                os.utime(fd, (mtime, mtime))
+            counts['files'] += 1
+
+        else:
+            raise ValueError(f'{name} has an unknown member type {kind!r}')
+
+    return counts
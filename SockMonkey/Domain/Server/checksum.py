@@ -0,0 +1,118 @@
+"""
+Checksums of transfers, negotiated per session
+The sender and the receiver both hash a body chunk by chunk as it streams,
+so checking a file costs no second pass over it. The sender's digest trails
+the body on 'data' as a size prefixed message and the receiver compares it
+with its own, an upload's verdict comes back over 'control'.
+A resumed transfer compares the part both sides already have block by block
+and only sends from the first block that differs.
+xxh64 and crc32c are used when the xxhash and crc32c packages are installed
+"""
+
+import hashlib
+import os
+import typing
+import zlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+
+class crc:
+    """a running CRC with the interface of hashlib"""
+
+    def __init__(self, function: typing.Callable[[bytes, int], int]):
+        self.function = function
+        self.value = 0
+
+    def update(self, data: typing.Union[bytes, bytearray, memoryview]) -> None:
+        self.value = self.function(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f'{self.value:08x}'
+
+
+# algorithm name -> factory of a running checksum, fastest first
+ALGORITHMS: typing.Dict[str, typing.Callable[[], typing.Any]] = {}
+if xxhash is not None:
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+if crc32c is not None:
+    ALGORITHMS['crc32c'] = lambda: crc(crc32c.crc32c)
+ALGORITHMS['crc32'] = lambda: crc(zlib.crc32)
+ALGORITHMS['blake2b'] = lambda: hashlib.blake2b(digest_size=32)
+ALGORITHMS['sha256'] = hashlib.sha256
+# the algorithm of a resumed transfer in a session that does not check its transfers
+RESUME_ALGORITHM = 'sha256'
+
+# the blocks a resumed transfer compares are at least BLOCK_SIZE bytes,
+# and there are never more than MAX_BLOCKS of them
+BLOCK_SIZE = 1 << 20
+MAX_BLOCKS = 4096
+# bytes read from a file at a time while hashing its blocks
+READ_SIZE = 1 << 16
+
+
+class mismatch(ValueError):
+    """a body does not match the checksum its sender computed"""
+
+    def __init__(self, name: str, expected: str, computed: str):
+        super().__init__(f'{name} does not match its checksum, expected {expected} and computed {computed}')
+        self.expected = expected
+        self.computed = computed
+
+
+def first_supported(offered: typing.List[str]) -> str:
+    """picks the first offered algorithm this side supports"""
+    return next((name for name in offered if name in ALGORITHMS), 'none')
+
+
+def new(name: typing.Optional[str]) -> typing.Optional[typing.Any]:
+    """a running checksum of the algorithm, None when transfers are not checked"""
+    return ALGORITHMS[name]() if name and name != 'none' else None
+
+
+def block_size(size: int) -> int:
+    """the size of the blocks the first size bytes of a file are compared in"""
+    return max(BLOCK_SIZE, -(-size // MAX_BLOCKS))
+
+
+def block_digests(path: typing.Union[str, os.PathLike], size: int, name: str) -> typing.Iterator[str]:
+    """
+    the digest of every block of the first size bytes of path, one at a time.
+    A file shorter than size ends with the digest of its short last block
+    """
+    if size <= 0:
+        return
+
+    step = block_size(size)
+    with open(path, "rb") as fp:
+        for start in range(0, size, step):
+            digest = ALGORITHMS[name]()
+            remaining = min(step, size - start)
+            while remaining and (chunk := fp.read(min(remaining, READ_SIZE))):
+                digest.update(chunk)
+                remaining -= len(chunk)
+            yield digest.hexdigest()
+            if remaining:
+                return
+
+
+def matching_prefix(path: typing.Union[str, os.PathLike], size: int, name: str, digests: typing.Iterable[str]) -> int:
+    """
+    compares the blocks of the first size bytes of path with the other side's digests
+    @return - the num of bytes up to the first block that differs, size when none does
+    """
+    step = block_size(size)
+    matched = 0
+    for ours, theirs in zip(block_digests(path, size, name), digests):
+        if ours != theirs:
+            break
+        matched = min(matched + step, size)
+    return matched
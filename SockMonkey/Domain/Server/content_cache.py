@@ -0,0 +1,110 @@
+"""
+In-memory cache of the small files clients fetch again and again
+A cached file is kept framed, its size header followed by its bytes, so it is
+sent with a single sendall instead of an open, a read of the header and a
+sendfile. The least recently sent files are dropped once the cache holds more
+than its size in bytes, and a file is read again when its inode, size or
+modification time changes or when it is uploaded
+"""
+
+import collections
+import errno
+import os
+import pathlib
+import threading
+import typing
+
+from SockMonkey.Domain.Server import listing, metrics
+from SockMonkey.Domain.Server.helpers import pad_str
+
+
+class content_cache:
+    def __init__(self, directory: pathlib.Path, max_bytes: int = 64 << 20, max_file_size: int = 256 << 10):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # larger files are sent from the page cache with sendfile
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.lock = threading.Lock()
+
+        # file name -> ((inode, size, mtime_ns), framed body), least recently sent first
+        self.entries: 'collections.OrderedDict[str, typing.Tuple[typing.Tuple[int, int, int], bytes]]' = \
+            collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # bytes sent from memory instead of being read from the disk
+        self.bytes_saved = 0
+
+    def lookup(self, name: str) -> typing.Optional[bytes]:
+        """
+        returns the framed body of a served file, reading it into the cache if it changed
+        @return - None when the file is too large to cache, it should be sent from the disk
+        @raise OSError - the file could not be read or is outside of the directory
+        """
+        if not self.max_bytes:
+            return None
+
+        if (path := listing.served_path(self.directory, name)) is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        with self.lock:
+            if (cached := self.entries.get(name)) is not None and cached[0] == key:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                self.bytes_saved += stat.st_size
+            else:
+                cached = None
+                self.misses += 1
+
+        if cached is not None:
+            metrics.default.count('ftp_content_cache_hits_total')
+            metrics.default.count('ftp_content_cache_bytes_saved_total', stat.st_size)
+            return cached[1]
+        metrics.default.count('ftp_content_cache_misses_total')
+
+        if stat.st_size > self.max_file_size:
+            self.invalidate(name)
+            return None
+
+        with open(path, "rb") as fp:
+            stat = os.fstat(fp.fileno())
+            body = fp.read(self.max_file_size + 1)
+
+        # the file changed while it was read, it is sent from the disk this time
+        if len(body) != stat.st_size:
+            self.invalidate(name)
+            return None
+
+        framed = pad_str(str(len(body))).encode('ascii') + body
+        self.store(name, (stat.st_ino, stat.st_size, stat.st_mtime_ns), framed)
+        return framed
+
+    def store(self, name: str, key: typing.Tuple[int, int, int], framed: bytes) -> None:
+        """adds a framed body, dropping the least recently sent ones until it fits"""
+        with self.lock:
+            if (old := self.entries.pop(name, None)) is not None:
+                self.size -= len(old[1])
+
+            self.entries[name] = (key, framed)
+            self.size += len(framed)
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, name: str) -> None:
+        """forgets a file, e.g. one that was just uploaded"""
+        with self.lock:
+            if (old := self.entries.pop(name, None)) is not None:
+                self.size -= len(old[1])
+
+    def counters(self) -> typing.Dict[str, typing.Any]:
+        """how many files were sent from memory and how many bytes that kept off the disk"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits,
+                    'misses': self.misses, 'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                    'bytes_saved': self.bytes_saved}
@@ -0,0 +1,208 @@
+"""
+Block level delta transfer, in the style of rsync
+The receiver describes its copy of a file with one signature per block: a weak
+rolling checksum and a strong hash. The sender slides a window over its file,
+references every block the receiver already has and sends only the bytes in between
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import typing
+import zlib
+
+# adler32 works modulo the largest prime below 2 ** 16
+MODULUS = 65521
+# a signature is the weak checksum followed by a 16 byte strong hash
+SIGNATURE = struct.Struct('!I16s')
+# copy count blocks starting at block index
+COPY = struct.Struct('!cQI')
+# literal bytes follow the header
+LITERAL = struct.Struct('!cI')
+# ops are grouped into chunks of about this size on the wire
+CHUNK_SIZE = 64 * 1024
+
+# weak checksum -> strong hash -> block index
+signature_table = typing.Dict[int, typing.Dict[bytes, int]]
+
+
+def block_size_for(size: int) -> int:
+    """picks a block size around the square root of the file size, like rsync"""
+    return min(max(1 << math.isqrt(size).bit_length(), 2048), 1 << 17)
+
+
+def strong_hash(block: typing.Union[bytes, memoryview]) -> bytes:
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def open_map(path: typing.Union[str, os.PathLike]) -> typing.Optional[mmap.mmap]:
+    """maps a file read only, None for a missing or empty file"""
+    try:
+        with open(path, "rb") as fp:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def signature(path: typing.Union[str, os.PathLike], block_size: int) -> typing.Iterator[bytes]:
+    """
+    Yields the signatures of every full block of a file, packed into chunks.
+    A missing file has no blocks
+    """
+    if (view := open_map(path)) is None:
+        return
+
+    with view:
+        per_chunk = CHUNK_SIZE // SIGNATURE.size
+        chunk = bytearray()
+
+        for offset in range(0, len(view) - block_size + 1, block_size):
+            block = view[offset:offset + block_size]
+            chunk += SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+
+            if len(chunk) >= per_chunk * SIGNATURE.size:
+                yield bytes(chunk)
+                chunk.clear()
+
+        if chunk:
+            yield bytes(chunk)
+
+
+def load_signature(chunks: typing.Iterable[bytes]) -> signature_table:
+    """
+    builds the lookup table of the blocks the receiver has
+    @raise ValueError - a signature was cut short
+    """
+    table: signature_table = {}
+    index = 0
+
+    for chunk in chunks:
+        if len(chunk) % SIGNATURE.size:
+            raise ValueError(f'received a chunk of {len(chunk)} bytes, signatures are {SIGNATURE.size} bytes each')
+        for weak, strong in SIGNATURE.iter_unpack(chunk):
+            table.setdefault(weak, {}).setdefault(strong, index)
+            index += 1
+
+    return table
+
+
+def delta(path: typing.Union[str, os.PathLike], table: signature_table,
+          block_size: int) -> typing.Iterator[bytes]:
+    """
+    Yields the ops that rebuild a file from the receiver's blocks, packed into chunks.
+    Matched blocks become references, everything else is sent literally
+    """
+    if (view := open_map(path)) is None:
+        return
+
+    with view:
+        size = len(view)
+        chunk = bytearray()
+        # the run of matched blocks not written yet
+        run_start, run_length = 0, 0
+
+        def flush_run() -> None:
+            nonlocal run_length
+            if run_length:
+                chunk.extend(COPY.pack(b'C', run_start, run_length))
+                run_length = 0
+
+        def literal(start: int, end: int) -> None:
+            if start == end:
+                return
+            flush_run()
+            for offset in range(start, end, CHUNK_SIZE):
+                data = view[offset:min(offset + CHUNK_SIZE, end)]
+                chunk.extend(LITERAL.pack(b'D', len(data)))
+                chunk.extend(data)
+
+        position = literal_start = 0
+        weak = None
+
+        while position + block_size <= size:
+            if weak is None:
+                weak = zlib.adler32(view[position:position + block_size])
+                a, b = weak & 0xffff, weak >> 16
+
+            if (candidates := table.get(weak)) is not None and (
+                    index := candidates.get(strong_hash(view[position:position + block_size]))) is not None:
+                literal(literal_start, position)
+
+                # consecutive blocks are sent as one reference
+                if run_length and run_start + run_length == index:
+                    run_length += 1
+                else:
+                    flush_run()
+                    run_start, run_length = index, 1
+
+                position += block_size
+                literal_start = position
+                weak = None
+            else:
+                # roll the window one byte forward
+                if position + block_size < size:
+                    outgoing, incoming = view[position], view[position + block_size]
+                    a = (a - outgoing + incoming) % MODULUS
+                    b = (b - block_size * outgoing + a - 1) % MODULUS
+                    weak = (b << 16) | a
+                position += 1
+
+                if position - literal_start >= CHUNK_SIZE:
+                    literal(literal_start, position)
+                    literal_start = position
+
+            if len(chunk) >= CHUNK_SIZE:
+                yield bytes(chunk)
+                chunk.clear()
+
+        literal(literal_start, size)
+        flush_run()
+
+        if chunk:
+            yield bytes(chunk)
+
+
+def patch(basis: typing.Optional[typing.BinaryIO], chunks: typing.Iterable[bytes],
+          block_size: int, fp: typing.BinaryIO) -> typing.Tuple[int, int]:
+    """
+    Rebuilds the sender's file into fp from the receiver's copy and the ops
+    @return - the num of bytes copied from the basis and the num of literal bytes
+    @raise ValueError - an op is malformed or cut short
+    """
+    copied = literal = 0
+
+    for chunk in chunks:
+        view = memoryview(chunk)
+        position = 0
+
+        while position < len(view):
+            op = bytes(view[position:position + 1])
+            if op not in (b'C', b'D'):
+                raise ValueError(f'received an unknown delta op {op!r}')
+            if position + (COPY.size if op == b'C' else LITERAL.size) > len(view):
+                raise ValueError(f'a delta op was cut short after {len(view) - position} bytes')
+
+            if op == b'C':
+                _, index, count = COPY.unpack_from(view, position)
+                position += COPY.size
+
+                if basis is None:
+                    raise ValueError('a block was referenced but there is no local copy')
+                basis.seek(index * block_size)
+                remaining = count * block_size
+                while remaining and (data := basis.read(min(remaining, CHUNK_SIZE))):
+                    fp.write(data)
+                    remaining -= len(data)
+                    copied += len(data)
+            else:
+                _, length = LITERAL.unpack_from(view, position)
+                position += LITERAL.size
+                if position + length > len(view):
+                    raise ValueError(f'a literal of {length} bytes was cut short after {len(view) - position}')
+                fp.write(view[position:position + length])
+                position += length
+                literal += length
+
+    return copied, literal
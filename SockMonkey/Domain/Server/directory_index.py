@@ -0,0 +1,190 @@
+"""
+In-memory index of the served directory
+It is built once when the server starts, updated by the server after every
+write and kept in step with changes made behind its back by polling the
+directory's modification time, so ls and the existence checks never scan
+the disk
+"""
+
+import fnmatch
+import logging
+import os
+import pathlib
+import threading
+import typing
+
+from SockMonkey.Domain.Server import listing
+from SockMonkey.Domain.Server.receiver import is_temporary
+
+log = logging.getLogger(__name__)
+
+
+class directory_index:
+    def __init__(self, directory: pathlib.Path, max_entries: int = 100_000,
+                 interval: float = 1.0):
+        self.directory = directory
+        # a directory with more entries than this is not indexed,
+        # every question then goes to the filesystem
+        self.max_entries = max_entries
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+        # answers from the index and from the filesystem
+        self.hits = 0
+        self.misses = 0
+
+        # file name -> listing entry, None while the directory is too big
+        self.entries: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None
+        # file name -> inode of the indexed entry, a name that is renamed over gets a new one
+        self.inodes: typing.Dict[str, int] = {}
+        self.mtime_ns = -1
+        self.rescan()
+
+        self.watcher = threading.Thread(target=self.watch, name='index', daemon=True)
+        self.watcher.start()
+
+    def rescan(self) -> None:
+        """
+        brings the index in step with the directory. A name that is still
+        the same file keeps its entry, only new or replaced files are read,
+        so after a write the directory costs one listing instead of a stat per file
+        """
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        with self.lock:
+            known = dict(self.entries or {})
+            known_inodes = dict(self.inodes)
+
+        entries: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = {}
+        inodes: typing.Dict[str, int] = {}
+        with os.scandir(self.directory) as scanned:
+            for dir_entry in scanned:
+                if is_temporary(dir_entry.name):
+                    continue
+                if len(entries) == self.max_entries:
+                    log.info('[INFO] %s has more than %s entries, it is not indexed', self.directory, self.max_entries)
+                    entries, inodes = None, {}
+                    break
+
+                name, inode = dir_entry.name, dir_entry.inode()
+                if (entry := known.get(name)) is None or known_inodes.get(name) != inode:
+                    try:
+                        entry = listing.describe(dir_entry)
+                    except FileNotFoundError:
+                        # deleted while we were listing
+                        continue
+                entries[name] = entry
+                inodes[name] = inode
+
+        with self.lock:
+            # entries the server updated while the directory was listed are newer
+            for name, entry in (self.entries or {}).items():
+                if entries is not None and name in entries and entry is not known.get(name):
+                    entries[name], inodes[name] = entry, self.inodes.get(name, inodes[name])
+            self.entries = entries
+            self.inodes = inodes
+            self.mtime_ns = mtime_ns
+
+    def refresh(self) -> None:
+        """rescans the directory if an entry was added, removed or renamed since the last scan"""
+        try:
+            if os.stat(self.directory).st_mtime_ns != self.mtime_ns:
+                self.rescan()
+        except OSError as error:
+            log.error('[SERVER ERROR] could not index %s: %s', self.directory, error)
+
+    def watch(self) -> None:
+        """keeps the index in step with changes made to the directory by others"""
+        while not self.closed.wait(self.interval):
+            self.refresh()
+
+    def close(self) -> None:
+        """stops watching the directory"""
+        self.closed.set()
+
+    def stat(self, name: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """reads the listing entry of a name from the filesystem, None if it does not exist"""
+        return self.read(name)[0]
+
+    def read(self, name: str) -> typing.Tuple[typing.Optional[typing.Dict[str, typing.Any]], int]:
+        """the listing entry and the inode of a name, None and -1 if it does not exist"""
+        # an upload in progress does not exist until it is renamed,
+        # nor does anything outside of the served directory
+        if is_temporary(name) or (path := listing.served_path(self.directory, name)) is None:
+            return None, -1
+
+        try:
+            info = os.stat(path, follow_symlinks=False)
+        except (OSError, ValueError):
+            return None, -1
+
+        return {'name': name, 'size': info.st_size, 'mtime': info.st_mtime,
+                'type': listing.entry_type(info.st_mode)}, info.st_ino
+
+    def update(self, name: str) -> None:
+        """records the current state of one entry after the server wrote it"""
+        # names with a directory part are not in the index
+        if os.path.basename(name) != name:
+            return
+
+        entry, inode = self.read(name)
+
+        with self.lock:
+            if self.entries is None:
+                return
+            if entry is None:
+                self.entries.pop(name, None)
+                self.inodes.pop(name, None)
+            elif name in self.entries or len(self.entries) < self.max_entries:
+                self.entries[name] = entry
+                self.inodes[name] = inode
+
+    def lookup(self, name: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """returns the listing entry of a name in the served directory, None if it does not exist"""
+        with self.lock:
+            # a name the index does not know may have been created since the last poll
+            if self.entries is not None and name in self.entries:
+                self.hits += 1
+                return self.entries[name]
+            self.misses += 1
+
+        if (entry := self.stat(name)) is not None:
+            self.update(name)
+        return entry
+
+    def is_file(self, name: str) -> bool:
+        """True when name is a regular file in the served directory"""
+        if (entry := self.lookup(name)) is not None and entry['type'] == 'link':
+            # links are served when they point at a file
+            return (self.directory / name).is_file()
+        return entry is not None and entry['type'] == 'file'
+
+    def scan(self, pattern: str = '*') -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        """yields the entries whose name matches pattern"""
+        # one stat instead of a scan unless the directory changed
+        self.refresh()
+
+        with self.lock:
+            if self.entries is not None:
+                self.hits += 1
+                matches = [entry for name, entry in self.entries.items()
+                           if fnmatch.fnmatchcase(name, pattern)]
+            else:
+                self.misses += 1
+                matches = None
+
+        if matches is None:
+            yield from listing.scan(self.directory, pattern)
+        else:
+            yield from matches
+
+    def files(self) -> typing.List[str]:
+        """the names of the regular files in the served directory"""
+        return [entry['name'] for entry in self.scan()
+                if entry['type'] == 'file'
+                or entry['type'] == 'link' and (self.directory / entry['name']).is_file()]
+
+    def counters(self) -> typing.Dict[str, int]:
+        """how many questions the index answered and how many went to the filesystem"""
+        with self.lock:
+            return {'entries': len(self.entries or ()), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,810 @@
+"""
+Single threaded engine of the ftp server, built on selectors
+Every socket is non-blocking and one loop waits on all of them at once, so a
+client that stalls in the middle of a transfer only holds up itself. Each
+connection is a small state machine: received bytes are kept until a whole
+command arrived, and sends that would block are resumed once the socket is
+writable again. Sessions idle for too long and transfers that stopped moving
+are closed. Allocating a large upload and committing one with fsync, the disk
+calls that may block for long, run on a few disk threads and wake the loop up
+once done. With SO_REUSEPORT one process per core listens on the same port.
+The engine serves get, put, ls, persist, negotiate, noop and quit, other
+commands are refused so clients fall back or report the error
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import multiprocessing
+import os
+import pathlib
+import selectors
+import socket
+import time
+import typing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from SockMonkey.Domain.Server import listing, metrics
+from SockMonkey.Domain.Server.helpers import (CHUNK_SIZE, FRAME, HEADER_SIZE, MAX_MESSAGE, MESSAGE,
+                                              VERSION, control_channel, no_delay, pad_str,
+                                              unpack_fields)
+from SockMonkey.Domain.Server.receiver import write_behind
+from SockMonkey.Domain.Server.server import COMMANDS, ftp_server
+from SockMonkey.Domain.Server.session import ftp_session
+
+log = logging.getLogger(__name__)
+
+# the most bytes one connection moves before the others get their turn
+BUDGET = 1 << 20
+# seconds between checks for idle sessions and stalled transfers
+SWEEP_INTERVAL = 1.0
+# threads that allocate large uploads and fsync them, so the loop does not wait for the disk
+DISK_WORKERS = 4
+# arguments of every command, LIST for a count followed by as many items
+LIST = -1
+ARGUMENTS = {1: 1, 2: 1, 3: 0, 4: 0, 5: 0, 6: LIST, 7: LIST, 8: 2, 9: 2, 10: 1, 11: 0,
+             12: 1, 13: 1, 14: 2, 15: 2, 16: 1, 17: 1, 18: 0, 19: 0, 20: 1, 21: 1, 22: 1}
+
+
+class file_range:
+    """bytes of an open file still to be sent with sendfile"""
+
+    def __init__(self, fp: typing.BinaryIO, offset: int, size: int):
+        self.fp = fp
+        self.offset = offset
+        self.remaining = size
+
+
+class outgoing:
+    """
+    What is waiting to be sent on a non-blocking socket, in order: bytes,
+    ranges of open files and bodies of chunks produced on demand.
+    It takes writes like a socket, so a control_channel can reply into it
+    """
+
+    def __init__(self):
+        self.queue: typing.Deque[typing.Union[memoryview, file_range, typing.Iterator[bytes]]] = collections.deque()
+
+    def __bool__(self) -> bool:
+        return bool(self.queue)
+
+    def sendall(self, data: typing.Union[bytes, bytearray, memoryview]) -> None:
+        if data:
+            self.queue.append(memoryview(data))
+
+    def send_file(self, fp: typing.BinaryIO, size: int, offset: int = 0) -> None:
+        """queues size bytes of fp, the file is closed once they are sent"""
+        self.queue.append(file_range(fp, offset, size))
+
+    def send_chunks(self, chunks: typing.Iterable[bytes]) -> None:
+        """queues a body of unknown size, each chunk is produced when the socket can take it"""
+        self.queue.append(iter(chunks))
+
+    def flush(self, sock: socket.socket, budget: int = BUDGET) -> int:
+        """
+        sends as much as the socket takes, up to budget bytes
+        @return - the num of bytes sent
+        @raise OSError - the connection broke
+        @raise EOFError - a file ended before its range was sent
+        """
+        bytes_sent = 0
+
+        while self.queue and bytes_sent < budget:
+            item = self.queue[0]
+
+            try:
+                if isinstance(item, memoryview):
+                    n = sock.send(item)
+                    if n < len(item):
+                        self.queue[0] = item[n:]
+                    else:
+                        self.queue.popleft()
+
+                elif isinstance(item, file_range):
+                    if not item.remaining:
+                        item.fp.close()
+                        self.queue.popleft()
+                        continue
+                    if not (n := os.sendfile(sock.fileno(), item.fp.fileno(), item.offset,
+                                             min(item.remaining, budget - bytes_sent))):
+                        raise EOFError(f'{item.fp.name} ended {item.remaining} bytes early')
+                    item.offset += n
+                    item.remaining -= n
+
+                else:
+                    # the next chunk goes in front of the body, an empty one ends it
+                    if (chunk := next(item, None)) is None:
+                        self.queue[0] = memoryview(pad_str('0').encode('ascii'))
+                    elif chunk:
+                        self.queue.appendleft(memoryview(chunk))
+                        self.queue.appendleft(memoryview(pad_str(str(len(chunk))).encode('ascii')))
+                    continue
+            except BlockingIOError:
+                break
+
+            bytes_sent += n
+
+        return bytes_sent
+
+    def close(self) -> None:
+        """drops what was not sent, closing its files"""
+        for item in self.queue:
+            if isinstance(item, file_range):
+                item.fp.close()
+        self.queue.clear()
+
+
+class transfer:
+    """
+    One get, ls, put or persist on the 'data' channel.
+    A get or ls sends a queue of bytes and file ranges, a put fills a temporary
+    file until its announced size arrived, both resumed whenever the socket is ready
+    """
+
+    def __init__(self, name: str, body: typing.Optional[outgoing] = None,
+                 path: typing.Optional[pathlib.Path] = None, fsync: bool = False):
+        self.name = name
+        self.body = body
+        self.path = path
+        self.fsync = fsync
+        self.header = bytearray()
+        self.target: typing.Optional[write_behind] = None
+        # blocking disk work the transfer waits for before it goes on, and the
+        # work once it runs on a disk thread, the socket is not read meanwhile
+        self.waiting: typing.Optional[typing.Callable[[], None]] = None
+        self.pending: typing.Optional[concurrent.futures.Future] = None
+        # the 'data' connection, once the client connected it
+        self.socket: typing.Optional[socket.socket] = None
+        self.size = 0
+        self.received = 0
+        # when the transfer last moved a byte, it is closed after stalling too long
+        self.last_active = time.monotonic()
+
+    @property
+    def events(self) -> int:
+        return selectors.EVENT_READ if self.path is not None else selectors.EVENT_WRITE
+
+    def resume(self, sock: socket.socket, meter: typing.Optional[metrics.measurement] = None) -> bool:
+        """
+        moves what the socket takes or has
+        @return - True once the transfer is complete
+        @raise OSError - the connection broke or the file could not be written
+        @raise ValueError - the size header is malformed
+        """
+        self.last_active = time.monotonic()
+
+        if self.path is None:
+            if (bytes_sent := self.body.flush(sock)) and meter is not None:
+                meter.moved('send', sent=bytes_sent)
+            return not self.body
+
+        return self.receive(sock, meter)
+
+    def receive(self, sock: socket.socket, meter: typing.Optional[metrics.measurement] = None) -> bool:
+        """
+        receives the size of the body and then the body, into a temporary file renamed once complete.
+        Allocating a large file and committing with fsync are left in waiting for a disk thread
+        """
+        if self.target is None:
+            if not (chunk := sock.recv(HEADER_SIZE - len(self.header))):
+                raise ConnectionError(f'{sock} closed before the size of {self.name} arrived')
+            self.header += chunk
+            if len(self.header) < HEADER_SIZE:
+                return False
+            if not self.header.isdigit():
+                raise ValueError(f'received a malformed size header {bytes(self.header)!r}')
+
+            self.size = int(self.header)
+            # the loop does not wait for a writer thread, writes go to the page cache.
+            # It allocates no more than the chunks it writes itself, a larger file on a disk thread
+            small = self.size <= CHUNK_SIZE
+            self.target = write_behind(self.path, self.size if small else 0, self.fsync, threaded=False)
+            if not small:
+                self.waiting = functools.partial(self.target.preallocate, self.size)
+                return False
+
+        budget = BUDGET
+        while self.received < self.size and budget > 0:
+            buffer = self.target.buffer()
+            try:
+                n = sock.recv_into(buffer, min(len(buffer), self.size - self.received))
+            except BlockingIOError:
+                # hands the buffer back
+                self.target.write(buffer, 0)
+                return False
+            if not n:
+                raise ConnectionError(f'{sock} closed after {self.received} of {self.size} bytes')
+
+            self.target.write(buffer, n)
+            self.received += n
+            budget -= n
+            if meter is not None:
+                meter.moved('recv_into', received=n)
+
+        if self.received < self.size:
+            return False
+
+        if self.fsync:
+            self.waiting = self.target.commit
+            return False
+        self.target.commit()
+        return True
+
+    def close(self) -> None:
+        """throws away what did not complete, once the disk thread is done with it"""
+        if self.pending is not None:
+            self.pending.add_done_callback(lambda _: self.discard())
+        else:
+            self.discard()
+        if self.body is not None:
+            self.body.close()
+
+    def discard(self) -> None:
+        if self.target is not None and not self.target.committed:
+            self.target.abort()
+
+
+class event_session(ftp_session):
+    """
+    A session as a state machine: the commands it received, the replies
+    waiting to be sent and the transfer it runs, at most one at a time
+    """
+
+    def __init__(self, control: socket.socket, address: typing.Tuple[str, int]):
+        super().__init__(control, address)
+        self.replies = outgoing()
+        self.channel = control_channel(self.replies)
+        self.received = bytearray()
+        self.fields: typing.Deque[str] = collections.deque()
+        # the client's pick of a protocol version is the next field
+        self.negotiating = False
+        self.transfer: typing.Optional[transfer] = None
+        # the socket the client connects its 'data' channel to
+        self.listener: typing.Optional[socket.socket] = None
+        self.started = 0.0
+        # the client hung up, the session closes once its transfer completes
+        self.closing = False
+        self.last_active = time.monotonic()
+        # what the loop waits for on 'control'
+        self.events = selectors.EVENT_READ
+
+    def parse(self, count: int) -> bool:
+        """
+        moves whole messages or frames from the received bytes to the fields until there are count
+        @return - False while the rest did not arrive yet
+        @raise ValueError - a message is malformed or too large
+        """
+        while len(self.fields) < count:
+            if self.channel.version == 1:
+                if len(self.received) < HEADER_SIZE:
+                    return False
+                if not (header := bytes(self.received[:HEADER_SIZE])).isdigit():
+                    raise ValueError(f'received a malformed size header {header!r}')
+                start, end = HEADER_SIZE, HEADER_SIZE + int(header)
+            else:
+                if len(self.received) < FRAME.size:
+                    return False
+                opcode, _, request_id, size = FRAME.unpack_from(self.received)
+                start, end = FRAME.size, FRAME.size + size
+
+            if end > MAX_MESSAGE:
+                raise ValueError(f'received a message of {end} bytes, at most {MAX_MESSAGE} are accepted')
+            if len(self.received) < end:
+                return False
+
+            payload = bytes(self.received[start:end])
+            del self.received[:end]
+
+            if self.channel.version == 1:
+                self.fields.append(payload.decode('utf-8'))
+                continue
+
+            if opcode != MESSAGE:
+                # replies carry the id of their request
+                self.channel.request_id = request_id
+                self.fields.append(str(opcode))
+            self.fields.extend(unpack_fields(payload))
+
+        return True
+
+    def command(self) -> typing.Optional[typing.List[str]]:
+        """
+        the next command code and its arguments, once all of them arrived
+        @raise ValueError - the command code is malformed
+        """
+        if self.channel.version > 1:
+            # a command and its arguments are one frame
+            if not self.parse(1):
+                return None
+            command = list(self.fields)
+            self.fields.clear()
+            return command
+
+        if not self.parse(1):
+            return None
+        count = 1 + ARGUMENTS.get(int(self.fields[0]), 0)
+
+        if ARGUMENTS.get(int(self.fields[0])) == LIST:
+            if not self.parse(2):
+                return None
+            count = 2 + int(self.fields[1])
+
+        if not self.parse(count):
+            return None
+        return [self.fields.popleft() for _ in range(count)]
+
+
+class event_server(ftp_server):
+    """
+    The ftp server on one selectors loop, see the module docstring.
+    Takes the options of ftp_server, bandwidth limits and checksums are not
+    applied by this engine
+    """
+
+    def __init__(self, server_port: int = 1233, idle_timeout: float = 300.0, stall_timeout: float = 30.0,
+                 max_connections: int = 10_000, backlog: int = 1024, **options: typing.Any):
+        if not(isinstance(idle_timeout, (int, float)) and idle_timeout > 0
+               and isinstance(stall_timeout, (int, float)) and stall_timeout > 0):
+            raise ValueError(
+                f'mismatched constructor: event_server(idle_timeout={idle_timeout}, stall_timeout={stall_timeout})')
+        super().__init__(server_port, max_connections=max_connections, backlog=backlog, **options)
+        # an idle session is closed after idle_timeout seconds without a command,
+        # a transfer after stall_timeout seconds without moving a byte
+        self.idle_timeout = idle_timeout
+        self.stall_timeout = stall_timeout
+        self.selector = selectors.DefaultSelector()
+        self.connections: typing.Dict[socket.socket, event_session] = {}
+        self.accepting = False
+        # wakes the loop up from another thread, for shutdown() and finished disk work
+        self.waker, self.wake_up = socket.socketpair()
+        self.disk = concurrent.futures.ThreadPoolExecutor(max_workers=DISK_WORKERS, thread_name_prefix='disk')
+        # the disk work that finished, with the session and transfer it belongs to
+        self.done: typing.Deque[typing.Tuple[event_session, transfer, concurrent.futures.Future]] = \
+            collections.deque()
+
+        self.handlers: typing.Dict[int, typing.Callable[..., None]] = {
+            1: self.serve_get, 2: self.serve_put, 3: self.serve_ls, 4: self.serve_quit,
+            5: self.serve_persist, 18: self.serve_negotiate, 19: self.serve_noop, 22: self.serve_ls}
+
+    def serve(self) -> None:
+        """serves clients until shutdown() or Ctrl-C"""
+        raise_file_limit()
+        self.welcome_sock.listen(self.backlog)
+        self.welcome_sock.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, self.wake)
+        self.resume_accepting()
+
+        try:
+            while not self.stopping.is_set():
+                for key, events in self.selector.select(SWEEP_INTERVAL):
+                    key.data(key.fileobj, events)
+                self.sweep()
+        except KeyboardInterrupt:
+            log.info('[INFO] Attempting to exit gracefully....')
+        finally:
+            self.close()
+
+    def shutdown(self) -> None:
+        """stops the loop, from any thread"""
+        self.stopping.set()
+        try:
+            self.wake_up.send(b'\0')
+        except OSError:
+            pass
+
+    def wake(self, sock: socket.socket, events: int) -> None:
+        sock.recv(4096)
+        while self.done:
+            self.resume_transfer(*self.done.popleft())
+
+    def close(self) -> None:
+        """disconnects everyone and releases the sockets"""
+        for session in list(self.connections.values()):
+            self.close_session(session)
+        self.stopping.set()
+        # the uploads still being committed are finished or thrown away
+        self.disk.shutdown()
+        self.index.close()
+        self.throttle.close()
+        self.selector.close()
+        self.welcome_sock.close()
+        self.waker.close()
+        self.wake_up.close()
+
+    def resume_accepting(self) -> None:
+        if not self.accepting and len(self.connections) < self.max_connections:
+            self.selector.register(self.welcome_sock, selectors.EVENT_READ, self.accept)
+            self.accepting = True
+
+    def accept(self, sock: socket.socket, events: int) -> None:
+        """accepts the clients waiting in the backlog, until max_connections are connected"""
+        while len(self.connections) < self.max_connections:
+            try:
+                control_sock, addr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                # e.g. out of file descriptors, accepting resumes once a session closes
+                log.error('[SERVER ERROR] %s', error)
+                break
+
+            control_sock.setblocking(False)
+            session = event_session(no_delay(control_sock), addr)
+            self.connections[control_sock] = session
+            self.selector.register(control_sock, selectors.EVENT_READ, functools.partial(self.on_control, session))
+            log.info('Accepted connection from client %s', addr)
+
+        # the others wait in the backlog until a session closes
+        self.forget(sock)
+        self.accepting = False
+
+    def on_control(self, session: event_session, sock: socket.socket, events: int) -> None:
+        """reads the commands of a session and sends its replies"""
+        try:
+            if events & selectors.EVENT_READ:
+                try:
+                    data = sock.recv(CHUNK_SIZE)
+                except BlockingIOError:
+                    data = None
+
+                if data == b'':
+                    self.hang_up(session)
+                    return
+                if data:
+                    session.received += data
+                    session.last_active = time.monotonic()
+                    if len(session.received) > MAX_MESSAGE:
+                        raise ValueError(f'{len(session.received)} bytes arrived without being a command')
+                    self.advance(session)
+
+            self.flush(session)
+        except (OSError, ValueError, EOFError) as error:
+            log.error('[SERVER ERROR] %s %s', session, error)
+            self.close_session(session)
+
+    def flush(self, session: event_session) -> None:
+        """sends the replies the socket takes and waits for it to be writable for the rest"""
+        if session.closing or session.control.fileno() < 0:
+            return
+        session.replies.flush(session.control)
+
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if session.replies else 0)
+        if events != session.events:
+            self.selector.modify(session.control, events, functools.partial(self.on_control, session))
+            session.events = events
+
+    def forget(self, sock: socket.socket) -> None:
+        """stops waiting on a socket, before it is closed"""
+        with contextlib.suppress(KeyError, ValueError):
+            self.selector.unregister(sock)
+
+    def hang_up(self, session: event_session) -> None:
+        """the client closed 'control', an upload it already sent still completes"""
+        log.info('[INFO] %s hung up', session)
+        if session.transfer is None:
+            self.close_session(session)
+            return
+
+        session.closing = True
+        self.forget(session.control)
+
+    def advance(self, session: event_session) -> None:
+        """runs the commands that arrived in full, one at a time, until one starts a transfer"""
+        while session.transfer is None and not session.closing and session.control.fileno() >= 0:
+            if session.negotiating:
+                if not session.parse(1):
+                    return
+                if not 1 <= (version := int(session.fields.popleft())) <= VERSION:
+                    raise ValueError(f'the client picked version {version}, expected 1 to {VERSION}')
+                session.channel.version = version
+                session.negotiating = False
+                log.info('[SERVER] %s speaks version %s of the protocol', session, version)
+                continue
+
+            if (command := session.command()) is None:
+                return
+            self.run(session, int(command[0]), command[1:])
+
+    def run(self, session: event_session, code: int, arguments: typing.List[str]) -> None:
+        """starts a command, the ones without a transfer are finished right away"""
+        log.debug('received command code %s from %s', code, session)
+        session.commands += 1
+        session.measurement = metrics.measurement(COMMANDS.get(code, 'unknown'))
+        session.channel.status = None
+
+        if code not in ARGUMENTS:
+            session.channel.send_reply('ERR', 'Unknown command. Type \'help\' for the command list')
+        elif (handler := self.handlers.get(code)) is None:
+            session.channel.send_reply('ERR', f'{COMMANDS[code]} is not served by this server')
+        else:
+            handler(session, *arguments)
+
+        if session.transfer is None:
+            self.finish(session, 'refused' if session.channel.status == 'ERR' else 'ok')
+
+    def finish(self, session: event_session, outcome: str) -> None:
+        if session.measurement is not None:
+            metrics.default.finish(session.measurement, outcome)
+            session.measurement = None
+
+    def serve_get(self, session: event_session, file_name: str) -> None:
+        """sends a file, a small one in one piece from the cache and a large one with sendfile"""
+        if not self.index.is_file(file_name):
+            err_msg = f'{file_name} does not exist. Path = {self.directory}'
+            session.channel.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
+
+        try:
+            served = self.open_served(file_name)
+        except OSError as error:
+            session.channel.send_reply('ERR', f'{file_name} could not be read: {error.strerror}')
+            return
+
+        body = outgoing()
+        if isinstance(served, bytes):
+            body.sendall(served)
+        else:
+            size = os.fstat(served.fileno()).st_size
+            body.sendall(pad_str(str(size)).encode('ascii'))
+            body.send_file(served, size)
+
+        self.start_transfer(session, transfer(file_name, body=body))
+
+    def serve_put(self, session: event_session, file_name: str) -> None:
+        """receives a file into a temporary file, renamed over the old one once complete"""
+        self.start_transfer(session, transfer(file_name, path=pathlib.Path(f'{self.directory}/{file_name}'),
+                                              fsync=self.fsync))
+
+    def serve_ls(self, session: event_session, pattern: str = '*') -> None:
+        """sends the entries whose name matches pattern as pages of JSON lines"""
+        body = outgoing()
+        body.send_chunks(listing.pages(self.index.scan(pattern)))
+        self.start_transfer(session, transfer(pattern, body=body))
+
+    def serve_persist(self, session: event_session) -> None:
+        """opens a 'data' channel that stays open for the rest of the session"""
+        if session.data is not None:
+            session.channel.send_reply('ERR', 'The data channel is already persistent')
+            return
+
+        self.start_transfer(session, transfer('persist'))
+
+    def serve_negotiate(self, session: event_session) -> None:
+        """offers the newest version of the protocol, the client's pick is the next field"""
+        session.channel.send_reply('OK', str(VERSION))
+        session.negotiating = True
+
+    def serve_noop(self, session: event_session) -> None:
+        session.channel.send_reply('OK')
+
+    def serve_quit(self, session: event_session) -> None:
+        self.finish(session, 'ok')
+        self.close_session(session)
+
+    def start_transfer(self, session: event_session, current: transfer) -> None:
+        """
+        accepts the command and starts its transfer on the persistent channel,
+        or on a new channel once the client connected to the port sent with the reply
+        """
+        session.transfer = current
+        session.started = time.perf_counter()
+
+        if session.data is not None:
+            session.channel.send_reply('OK')
+            current.socket = session.data
+            self.selector.register(session.data, current.events, functools.partial(self.on_data, session))
+            return
+
+        # create the data channel and bind it to an available port
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('', 0))
+        listener.listen(1)
+        listener.setblocking(False)
+        session.listener = listener
+
+        session.channel.send_reply('OK', str(listener.getsockname()[1]))
+        self.selector.register(listener, selectors.EVENT_READ, functools.partial(self.on_data_channel, session))
+
+    def on_data_channel(self, session: event_session, listener: socket.socket, events: int) -> None:
+        """the client connected its 'data' channel, the transfer starts"""
+        try:
+            data, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        self.forget(listener)
+        listener.close()
+        session.listener = None
+        data.setblocking(False)
+        no_delay(data)
+        if session.measurement is not None:
+            session.measurement.connected(session.started)
+
+        current = session.transfer
+        if current.body is None and current.path is None:
+            # persist: the channel is kept for the transfers to come
+            session.data = data
+            log.info('[SERVER] %s keeps its data channel open', session)
+            self.end_transfer(session)
+            return
+
+        current.socket = data
+        self.selector.register(data, current.events, functools.partial(self.on_data, session))
+
+    def on_data(self, session: event_session, sock: socket.socket, events: int) -> None:
+        """moves the bytes of the running transfer the socket is ready for"""
+        try:
+            if not session.transfer.resume(sock, session.measurement):
+                if session.transfer.waiting is not None:
+                    self.wait_for_disk(session, session.transfer)
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError, EOFError) as error:
+            log.error('[SERVER ERROR] [%s] %s', session.transfer.name, error)
+            self.end_transfer(session, broken=True)
+            return
+
+        if session.transfer.path is not None:
+            log.info('[SERVER] [%s] has been written to %s', session.transfer.name, self.directory)
+        else:
+            log.info('[SERVER] [%s] has been sent!', session.transfer.name)
+        self.end_transfer(session)
+
+    def wait_for_disk(self, session: event_session, current: transfer) -> None:
+        """runs the blocking disk work of a transfer on a disk thread, its socket is not read meanwhile"""
+        work, current.waiting = current.waiting, None
+        self.forget(current.socket)
+        current.pending = self.disk.submit(work)
+        current.pending.add_done_callback(functools.partial(self.disk_done, session, current))
+
+    def disk_done(self, session: event_session, current: transfer, future: concurrent.futures.Future) -> None:
+        """called on the disk thread, hands the result to the loop"""
+        self.done.append((session, current, future))
+        with contextlib.suppress(OSError):
+            self.wake_up.send(b'\0')
+
+    def resume_transfer(self, session: event_session, current: transfer, future: concurrent.futures.Future) -> None:
+        """the disk work of a transfer finished, it completes or goes on receiving"""
+        current.pending = None
+        if session.transfer is not current:
+            # the session closed meanwhile, close() threw the file away
+            return
+
+        if (error := future.exception()) is not None:
+            log.error('[SERVER ERROR] [%s] %s', current.name, error)
+            self.end_transfer(session, broken=True)
+            return
+
+        if current.target.committed:
+            log.info('[SERVER] [%s] has been written to %s', current.name, self.directory)
+            self.end_transfer(session)
+            return
+
+        current.last_active = time.monotonic()
+        self.selector.register(current.socket, current.events, functools.partial(self.on_data, session))
+
+    def end_transfer(self, session: event_session, broken: bool = False) -> None:
+        """
+        ends the running transfer and goes on with the commands that arrived meanwhile.
+        A persistent channel stays open unless the transfer broke its framing
+        """
+        current, session.transfer = session.transfer, None
+        current.close()
+        if current.path is not None:
+            self.changed(current.name)
+
+        if session.listener is not None:
+            self.forget(session.listener)
+            session.listener.close()
+            session.listener = None
+
+        if (data := current.socket) is not None:
+            self.forget(data)
+            if data is session.data and broken:
+                session.data = None
+            if data is not session.data:
+                data.close()
+
+        self.finish(session, 'failed' if broken else 'ok')
+        session.last_active = time.monotonic()
+
+        if session.closing:
+            self.close_session(session)
+            return
+
+        try:
+            self.advance(session)
+            self.flush(session)
+        except (OSError, ValueError, EOFError) as error:
+            log.error('[SERVER ERROR] %s %s', session, error)
+            self.close_session(session)
+
+    def close_session(self, session: event_session) -> None:
+        """terminates a session and whatever transfer it was running"""
+        if self.connections.pop(session.control, None) is None:
+            return
+
+        current, session.transfer = session.transfer, None
+        # closing a socket takes it out of epoll but not out of the selector's map
+        for sock in (session.control, session.listener, session.data, current and current.socket):
+            if sock is not None:
+                self.forget(sock)
+
+        if current is not None:
+            current.close()
+            if current.socket is not None and current.socket is not session.data:
+                current.socket.close()
+        if session.listener is not None:
+            session.listener.close()
+            session.listener = None
+        self.finish(session, 'failed')
+
+        session.close()
+        session.replies.close()
+        self.resume_accepting()
+
+    def sweep(self) -> None:
+        """closes the sessions idle for too long and the transfers that stopped moving"""
+        now = time.monotonic()
+
+        for session in list(self.connections.values()):
+            if session.transfer is not None and session.transfer.pending is not None:
+                # the disk is slow, not the client
+                continue
+            if session.transfer is not None and now - session.transfer.last_active > self.stall_timeout:
+                log.info('[INFO] %s stalled in the middle of a transfer', session)
+                self.end_transfer(session, broken=True)
+            elif session.transfer is None and now - session.last_active > self.idle_timeout:
+                log.info('[INFO] %s was idle for %s seconds', session, self.idle_timeout)
+                self.close_session(session)
+
+
+def raise_file_limit() -> None:
+    """lets the process open as many sockets as its hard limit allows, every session takes two or three"""
+    if resource is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def run_worker(options: typing.Dict[str, typing.Any]) -> None:
+    """one worker process, its own loop on its own socket of the shared port"""
+    try:
+        event_server(reuse_port=True, **options).serve()
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_workers(workers: int, **options: typing.Any) -> None:
+    """
+    Serves from one event loop per process. Every process listens on its own socket
+    with SO_REUSEPORT and the kernel spreads new connections over them
+    @options - the arguments of event_server, server_port included
+    """
+    processes = [multiprocessing.Process(target=run_worker, args=(options,), name=f'worker {n}')
+                 for n in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # the workers got the Ctrl-C too and are closing their sessions
+        log.info('[INFO] Attempting to exit gracefully....')
+        for process in processes:
+            process.join()
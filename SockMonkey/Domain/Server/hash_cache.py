@@ -0,0 +1,82 @@
+"""
+Persistent cache of the content hashes of the served files
+A file is only hashed again when its inode, size or modification time changes
+"""
+
+import json
+import os
+import pathlib
+import threading
+import typing
+
+from SockMonkey.Domain.Server.helpers import hash_file
+from SockMonkey.Domain.Server.receiver import is_temporary
+
+
+class hash_cache:
+    def __init__(self, directory: pathlib.Path, path: typing.Optional[pathlib.Path] = None):
+        self.directory = directory
+        # kept next to the served directory so clients never see it
+        self.path = path or pathlib.Path(f'{directory}.hashes.json')
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        # file name -> {inode, size, mtime_ns, hash}
+        self.entries: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        try:
+            with open(self.path) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            # missing or corrupt, every file is hashed on first use
+            pass
+
+    def lookup(self, entry: os.DirEntry) -> str:
+        """returns the hash of a file in the served directory, hashing it only if it changed"""
+        stat = entry.stat()
+        key = {'inode': stat.st_ino, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        with self.lock:
+            cached = self.entries.get(entry.name)
+            if cached and all(cached.get(field) == value for field, value in key.items()):
+                return cached['hash']
+
+        digest = hash_file(entry.path)
+
+        with self.lock:
+            self.entries[entry.name] = {**key, 'hash': digest}
+            self.dirty = True
+
+        return digest
+
+    def manifest(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """returns the name, size, mtime and hash of every served file"""
+        manifest = []
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not is_temporary(entry.name):
+                    stat = entry.stat()
+                    manifest.append({'name': entry.name, 'size': stat.st_size,
+                                     'mtime': stat.st_mtime, 'hash': self.lookup(entry)})
+
+        # forget files that were deleted
+        names = {item['name'] for item in manifest}
+        with self.lock:
+            for name in self.entries.keys() - names:
+                del self.entries[name]
+                self.dirty = True
+
+        self.save()
+        return manifest
+
+    def save(self) -> None:
+        """writes the cache to disk if it changed, replacing the old copy atomically"""
+        with self.lock:
+            if not self.dirty:
+                return
+
+            temporary = pathlib.Path(f'{self.path}.tmp')
+            with open(temporary, "w") as fp:
+                json.dump(self.entries, fp)
+            os.replace(temporary, self.path)
+            self.dirty = False
@@ -0,0 +1,66 @@
+"""
+In-process listing of the served directory
+Entries are read with os.scandir and sent as JSON lines, one page per chunk,
+so huge directories are streamed instead of being built up in memory
+"""
+
+import fnmatch
+import itertools
+import json
+import os
+import stat
+import typing
+
+from SockMonkey.Domain.Server.receiver import is_temporary
+
+# entries per page on the wire
+PAGE_SIZE = 1000
+
+
+def entry_type(mode: int) -> str:
+    if stat.S_ISLNK(mode):
+        return 'link'
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    if stat.S_ISREG(mode):
+        return 'file'
+    return 'other'
+
+
+def served_path(directory: os.PathLike, name: str) -> typing.Optional[str]:
+    """
+    the path of a name inside the served directory, links are not resolved
+    @return - None when the name is absolute or leads out of the directory
+    """
+    relative = os.path.normpath(name)
+    if os.path.isabs(relative) or relative == os.pardir or relative.startswith(os.pardir + os.sep) or '\0' in name:
+        return None
+    return os.path.join(directory, relative)
+
+
+def describe(entry: os.DirEntry) -> typing.Dict[str, typing.Any]:
+    """the name, size, mtime and type of a directory entry, links are not followed"""
+    info = entry.stat(follow_symlinks=False)
+    return {'name': entry.name, 'size': info.st_size,
+            'mtime': info.st_mtime, 'type': entry_type(info.st_mode)}
+
+
+def scan(directory: typing.Union[str, os.PathLike],
+         pattern: str = '*') -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    """yields the entries of directory whose name matches pattern, in directory order"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if fnmatch.fnmatchcase(entry.name, pattern) and not is_temporary(entry.name):
+                try:
+                    yield describe(entry)
+                except FileNotFoundError:
+                    # deleted while we were listing
+                    continue
+
+
+def pages(entries: typing.Iterable[typing.Dict[str, typing.Any]],
+          page_size: int = PAGE_SIZE) -> typing.Iterator[bytes]:
+    """groups entries into pages of JSON lines"""
+    entries = iter(entries)
+    while page := list(itertools.islice(entries, page_size)):
+        yield '\n'.join(map(json.dumps, page)).encode('utf-8')
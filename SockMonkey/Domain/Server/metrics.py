@@ -0,0 +1,186 @@
+"""
+Instrumentation of commands and of the transfers they make
+Every command is measured: how long it took, how long the 'data' channel
+took to open, when the first byte moved, how many bytes and socket calls
+it made. The totals are kept in a registry that renders them in the
+Prometheus text format, and each command can also be written out as one
+JSON line
+"""
+
+import bisect
+import collections
+import http.server
+import json
+import threading
+import time
+import typing
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+HELP = {
+    'ftp_commands_total': ('counter', 'Commands run, by command and outcome'),
+    'ftp_command_seconds': ('histogram', 'Time from receiving a command to finishing it'),
+    'ftp_data_channel_setup_seconds': ('histogram', 'Time to open the data channel of a command'),
+    'ftp_first_byte_seconds': ('histogram', 'Time from receiving a command to the first byte on its data channel'),
+    'ftp_transfer_bytes_total': ('counter', 'Bytes moved on data channels, by command and direction'),
+    'ftp_socket_calls_total': ('counter', 'Socket calls made on data channels, by command and call'),
+    'ftp_message_calls_total': ('counter', 'Size prefixed messages sent by send_all or received by receive_all'),
+    'ftp_message_bytes_total': ('counter', 'Bytes of the messages sent by send_all or received by receive_all'),
+    'ftp_message_seconds_total': ('counter', 'Time spent in send_all and receive_all, receive_all waits for the peer'),
+    'ftp_content_cache_hits_total': ('counter', 'Files sent from the in-memory content cache'),
+    'ftp_content_cache_misses_total': ('counter', 'Files the content cache had to read or could not hold'),
+    'ftp_content_cache_bytes_saved_total': ('counter', 'Bytes sent from the content cache instead of the disk'),
+}
+
+labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+class measurement:
+    """one command, filled in as it runs"""
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.setup: typing.Optional[float] = None
+        self.first_byte: typing.Optional[float] = None
+        self.sent = 0
+        self.received = 0
+        self.calls: typing.Counter[str] = collections.Counter()
+
+    def connected(self, since: float) -> None:
+        """records how long the 'data' channel took to open, since a perf_counter reading"""
+        self.setup = (self.setup or 0.0) + time.perf_counter() - since
+
+    def moved(self, call: str, sent: int = 0, received: int = 0) -> None:
+        """records one socket call on the 'data' channel and the bytes it moved"""
+        with self.lock:
+            self.calls[call] += 1
+            self.sent += sent
+            self.received += received
+            if self.first_byte is None and (sent or received):
+                self.first_byte = time.perf_counter() - self.started
+
+    def record(self, outcome: str) -> typing.Dict[str, typing.Any]:
+        """the measurement as a dict, for the registry and the JSON log"""
+        return {'command': self.command, 'outcome': outcome,
+                'seconds': time.perf_counter() - self.started,
+                'setup_seconds': self.setup, 'first_byte_seconds': self.first_byte,
+                'bytes_sent': self.sent, 'bytes_received': self.received,
+                'calls': dict(self.calls)}
+
+
+class registry:
+    """totals of every measurement, thread safe"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: typing.Dict[str, typing.Dict[labels, float]] = collections.defaultdict(
+            lambda: collections.defaultdict(float))
+        # name -> labels -> [count per bucket..., count, sum]
+        self.histograms: typing.Dict[str, typing.Dict[labels, typing.List[float]]] = collections.defaultdict(dict)
+        # where one JSON line per command goes, None for nowhere
+        self.json_log: typing.Optional[typing.TextIO] = None
+
+    def count(self, name: str, value: float = 1, **label_values: str) -> None:
+        with self.lock:
+            self.counters[name][tuple(sorted(label_values.items()))] += value
+
+    def observe(self, name: str, seconds: float, **label_values: str) -> None:
+        with self.lock:
+            # one slot per bucket, one for what is above the last bucket, the count and the sum
+            series = self.histograms[name].setdefault(
+                tuple(sorted(label_values.items())), [0.0] * (len(BUCKETS) + 3))
+            series[bisect.bisect_left(BUCKETS, seconds)] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def message(self, helper: str, size: int, seconds: float) -> None:
+        """records one call of send_all or receive_all"""
+        with self.lock:
+            key = (('helper', helper),)
+            self.counters['ftp_message_calls_total'][key] += 1
+            self.counters['ftp_message_bytes_total'][key] += size
+            self.counters['ftp_message_seconds_total'][key] += seconds
+
+    def finish(self, current: measurement, outcome: str = 'ok') -> typing.Dict[str, typing.Any]:
+        """adds a finished command to the totals and writes its JSON line"""
+        record = current.record(outcome)
+        command = current.command
+
+        self.count('ftp_commands_total', command=command, outcome=outcome)
+        self.observe('ftp_command_seconds', record['seconds'], command=command)
+        if current.setup is not None:
+            self.observe('ftp_data_channel_setup_seconds', current.setup, command=command)
+        if current.first_byte is not None:
+            self.observe('ftp_first_byte_seconds', current.first_byte, command=command)
+        if current.sent:
+            self.count('ftp_transfer_bytes_total', current.sent, command=command, direction='sent')
+        if current.received:
+            self.count('ftp_transfer_bytes_total', current.received, command=command, direction='received')
+        for call, n in current.calls.items():
+            self.count('ftp_socket_calls_total', n, command=command, call=call)
+
+        if self.json_log is not None:
+            with self.lock:
+                self.json_log.write(json.dumps(record) + '\n')
+                self.json_log.flush()
+
+        return record
+
+    def render(self) -> str:
+        """every metric in the Prometheus text exposition format"""
+        def label_text(pairs: labels, *extra: typing.Tuple[str, str]) -> str:
+            pairs = pairs + extra
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}' if pairs else ''
+
+        lines: typing.List[str] = []
+        with self.lock:
+            for name in sorted(set(self.counters) | set(self.histograms)):
+                kind, text = HELP.get(name, ('untyped', name))
+                lines += [f'# HELP {name} {text}', f'# TYPE {name} {kind}']
+
+                for pairs, value in sorted(self.counters.get(name, {}).items()):
+                    lines.append(f'{name}{label_text(pairs)} {value:g}')
+
+                for pairs, series in sorted(self.histograms.get(name, {}).items()):
+                    cumulative = 0.0
+                    for bound, n in zip(BUCKETS, series):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{label_text(pairs, ("le", f"{bound:g}"))} {cumulative:g}')
+                    lines.append(f'{name}_bucket{label_text(pairs, ("le", "+Inf"))} {series[-2]:g}')
+                    lines.append(f'{name}_count{label_text(pairs)} {series[-2]:g}')
+                    lines.append(f'{name}_sum{label_text(pairs)} {series[-1]:g}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> http.server.ThreadingHTTPServer:
+        """serves the metrics at http://host:port/metrics from a background thread"""
+        metrics = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                # scrapes are not worth a line each
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+# the registry the helpers and the commands of this process report to
+default = registry()
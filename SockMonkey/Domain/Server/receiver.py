@@ -0,0 +1,216 @@
+"""
+Crash safe receiving of uploaded files
+A file is written to a temporary file next to its destination, with its
+announced size allocated up front, and only renamed over the destination
+once every byte arrived, so a crash or a client that hangs up never leaves
+a truncated file behind. Large bodies are written by a thread fed from a
+bounded pool of buffers, the next chunk is read from the network while the
+previous one goes to the disk
+"""
+
+import errno
+import os
+import pathlib
+import queue
+import re
+import secrets
+import socket
+import threading
+import typing
+
+from SockMonkey.Domain.Server import checksum
+from SockMonkey.Domain.Server.helpers import CHUNK_SIZE, receive_all, receive_header
+
+# buffers a body may be ahead of the disk by, the memory used is DEPTH * CHUNK_SIZE
+DEPTH = 8
+# filesystems that cannot allocate ahead are written without it
+NOT_SUPPORTED = {errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS}
+# names of the temporary files of uploads in progress, made by create_temporary
+TEMPORARY = re.compile(r'\..+\.[0-9a-f]{8}\.part')
+
+
+def create_temporary(path: pathlib.Path) -> typing.Tuple[int, pathlib.Path]:
+    """
+    opens a new hidden file next to path, to be renamed over it later.
+    Unlike mkstemp the file gets the permissions a plain open would give it
+    """
+    while True:
+        temporary = path.with_name(f'.{path.name}.{secrets.token_hex(4)}.part')
+        try:
+            return os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), temporary
+        except FileExistsError:
+            continue
+
+
+def is_temporary(name: str) -> bool:
+    """True for the temporary file of an upload in progress, it is never listed or served"""
+    return name.startswith('.') and TEMPORARY.fullmatch(name) is not None
+
+
+def write_fully(fd: int, view: memoryview) -> None:
+    """writes the whole view, os.write may take only part of it"""
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class write_behind:
+    """
+    A file being received into a temporary file.
+    commit() renames it over its destination, leaving the with block
+    without committing throws the temporary file away
+    """
+
+    def __init__(self, path: pathlib.Path, size: int = 0, fsync: bool = False,
+                 threaded: bool = True, depth: int = DEPTH, chunk_size: int = CHUNK_SIZE):
+        self.path = path
+        self.fsync = fsync
+        self.fd, self.temporary = create_temporary(path)
+        self.committed = False
+        # the first error of the writer thread, raised to the receiving side
+        self.error: typing.Optional[OSError] = None
+
+        try:
+            self.preallocate(size)
+        except BaseException:
+            self.abort()
+            raise
+
+        # buffers waiting to be filled and filled buffers waiting for the disk,
+        # the receiving side waits for a free buffer when the disk falls behind
+        self.free: 'queue.SimpleQueue[memoryview]' = queue.SimpleQueue()
+        for _ in range(depth if threaded else 1):
+            self.free.put(memoryview(bytearray(chunk_size)))
+        self.full: 'queue.SimpleQueue[typing.Optional[memoryview]]' = queue.SimpleQueue()
+
+        self.thread: typing.Optional[threading.Thread] = None
+        if threaded:
+            self.thread = threading.Thread(target=self.drain, name=f'write {path.name}', daemon=True)
+            self.thread.start()
+
+    def __enter__(self) -> 'write_behind':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if not self.committed:
+            self.abort()
+
+    def preallocate(self, size: int) -> None:
+        """
+        reserves the blocks of the whole file, a full disk is found out before any byte is received
+        @raise OSError - there is not enough space
+        """
+        if size <= 0 or not hasattr(os, 'posix_fallocate'):
+            return
+
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except OSError as error:
+            if error.errno not in NOT_SUPPORTED:
+                raise
+
+    def buffer(self) -> memoryview:
+        """an empty buffer to receive the next chunk into, waits while the disk is behind"""
+        return self.free.get()
+
+    def write(self, buffer: memoryview, size: int) -> None:
+        """
+        queues the first size bytes of a buffer from buffer(), the buffer is handed back once written
+        @raise OSError - an earlier chunk could not be written
+        """
+        if self.error is not None:
+            raise self.error
+
+        if self.thread is None:
+            write_fully(self.fd, buffer[:size])
+            self.free.put(buffer)
+        else:
+            self.full.put(buffer[:size])
+
+    def drain(self) -> None:
+        """the writer thread, writes the queued chunks in order until stop()"""
+        while (chunk := self.full.get()) is not None:
+            if self.error is None:
+                try:
+                    write_fully(self.fd, chunk)
+                except OSError as error:
+                    self.error = error
+            # the receiving side may be waiting for a free buffer even after an error
+            self.free.put(memoryview(chunk.obj))
+
+    def stop(self) -> None:
+        """waits for the queued chunks to be written"""
+        if self.thread is not None:
+            self.full.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def commit(self) -> None:
+        """
+        renames the complete file over its destination, with fsync the file and the
+        rename are on the disk when this returns
+        @raise OSError - a chunk could not be written
+        """
+        self.stop()
+        if self.error is not None:
+            raise self.error
+
+        if self.fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        # the number may be reused by another file from now on
+        self.fd = -1
+        os.replace(self.temporary, self.path)
+        self.committed = True
+
+        if self.fsync:
+            directory = os.open(self.path.parent, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def abort(self) -> None:
+        """throws the temporary file away, the destination is left as it was"""
+        if getattr(self, 'thread', None) is not None:
+            self.stop()
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        try:
+            os.unlink(self.temporary)
+        except FileNotFoundError:
+            pass
+
+
+def receive_file(socket: socket.socket, path: pathlib.Path, fsync: bool = False,
+                 digest: typing.Optional[typing.Any] = None, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Receives a size prefixed body into path, replacing it only once the whole body arrived
+    @digest - a running checksum of the body, the sender's digest follows the body
+    and the file is only kept if both match
+    @return - the num of bytes received
+    @raise ConnectionError - the socket closed before the whole body arrived
+    @raise OSError - the file could not be allocated or written
+    @raise checksum.mismatch - the body does not match the sender's digest
+    """
+    size = receive_header(socket)
+    bytes_received = 0
+
+    # a body that fits in one chunk has nothing to overlap with
+    with write_behind(path, size, fsync, threaded=size > chunk_size, chunk_size=chunk_size) as writer:
+        while bytes_received < size:
+            buffer = writer.buffer()
+            if not (n := socket.recv_into(buffer, min(len(buffer), size - bytes_received))):
+                raise ConnectionError(f'{socket} closed after {bytes_received} of {size} bytes')
+            if digest is not None:
+                digest.update(buffer[:n])
+            writer.write(buffer, n)
+            bytes_received += n
+
+        if digest is not None and (expected := receive_all(socket)) != digest.hexdigest():
+            raise checksum.mismatch(path.name, expected, digest.hexdigest())
+
+        writer.commit()
+
+    return bytes_received
@@ -4,48 +4,145 @@ It receives commands from the client and sends/receives data to/from the client
 """
 
 
+import argparse
+import concurrent.futures
+import contextlib
+import fnmatch
+import json
+import logging
 import os
 import socket
 import sys
+import threading
+import time
 import typing
 import functools
 import pathlib
 import tempfile
 
-from SockMonkey.Domain.Server.helpers import receive_all, send_all, send_err
+from SockMonkey.Domain.Server import archive, checksum, compression, delta, listing, metrics
+from SockMonkey.Domain.Server.content_cache import content_cache
+from SockMonkey.Domain.Server.helpers import (HEADER_SIZE, VERSION, control_channel, hash_file, iter_chunks,
+                                              no_delay, receive_all, receive_stream, send_all,
+                                              send_chunks, send_file, split_range)
+from SockMonkey.Domain.Server.directory_index import directory_index
+from SockMonkey.Domain.Server.hash_cache import hash_cache
+from SockMonkey.Domain.Server.receiver import create_temporary, receive_file
+from SockMonkey.Domain.Server.session import ftp_session
+from SockMonkey.Domain.Server.throttle import PRIORITIES, flow, parse_rate, throttle, throttled_socket
+
+log = logging.getLogger(__name__)
+
+
+# most connections a single parallel get may open
+MAX_SEGMENTS = 16
+# levels of the --log-level option, off silences everything but the final report
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING,
+              'error': logging.ERROR, 'off': logging.CRITICAL + 1}
+# names of the command codes, as they appear in the metrics
+COMMANDS = {1: 'get', 2: 'put', 3: 'ls', 4: 'quit', 5: 'persist', 6: 'mget', 7: 'mput',
+            8: 'pget', 9: 'reget', 10: 'reput', 11: 'sync', 12: 'dget', 13: 'dput',
+            14: 'zget', 15: 'zput', 16: 'rget', 17: 'rput', 18: 'negotiate',
+            19: 'noop', 20: 'priority', 21: 'checksum', 22: 'ls'}
 
 
 class ftp_server:
     def __init__(self, server_port: int = 1233,
-                 directory: pathlib.Path = pathlib.Path(f'{tempfile.gettempdir()}/build')):
+                 directory: pathlib.Path = pathlib.Path(f'{tempfile.gettempdir()}/build'),
+                 max_connections: int = 16, backlog: int = 16,
+                 index_entries: int = 100_000, index_interval: float = 1.0,
+                 transfer_rate: float = 0, client_rate: float = 0, total_rate: float = 0,
+                 fsync: bool = False, cache_bytes: int = 64 << 20, cache_file_size: int = 256 << 10,
+                 reuse_port: bool = False):
         if not(isinstance(server_port, int)
-               and isinstance(directory, pathlib.Path)):
+               and isinstance(directory, pathlib.Path)
+               and isinstance(max_connections, int)
+               and isinstance(backlog, int)
+               and isinstance(index_entries, int)
+               and isinstance(index_interval, (int, float))
+               and all(isinstance(rate, (int, float)) for rate in (transfer_rate, client_rate, total_rate))
+               and isinstance(fsync, bool)
+               and isinstance(cache_bytes, int)
+               and isinstance(cache_file_size, int)
+               and isinstance(reuse_port, bool)):
             raise ValueError(
                 f'mismatched constructor: ftp_server({list(locals().values())[1:]})')
         self.server_port = server_port
         self.directory = directory
+        self.max_connections = max_connections
+        self.backlog = backlog
+        # uploads are flushed to the disk before they replace the old file
+        self.fsync = fsync
         self.welcome_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # several processes may listen on the same port, the kernel spreads the clients over them
+        if reuse_port:
+            self.welcome_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.welcome_sock.bind(('', self.server_port))
 
+        # control channel -> session of every connected client
+        self.sessions: typing.Dict[control_channel, ftp_session] = {}
+        self.sessions_lock = threading.Lock()
+        self.stopping = threading.Event()
+
         if not self.directory.is_dir():
-            print(f'[INFO] Creating {self.directory}')
-            print('[INFO] This is where the server\'s files are located')
+            log.info('[INFO] Creating %s', self.directory)
+            log.info("[INFO] This is where the server's files are located")
             self.directory.mkdir()
 
-    def get(self, file_name: str, control: socket.socket) -> None:
-        """sends a file to the client"""
+        # content hashes of the served files, kept between runs for sync
+        self.hashes = hash_cache(self.directory)
 
-        # check if the file exists
-        if not pathlib.Path(f'{self.directory}/{file_name}').is_file():
-            err_msg = (
-                f'{file_name} does not exist. Path = {self.directory}'
-            )
-            send_err(control, err_msg)
-            print(err_msg)
-            return
-        
-        # tell the client that the command is OK
-        send_all(control, 'OK')
+        # names, sizes and types of the served files, so ls and the
+        # existence checks do not go to the disk
+        self.index = directory_index(self.directory, index_entries, index_interval)
+
+        # framed bodies of the small files sent most recently, sent without touching the disk
+        self.cache = content_cache(self.directory, cache_bytes, cache_file_size)
+
+        # bandwidth limits of the 'data' channels, in bytes per second
+        self.throttle = throttle(transfer_rate, client_rate, total_rate)
+
+    def open_data_channel(self, control: control_channel, *reply: str) -> socket.socket:
+        """
+        Returns the 'data' channel for the next transfer.
+        A persistent session reuses its open channel, otherwise a fresh socket
+        is bound to an available port and the client connects to it.
+        A reply ('OK' and its fields) is sent together with the port,
+        in version 2 they share a frame.
+        Every transfer is paced by the bandwidth limits and measured
+        """
+        start = time.perf_counter()
+        data = self.accept_data_channel(control, *reply)
+
+        transfer = self.new_flow(control)
+        if transfer.meter is not None:
+            transfer.meter.connected(start)
+
+        return throttled_socket(data, transfer)
+
+    def new_digest(self, control: control_channel) -> typing.Optional[typing.Any]:
+        """a running checksum of the session's next body, None when its transfers are not checked"""
+        session = self.sessions.get(control)
+        return checksum.new(session and session.checksum)
+
+    def resume_algorithm(self, control: control_channel) -> str:
+        """the checksum a resumed transfer of the session compares its blocks and its body with"""
+        session = self.sessions.get(control)
+        return (session and session.checksum) or checksum.RESUME_ALGORITHM
+
+    def new_flow(self, control: control_channel) -> flow:
+        """a transfer of the client on control, limited and measured as part of its command"""
+        session = self.sessions.get(control)
+        transfer = self.throttle.new_flow(session and session.bucket, session.priority if session else 1)
+        transfer.meter = session and session.measurement
+        return transfer
+
+    def accept_data_channel(self, control: control_channel, *reply: str) -> socket.socket:
+        """returns the open persistent channel, or the socket of a new channel once the client connected"""
+        if (session := self.sessions.get(control)) and session.data is not None:
+            if reply:
+                control.send_reply(*reply)
+            return session.data
 
         # create the data channel and bind it to an available port
         data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -58,166 +155,925 @@ class ftp_server:
         port_num = str(data_socket.getsockname()[1])
 
         # send the data port num to client over control
-        print(f"[SERVER] Sending the port of {port_num}")
-        send_all(control, port_num)
+        log.debug('[SERVER] Sending the port of %s', port_num)
+        if reply:
+            control.send_reply(*reply, port_num)
+        else:
+            control.send(port_num)
 
         # wait for client to connect over data
         data, addrs = data_socket.accept()
+        data_socket.close()
 
-        # store shell command
-        # our filesystem we have access to is /tmp/build , assuming linux
-        print(f'[SERVER] Reading [{file_name}] from {self.directory}')
-        with open(f'{self.directory}/{file_name}') as fp:
-            content = ''.join(fp.readlines())
-        # file_list = 'this is the file list'
+        return no_delay(data)
 
-        # send the output over the 'data' channel
-        print('[SERVER] Sending...')
-        send_all(data, content)
+    def close_data_channel(self, control: control_channel, data: throttled_socket,
+                           broken: bool = False) -> None:
+        """
+        Ends a transfer on the 'data' channel.
+        A persistent channel stays open unless the transfer broke its framing,
+        then the session falls back to a new channel per command
+        """
+        session = self.sessions.get(control)
 
-        print(f'[SERVER] [{file_name}] has been sent!')
+        if session and session.data is data.socket:
+            if not broken:
+                return
+            session.data = None
 
-        # close the 'data' channel
         data.close()
-        data_socket.close()
 
-    def put(self, file_name: str, control: socket.socket) -> None:
-        """receives a file from the client"""
+    def open_served(self, file_name: str) -> typing.Union[bytes, typing.BinaryIO]:
+        """
+        returns a served file, as its framed body when it is small enough for the cache
+        and as an open file otherwise
+        @raise OSError - the file could not be read
+        """
+        framed = self.cache.lookup(file_name)
+        return framed if framed is not None else open(f'{self.directory}/{file_name}', "rb")
+
+    def send_served(self, data: throttled_socket, body: typing.Union[bytes, typing.BinaryIO],
+                    digest: typing.Optional[typing.Any] = None) -> None:
+        """
+        sends a file from open_served() behind its size, a cached body in a single
+        sendall and a file from the disk with sendfile. The checksum trails the body
+        """
+        if isinstance(body, bytes):
+            if digest is not None:
+                digest.update(memoryview(body)[HEADER_SIZE:])
+            data.sendall(body)
+        else:
+            with body:
+                send_file(data, body, os.fstat(body.fileno()).st_size, digest=digest)
+
+        if digest is not None:
+            send_all(data, digest.hexdigest())
+
+    def changed(self, name: str) -> None:
+        """a served file was written, the index and the cache forget what they knew of it"""
+        self.index.update(name)
+        self.cache.invalidate(name)
+
+    def get(self, file_name: str, control: control_channel) -> None:
+        """sends a file to the client"""
+
+        # check if the file exists
+        if not self.index.is_file(file_name):
+            err_msg = (
+                f'{file_name} does not exist. Path = {self.directory}'
+            )
+            control.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
+
+        # the index may be a moment behind a file deleted behind our back
+        try:
+            body = self.open_served(file_name)
+        except OSError as error:
+            control.send_reply('ERR', f'{file_name} could not be read: {error.strerror}')
+            return
+
         # tell the client that the command is OK
-        send_all(control, 'OK')
+        data = self.open_data_channel(control, 'OK')
+
+        # our filesystem we have access to is /tmp/build , assuming linux
+        # a small file goes out of the cache with its header, a large one
+        # is copied by the kernel from the page cache onto the 'data' channel
+        log.debug('[SERVER] Sending [%s] from %s...', file_name, self.directory)
+        self.send_served(data, body, self.new_digest(control))
+
+        log.info('[SERVER] [%s] has been sent!', file_name)
+
+        # close the 'data' channel
+        self.close_data_channel(control, data)
+
+    def pget(self, file_name: str, connections: int, control: control_channel) -> None:
+        """
+        sends a file to the client over several 'data' connections at once.
+        Every connection asks for one byte range of the file
+        """
+        path = pathlib.Path(f'{self.directory}/{file_name}')
+
+        # check if the file exists
+        if not self.index.is_file(file_name):
+            err_msg = (
+                f'{file_name} does not exist. Path = {self.directory}'
+            )
+            control.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
+
+        size = path.stat().st_size
+        connections = max(1, min(connections, MAX_SEGMENTS))
+        segments = split_range(size, connections)
+
+        # one listening socket serves every segment
+        start = time.perf_counter()
         data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         data_socket.bind(('', 0))
+        data_socket.listen(len(segments))
 
-        # listen
-        data_socket.listen(1)
-
-        # store the port num as str
+        # tell the client that the command is OK, how much is coming,
+        # how many connections it may open and where
         port_num = str(data_socket.getsockname()[1])
+        log.debug('[SERVER] Sending the port of %s', port_num)
+        control.send_reply('OK', str(size), str(connections), port_num)
 
-        # send the data port num to client over control
-        print(f"[SERVER] Sending the port of {port_num}")
-        send_all(control, port_num)
+        log.debug('[SERVER] Sending [%s] over %s connections...', file_name, len(segments))
+        # the segments are one transfer as far as the limits and the metrics go
+        transfer = self.new_flow(control)
+        workers = []
+        for _ in segments:
+            data, addrs = data_socket.accept()
+            workers.append(threading.Thread(target=self.send_segment,
+                                            args=(throttled_socket(no_delay(data), transfer), path, size,
+                                                  self.new_digest(control))))
+            workers[-1].start()
 
-        data, addrs = data_socket.accept()
+        if transfer.meter is not None:
+            transfer.meter.connected(start)
 
-        print("[SERVER] Writing...")
-        with open(f'{self.directory}/{file_name}', "w") as fp:
-            fp.write(receive_all(data))
+        for worker in workers:
+            worker.join()
+        data_socket.close()
 
-        print(f"[SERVER] [{file_name}] has been written to {self.directory}")
+        log.info('[SERVER] [%s] has been sent!', file_name)
 
-        data.close()
-        data_socket.close()
+    def send_segment(self, data: throttled_socket, path: pathlib.Path, size: int,
+                     digest: typing.Optional[typing.Any] = None) -> None:
+        """
+        sends the byte range a parallel get asks for on one 'data' connection.
+        Every range is checksummed on its own, so a bad range can be fetched again alone
+        """
+        with data:
+            try:
+                offset = int(receive_all(data))
+                length = int(receive_all(data))
+                if offset < 0 or length < 0 or offset + length > size:
+                    raise ValueError(f'{offset}+{length} is outside of {path.name} ({size} bytes)')
 
-    def ls(self, control: socket.socket) -> None:
-        """lists the files located at the server"""
+                with open(path, "rb") as fp:
+                    send_file(data, fp, length, offset, digest=digest)
+                if digest is not None:
+                    send_all(data, digest.hexdigest())
+            except (ValueError, OSError) as error:
+                log.error('[SERVER ERROR] [%s] %s', path.name, error)
+
+    def put(self, file_name: str, control: control_channel) -> None:
+        """
+        receives a file from the client.
+        When the session checks its transfers the client's checksum trails the body,
+        the server answers with the checksum of what it received or with an error
+        if the body did not arrive, the file is only kept if both checksums match
+        """
         # tell the client that the command is OK
-        send_all(control, 'OK')
+        data = self.open_data_channel(control, 'OK')
+        digest = self.new_digest(control)
+        failure = None
 
-        # create the data channel and bind it to an available port
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        data_socket.bind(('', 0))
+        log.debug('[SERVER] Writing...')
+        try:
+            receive_file(data, pathlib.Path(f'{self.directory}/{file_name}'), self.fsync, digest)
+        except checksum.mismatch as error:
+            log.error('[SERVER ERROR] [%s] %s', file_name, error)
+            self.close_data_channel(control, data)
+        except (ValueError, OSError) as error:
+            log.error('[SERVER ERROR] [%s] %s', file_name, error)
+            self.close_data_channel(control, data, broken=True)
+            failure = f'{file_name} was not received: {error}'
+        else:
+            log.info('[SERVER] [%s] has been written to %s', file_name, self.directory)
+            self.close_data_channel(control, data)
+        finally:
+            self.changed(file_name)
 
-        # listen
-        data_socket.listen(1)
+        # a checked transfer is always answered
+        if digest is not None and failure is None:
+            control.send_reply('OK', digest.hexdigest())
+        elif digest is not None:
+            control.send_reply('ERR', failure)
 
-        # store the port num as str
-        port_num = str(data_socket.getsockname()[1])
+    def reget(self, file_name: str, offset: int, control: control_channel) -> None:
+        """
+        sends the rest of a file the client already has the first offset bytes of.
+        The client sends the digests of the blocks it has, the body starts at
+        the first one that differs from ours and its checksum trails it
+        """
+        path = pathlib.Path(f'{self.directory}/{file_name}')
 
-        # send the data port num to client over control
-        print(f"[SERVER] Sending the port of {port_num}")
-        send_all(control, port_num)
+        # check if the file exists
+        if not self.index.is_file(file_name):
+            err_msg = (
+                f'{file_name} does not exist. Path = {self.directory}'
+            )
+            control.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
 
-        # wait for client to connect over data
-        data, addrs = data_socket.accept()
+        if not 0 <= offset <= (size := path.stat().st_size):
+            err_msg = f'{file_name} has {size} bytes, it cannot be resumed from byte {offset}'
+            control.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
 
-        # store shell command
-        # our filesystem we have access to is /tmp/build , assuming linux
-        print(f'[SERVER] Getting the file list from {self.directory}')
-        file_list: str = os.popen(f"ls -l {self.directory}").read()
-        # file_list = 'this is the file list'
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+
+        # only the blocks the client has are hashed, up to the first that differs
+        algorithm = self.resume_algorithm(control)
+        offset = checksum.matching_prefix(path, offset, algorithm, control.receive_list())
+        control.send(str(offset))
+        digest = checksum.new(algorithm)
+
+        log.debug('[SERVER] Resuming [%s] from byte %s of %s...', file_name, offset, size)
+        with open(path, "rb") as fp:
+            send_file(data, fp, size - offset, offset, digest=digest)
+        send_all(data, digest.hexdigest())
+
+        self.close_data_channel(control, data)
+
+        log.info('[SERVER] [%s] has been sent!', file_name)
 
-        # send the output over the 'data' channel
-        print(f"[SERVER] Sending...")
-        send_all(data, file_list)
-        send_all(data, f'{self.directory}')
+    def reput(self, file_name: str, control: control_channel) -> None:
+        """
+        receives the rest of a file the server already has part of.
+        The server reports its partial size and the digests of its blocks, the
+        client sends everything from the first block that differs from its copy
+        and the checksum of what it sent, which the server checks
+        """
+        path = pathlib.Path(f'{self.directory}/{os.path.basename(file_name)}')
+        partial = path.stat().st_size if path.is_file() else 0
+        algorithm = self.resume_algorithm(control)
+        digests = list(checksum.block_digests(path, partial, algorithm))
+
+        # tell the client that the command is OK, how much is already here and what it is
+        control.send_reply('OK', str(partial), str(len(digests)), *digests)
+
+        if not 0 <= (offset := int(control.receive())) <= partial:
+            raise ValueError(f'cannot resume {path.name} ({partial} bytes) from byte {offset}')
+
+        data = self.open_data_channel(control)
+        digest = checksum.new(algorithm)
+
+        log.debug('[SERVER] Resuming [%s] from byte %s...', path.name, offset)
+        try:
+            # append mode keeps the part that matched, truncate drops anything past it
+            with open(path, "ab") as fp:
+                fp.truncate(offset)
+                receive_stream(data, fp, digest=digest)
+            expected = receive_all(data)
+        except (ValueError, ConnectionError) as error:
+            log.error('[SERVER ERROR] [%s] %s', path.name, error)
+            self.close_data_channel(control, data, broken=True)
+            return
+        finally:
+            self.changed(path.name)
+
+        self.close_data_channel(control, data)
+
+        if expected != digest.hexdigest():
+            # the next reput sends the blocks that differ again
+            control.send_reply('ERR', f'{path.name} does not match the client\'s copy after resuming, reput it again')
+            log.error('[SERVER ERROR] [%s] does not match %s', path.name, expected)
+            return
+
+        control.send_reply('OK')
+        log.info('[SERVER] [%s] has been written to %s', path.name, self.directory)
+
+    def dget(self, file_name: str, control: control_channel) -> None:
+        """
+        sends a file as a delta against the client's copy.
+        The client sends the signatures of its blocks, the server answers with
+        block references and the bytes the client does not have
+        """
+        path = pathlib.Path(f'{self.directory}/{file_name}')
+
+        # check if the file exists
+        if not self.index.is_file(file_name):
+            err_msg = (
+                f'{file_name} does not exist. Path = {self.directory}'
+            )
+            control.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
+
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+
+        block_size = int(receive_all(data))
+        table = delta.load_signature(iter_chunks(data))
+
+        log.debug('[SERVER] Sending the delta of [%s]...', file_name)
+        bytes_sent = send_chunks(data, delta.delta(path, table, block_size))
+
+        self.close_data_channel(control, data)
+        control.send(hash_file(path))
+
+        log.info('[SERVER] [%s] has been sent in %s bytes!', file_name, bytes_sent)
+
+    def dput(self, file_name: str, control: control_channel) -> None:
+        """
+        receives a file as a delta against the server's copy.
+        The server sends the signatures of its blocks and rebuilds the file
+        from them and the client's delta next to the old copy, which is only
+        replaced once the client's hash matches
+        """
+        path = pathlib.Path(f'{self.directory}/{os.path.basename(file_name)}')
+
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+
+        block_size = delta.block_size_for(path.stat().st_size if path.is_file() else 0)
+        send_all(data, str(block_size))
+        send_chunks(data, delta.signature(path, block_size))
+
+        # named like every other upload in progress, so no listing or index shows it
+        fd, temporary = create_temporary(path)
+        try:
+            try:
+                with open(fd, "wb") as fp, (
+                        open(path, "rb") if path.is_file() else contextlib.nullcontext()) as basis:
+                    copied, literal = delta.patch(basis, iter_chunks(data), block_size, fp)
+            except (ValueError, ConnectionError) as error:
+                log.error('[SERVER ERROR] [%s] %s', path.name, error)
+                self.close_data_channel(control, data, broken=True)
+                return
+
+            self.close_data_channel(control, data)
+
+            if (digest := control.receive()) != hash_file(temporary):
+                control.send_reply('ERR', f'{path.name} does not match the client\'s copy after patching, put it again')
+                log.error('[SERVER ERROR] [%s] does not match %s', path.name, digest)
+                return
+
+            os.replace(temporary, path)
+        finally:
+            # the patched file is thrown away unless it replaced the old copy
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+        self.changed(path.name)
+        control.send_reply('OK')
+        log.info('[SERVER] [%s] has been written to %s, %s bytes reused and %s bytes received',
+                 path.name, self.directory, copied, literal)
+
+    def zget(self, file_name: str, offered: typing.List[str], control: control_channel) -> None:
+        """
+        sends a file compressed with the first codec the client offered.
+        Files that are compressed already are sent as they are
+        """
+        path = pathlib.Path(f'{self.directory}/{file_name}')
+
+        # check if the file exists
+        if not self.index.is_file(file_name):
+            err_msg = (
+                f'{file_name} does not exist. Path = {self.directory}'
+            )
+            control.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
 
-        print('[SERVER] File list has been sent!')
+        # tell the client that the command is OK and which codec was picked
+        codec = compression.choose_codec(offered, path)
+        data = self.open_data_channel(control, 'OK', codec)
+
+        log.debug('[SERVER] Sending [%s] with %s...', file_name, codec)
+        with open(path, "rb") as fp:
+            bytes_sent = send_chunks(data, compression.compress_chunks(fp, codec))
+
+        self.close_data_channel(control, data)
+        log.info('[SERVER] [%s] has been sent in %s bytes!', file_name, bytes_sent)
+
+    def zput(self, file_name: str, offered: typing.List[str], control: control_channel) -> None:
+        """receives a file compressed with the first codec the client offered"""
+        path = pathlib.Path(f'{self.directory}/{os.path.basename(file_name)}')
+
+        # tell the client that the command is OK and which codec was picked
+        codec = compression.first_supported(offered)
+        data = self.open_data_channel(control, 'OK', codec)
+
+        log.debug('[SERVER] Writing [%s] compressed with %s...', path.name, codec)
+        try:
+            with open(path, "wb") as fp:
+                for chunk in compression.decompress_chunks(iter_chunks(data), codec):
+                    fp.write(chunk)
+        except compression.DECODE_ERRORS as error:
+            log.error('[SERVER ERROR] [%s] %s', path.name, error)
+            self.close_data_channel(control, data, broken=True)
+            return
+        finally:
+            self.changed(path.name)
+
+        self.close_data_channel(control, data)
+        log.info('[SERVER] [%s] has been written to %s', path.name, self.directory)
+
+    def mget(self, patterns: typing.List[str], control: control_channel) -> None:
+        """
+        sends every file matching the patterns to the client.
+        Each result is an 'OK' and the file name over 'control' followed by
+        the file over 'data', or an error for a pattern that matched nothing
+        """
+        files = sorted(self.index.files())
+        results: typing.List[typing.Tuple[str, typing.Optional[str]]] = []
+
+        for pattern in patterns:
+            if not (matches := fnmatch.filter(files, pattern)):
+                results.append((pattern, f'{pattern} does not match any file. Path = {self.directory}'))
+            results.extend((file_name, None) for file_name in matches)
+
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+        control.send(str(len(results)))
+
+        for file_name, err_msg in results:
+            if err_msg is None:
+                try:
+                    body = self.open_served(file_name)
+                except OSError as error:
+                    err_msg = f'{file_name} could not be read: {error.strerror}'
+
+            if err_msg is not None:
+                control.send_reply('ERR', err_msg)
+                log.info(err_msg)
+                continue
+
+            control.send_reply('OK', file_name)
+            self.send_served(data, body, self.new_digest(control))
+
+            log.info('[SERVER] [%s] has been sent!', file_name)
+
+        self.close_data_channel(control, data)
+
+    def mput(self, file_names: typing.List[str], control: control_channel) -> None:
+        """
+        receives the files from the client, one after the other.
+        The client sends them all without waiting, the server answers each
+        with an 'OK' or an error over 'control'
+        """
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+        broken = False
+
+        for file_name in map(os.path.basename, file_names):
+            if broken:
+                control.send_reply('ERR', f'{file_name} was not received, the data channel was closed')
+                continue
+
+            try:
+                receive_file(data, pathlib.Path(f'{self.directory}/{file_name}'), self.fsync,
+                             self.new_digest(control))
+            except checksum.mismatch as error:
+                # the body and its checksum were read, the channel is still in step
+                control.send_reply('ERR', str(error))
+                log.error('[SERVER ERROR] [%s] %s', file_name, error)
+                continue
+            except (ValueError, OSError) as error:
+                broken = True
+                control.send_reply('ERR', f'{file_name} was not received: {error}')
+                log.error('[SERVER ERROR] [%s] %s', file_name, error)
+                continue
+            finally:
+                self.changed(file_name)
+
+            control.send_reply('OK')
+            log.info('[SERVER] [%s] has been written to %s', file_name, self.directory)
+
+        self.close_data_channel(control, data, broken=broken)
+
+    def rget(self, directory_name: str, control: control_channel) -> None:
+        """sends a directory and everything under it as one tar stream"""
+        directory_name = os.path.basename(os.path.normpath(directory_name))
+
+        # check if the directory exists
+        if (entry := self.index.lookup(directory_name)) is None or entry['type'] != 'dir':
+            err_msg = (
+                f'{directory_name} is not a directory. Path = {self.directory}'
+            )
+            control.send_reply('ERR', err_msg)
+            log.info(err_msg)
+            return
+
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+
+        log.debug('[SERVER] Sending [%s] from %s...', directory_name, self.directory)
+        counts: typing.Dict[str, int] = {}
+        bytes_sent = send_chunks(data, archive.tree_chunks(self.directory / directory_name, counts))
+
+        self.close_data_channel(control, data)
+        log.info('[SERVER] [%s] has been sent, %s files in %s directories and %s bytes!',
+                 directory_name, counts['files'], counts['directories'], bytes_sent)
+
+    def rput(self, directory_name: str, control: control_channel) -> None:
+        """
+        receives a directory and everything under it as one tar stream.
+        Every file is written in place as soon as it arrives
+        """
+        directory_name = os.path.basename(os.path.normpath(directory_name))
+
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+
+        log.debug('[SERVER] Writing [%s]...', directory_name)
+        try:
+            counts = archive.extract_chunks(iter_chunks(data), self.directory, directory_name)
+        except (OSError, ValueError) as error:
+            log.error('[SERVER ERROR] [%s] %s', directory_name, error)
+            self.close_data_channel(control, data, broken=True)
+            control.send_reply('ERR', f'{directory_name} was not received: {error}')
+            return
+        finally:
+            self.changed(directory_name)
+
+        self.close_data_channel(control, data)
+        control.send_reply('OK')
+        log.info('[SERVER] [%s] has been written to %s, %s files in %s directories',
+                 directory_name, self.directory, counts['files'], counts['directories'])
+
+    def ls(self, pattern: str, control: control_channel) -> None:
+        """
+        lists the files located at the server whose name matches pattern.
+        The entries are streamed as pages of JSON lines
+        """
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+
+        # our filesystem we have access to is /tmp/build , assuming linux
+        log.debug('[SERVER] Sending the file list of %s...', self.directory)
+        send_chunks(data, listing.pages(self.index.scan(pattern)))
+
+        log.info('[SERVER] File list has been sent!')
 
         # close the 'data' channel
-        data.close()
-        data_socket.close()
+        self.close_data_channel(control, data)
+
+    def sync(self, control: control_channel) -> None:
+        """
+        sends the manifest of the served files so the client can send only
+        the files that are new or changed
+        """
+        # tell the client that the command is OK
+        data = self.open_data_channel(control, 'OK')
+
+        # one JSON object per line: name, size, mtime and hash
+        log.debug('[SERVER] Building the manifest of %s', self.directory)
+        manifest = self.hashes.manifest()
+        send_all(data, '\n'.join(json.dumps(item) for item in manifest))
+
+        log.info('[SERVER] Manifest of %s files has been sent!', len(manifest))
+        self.close_data_channel(control, data)
+
+    def persist(self, control: control_channel) -> None:
+        """opens a 'data' channel that stays open for the rest of the session"""
+        session = self.sessions[control]
+
+        if session.data is not None:
+            control.send_reply('ERR', 'The data channel is already persistent')
+            return
+
+        # tell the client that the command is OK,
+        # transfers are framed by their size, so they can follow each other on one connection
+        session.data = self.accept_data_channel(control, 'OK')
+        log.info('[SERVER] %s keeps its data channel open', session)
+
+    def negotiate(self, control: control_channel) -> None:
+        """
+        agrees on a version of the control protocol.
+        The server offers the newest version it speaks and the client answers
+        with the one it picked, everything after that is in the new version
+        """
+        control.send_reply('OK', str(VERSION))
+
+        if not 1 <= (version := int(control.receive())) <= VERSION:
+            raise ValueError(f'the client picked version {version}, expected 1 to {VERSION}')
+        control.version = version
+
+        log.info('[SERVER] %s speaks version %s of the protocol', self.sessions[control], version)
+
+    def noop(self, control: control_channel) -> None:
+        """answers a health check, nothing else happens"""
+        control.send_reply('OK')
+
+    def choose_checksum(self, offered: typing.List[str], control: control_channel) -> None:
+        """
+        agrees on the checksum of the session's transfers, the first offered algorithm
+        the server supports, or none to stop checking them
+        """
+        session = self.sessions[control]
+        session.checksum = None if (name := checksum.first_supported(offered)) == 'none' else name
+        control.send_reply('OK', name)
+
+        log.info('[SERVER] %s checks its transfers with %s', session, name)
+
+    def prioritize(self, priority: str, control: control_channel) -> None:
+        """
+        sets the priority of the session's transfers.
+        Under a global limit a transfer's share of it grows with its priority
+        """
+        if not priority.isdigit() or int(priority) not in PRIORITIES:
+            control.send_reply('ERR', f'The priority should be {PRIORITIES.start} to {PRIORITIES.stop - 1}, received {priority}')
+            return
+
+        session = self.sessions[control]
+        session.priority = int(priority)
+        control.send_reply('OK')
+        log.info('[SERVER] %s transfers at priority %s', session, session.priority)
 
     def __del__(self):
         """clean up the object once we're done"""
         # close port
         self.welcome_sock.close()
-        print(f"deleting object at {self}")
+        log.debug('deleting object at %s', self)
 
-    def parse_args(self, socket: socket.socket, command: int) -> typing.Callable:
+    def parse_args(self, control: control_channel, command: int) -> typing.Callable:
         def empty(): return None  # void function
 
         # get
         if command == 1:
-            file_name = receive_all(socket)
+            file_name = control.receive()
+
+            return functools.partial(self.get, file_name, control)
 
-            return functools.partial(self.get, file_name, socket)
+        # parallel get
+        if command == 8:
+            file_name = control.receive()
+            connections = int(control.receive())
+
+            return functools.partial(self.pget, file_name, connections, control)
 
         # put
         if command == 2:
-            file_name = receive_all(socket)
+            file_name = control.receive()
 
-            return functools.partial(self.put, file_name, socket)
+            return functools.partial(self.put, file_name, control)
 
-        # ls
+        # ls, without an argument as version 1 clients have always sent it
         if command == 3:
-            return functools.partial(self.ls, socket)
+            return functools.partial(self.ls, '*', control)
+
+        # ls of the names matching a pattern
+        if command == 22:
+            pattern = control.receive()
+
+            return functools.partial(self.ls, pattern, control)
+
+        # persistent data channel
+        if command == 5:
+            return functools.partial(self.persist, control)
+
+        # resumed get
+        if command == 9:
+            file_name = control.receive()
+            offset = int(control.receive())
+
+            return functools.partial(self.reget, file_name, offset, control)
+
+        # resumed put
+        if command == 10:
+            file_name = control.receive()
+
+            return functools.partial(self.reput, file_name, control)
+
+        # delta get
+        if command == 12:
+            file_name = control.receive()
+
+            return functools.partial(self.dget, file_name, control)
+
+        # delta put
+        if command == 13:
+            file_name = control.receive()
+
+            return functools.partial(self.dput, file_name, control)
+
+        # compressed get
+        if command == 14:
+            file_name = control.receive()
+            offered = control.receive().split(',')
+
+            return functools.partial(self.zget, file_name, offered, control)
+
+        # compressed put
+        if command == 15:
+            file_name = control.receive()
+            offered = control.receive().split(',')
+
+            return functools.partial(self.zput, file_name, offered, control)
+
+        # recursive get
+        if command == 16:
+            directory_name = control.receive()
+
+            return functools.partial(self.rget, directory_name, control)
+
+        # recursive put
+        if command == 17:
+            directory_name = control.receive()
+
+            return functools.partial(self.rput, directory_name, control)
+
+        # mget
+        if command == 6:
+            patterns = control.receive_list()
+
+            return functools.partial(self.mget, patterns, control)
+
+        # mput
+        if command == 7:
+            file_names = control.receive_list()
+
+            return functools.partial(self.mput, file_names, control)
+
+        # sync
+        if command == 11:
+            return functools.partial(self.sync, control)
+
+        # protocol version, without arguments so that
+        # servers that do not know the command stay in step
+        if command == 18:
+            return functools.partial(self.negotiate, control)
+
+        # noop, lets clients check that an idle session is still alive
+        if command == 19:
+            return functools.partial(self.noop, control)
+
+        # priority
+        if command == 20:
+            priority = control.receive()
+
+            return functools.partial(self.prioritize, priority, control)
+
+        # checksum of the transfers
+        if command == 21:
+            offered = control.receive().split(',')
+
+            return functools.partial(self.choose_checksum, offered, control)
 
         # quit
         if command == 4:
-            socket.close()
+            control.socket.close()
             del self
         else:
             err_msg = 'Unknown command. Type \'help\' for the command list'
-            send_err(socket, err_msg)
+            control.send_reply('ERR', err_msg)
             return empty
 
+    def handle(self, control_sock: socket.socket, addr: typing.Tuple[str, int]) -> None:
+        """receives and executes commands from one client until it quits"""
+        session = ftp_session(no_delay(control_sock), addr)
+        session.bucket = self.throttle.client_bucket()
+        control = control_channel(control_sock)
+        with self.sessions_lock:
+            self.sessions[control] = session
+
+        try:
+            while not self.stopping.is_set():
+                log.debug('Waiting for commands from client...')
+
+                # command should be an integer.
+                # anything else means the client has hung up
+                try:
+                    command_code = int(control.receive())
+                except (ValueError, OSError):
+                    log.info('[INFO] Attempting to exit gracefully....')
+                    break
+
+                log.debug('received command code %s from %s', command_code, session)
+                session.commands += 1
+                session.measurement = metrics.measurement(COMMANDS.get(command_code, 'unknown'))
+                control.status = None
+                outcome = 'failed'
+
+                # each command is parsed  into a function that is invoked here
+                # it will break when self becomes None after deletion
+                try:
+                    self.parse_args(control, command_code)()
+                    outcome = 'refused' if control.status == 'ERR' else 'ok'
+                except TypeError:
+                    outcome = 'ok'
+                    break
+                except (OSError, ValueError) as error:
+                    log.error('[SERVER ERROR] %s %s', session, error)
+                    break
+                finally:
+                    metrics.default.finish(session.measurement, outcome)
+                    session.measurement = None
+        finally:
+            with self.sessions_lock:
+                del self.sessions[control]
+            session.close()
+
     def loop(self):
-        """receives and executes commands on loop"""
+        """serves a single client until it quits"""
         self.welcome_sock.listen(1)
 
-        print('Waiting for the client to connect...')
+        log.debug('Waiting for the client to connect...')
         control_sock, addr = self.welcome_sock.accept()
 
-        print(f'Accepted connection from client {addr}')
+        log.info('Accepted connection from client %s', addr)
+        self.handle(control_sock, addr)
 
-        while True:
-            print('Waiting for commands from client...')
+    def serve(self) -> None:
+        """
+        Serves many clients at once until shutdown() or Ctrl-C.
+        Each client is handled by a bounded pool of worker threads,
+        clients past max_connections wait in the listen backlog
+        """
+        self.welcome_sock.listen(self.backlog)
+        slots = threading.BoundedSemaphore(self.max_connections)
 
-            # command should be an integer.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_connections, thread_name_prefix='session') as pool:
             try:
-                command_code = int(receive_all(control_sock))
-            except ValueError:
-                print("[INFO] Attempting to exit gracefully....")
+                while not self.stopping.is_set():
+                    log.debug('Waiting for clients to connect (%s connected)...', len(self.sessions))
+                    slots.acquire()
 
-            print(f'received command code {command_code}')
+                    try:
+                        control_sock, addr = self.welcome_sock.accept()
+                    except OSError:
+                        # the welcome socket was closed by shutdown()
+                        slots.release()
+                        break
 
-            # each command is parsed  into a function that is invoked here
-            # it will break when self becomes None after deletion
-            try:
-                self.parse_args(control_sock, command_code)()
-            except TypeError:
-                break
+                    log.info('Accepted connection from client %s', addr)
+                    pool.submit(self.handle, control_sock, addr).add_done_callback(
+                        lambda _: slots.release())
+            except KeyboardInterrupt:
+                log.info('[INFO] Attempting to exit gracefully....')
+            finally:
+                # in-flight commands finish before the pool is joined
+                self.shutdown()
+
+    def shutdown(self) -> None:
+        """stops accepting clients and disconnects the connected ones"""
+        self.stopping.set()
+        self.index.close()
+        self.throttle.close()
+
+        try:
+            # wakes up a thread blocked in accept()
+            self.welcome_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.welcome_sock.close()
+
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.disconnect()
 
 
 def main(argv: typing.List[str] = ["server.py", "1234"]):
     if not(argv):
         argv = sys.argv
-    if len(argv) != 2:
-        print(
-            f'Usage: python {argv[0]} <Server Port>')
 
-    server_port = argv[1]
+    parser = argparse.ArgumentParser(prog=f'python {argv[0]}')
+    parser.add_argument('server_port', metavar='<Server Port>')
+    parser.add_argument('--directory', type=pathlib.Path, default=pathlib.Path(f'{tempfile.gettempdir()}/build'),
+                        help='directory of the served files, created if it does not exist')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='serve many clients at once instead of a single session')
+    parser.add_argument('--max-connections', type=int,
+                        help='clients served at once in concurrent mode (16) or per events worker (10000)')
+    parser.add_argument('--backlog', type=int,
+                        help='connections queued by the kernel while the server is busy (16, 1024 for events)')
+    parser.add_argument('--engine', choices=('threads', 'events'), default='threads',
+                        help='a thread per client, or one non-blocking selectors loop per process')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes of the events engine, all listening on the port with SO_REUSEPORT')
+    parser.add_argument('--idle-timeout', type=float, default=300.0,
+                        help='seconds the events engine keeps a session without commands')
+    parser.add_argument('--stall-timeout', type=float, default=30.0,
+                        help='seconds the events engine keeps a transfer that stopped moving')
+    parser.add_argument('--index-entries', type=int, default=100_000,
+                        help='most directory entries kept in the in-memory index')
+    parser.add_argument('--index-interval', type=float, default=1.0,
+                        help='seconds between checks for changes made to the directory by others')
+    parser.add_argument('--transfer-rate', type=parse_rate, default=0,
+                        help='bytes per second of each transfer, e.g. 500K or 10M, 0 for no limit')
+    parser.add_argument('--client-rate', type=parse_rate, default=0,
+                        help='bytes per second of all the transfers of one client')
+    parser.add_argument('--total-rate', type=parse_rate, default=0,
+                        help='bytes per second of the whole server, shared fairly by priority')
+    parser.add_argument('--limits', metavar='FILE',
+                        help='JSON file with the transfer, client and total rates, applied whenever it changes')
+    parser.add_argument('--fsync', action='store_true',
+                        help='flush every uploaded file to the disk before it replaces the old one')
+    parser.add_argument('--cache-size', type=parse_rate, default=64 << 20,
+                        help='bytes of small files kept in memory, e.g. 64M, 0 to always read from the disk')
+    parser.add_argument('--cache-file-size', type=parse_rate, default=256 << 10,
+                        help='largest file kept in the cache, e.g. 256K')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info',
+                        help='least important messages printed, debug traces every command')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--json-log', metavar='FILE',
+                        help='append one JSON line per command to FILE, - for standard output')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(format='%(message)s', stream=sys.stdout, level=LOG_LEVELS[args.log_level])
+
+    server_port = args.server_port
     try:
         if((server_port := int(server_port)) < 0):
             print(
@@ -228,8 +1084,71 @@ def main(argv: typing.List[str] = ["server.py", "1234"]):
             f'[ERROR] Port should be number, received {server_port} of type {type(server_port)}')
         return
 
-    server = ftp_server(server_port=server_port)
-    server.loop()
+    events = args.engine == 'events'
+    if args.max_connections is None:
+        args.max_connections = 10_000 if events else 16
+    if args.backlog is None:
+        args.backlog = 1024 if events else 16
+
+    if args.max_connections < 1 or args.backlog < 0:
+        print(
+            f'[ERROR] Expected at least 1 connection and a non-negative backlog, received {args.max_connections} and {args.backlog}')
+        return
+
+    if args.index_entries < 0 or args.index_interval <= 0:
+        print(
+            f'[ERROR] Expected a non-negative index size and a positive interval, received {args.index_entries} and {args.index_interval}')
+        return
+
+    if events and (args.transfer_rate or args.client_rate or args.total_rate or args.limits):
+        print('[ERROR] The events engine does not limit bandwidth, use --engine threads')
+        return
+
+    if args.workers < 1 or args.workers > 1 and (not events or not server_port or args.metrics_port is not None):
+        print(
+            f'[ERROR] Expected 1 worker, or more with --engine events on a fixed port and without --metrics-port, received {args.workers}')
+        return
+
+    if args.idle_timeout <= 0 or args.stall_timeout <= 0:
+        print(
+            f'[ERROR] Expected positive timeouts, received {args.idle_timeout} and {args.stall_timeout}')
+        return
+
+    options = dict(server_port=server_port,
+                   directory=args.directory,
+                   max_connections=args.max_connections, backlog=args.backlog,
+                   index_entries=args.index_entries, index_interval=args.index_interval,
+                   fsync=args.fsync,
+                   cache_bytes=int(args.cache_size), cache_file_size=int(args.cache_file_size))
+    if args.json_log:
+        metrics.default.json_log = sys.stdout if args.json_log == '-' else open(args.json_log, 'a')
+
+    if events:
+        # the engine builds on ftp_server, so it is only imported once this module is
+        from SockMonkey.Domain.Server.event_server import event_server, serve_workers
+
+        options.update(idle_timeout=args.idle_timeout, stall_timeout=args.stall_timeout)
+        if args.workers > 1:
+            print(f'[INFO] Serving port {server_port} from {args.workers} worker processes')
+            serve_workers(args.workers, **options)
+            print('DONE')
+            return
+        server = event_server(**options)
+    else:
+        server = ftp_server(**options, transfer_rate=args.transfer_rate, client_rate=args.client_rate,
+                            total_rate=args.total_rate)
+
+    if args.limits:
+        server.throttle.watch(args.limits)
+    if args.metrics_port is not None:
+        metrics.default.serve(args.metrics_port)
+        print(f'[INFO] Metrics at http://127.0.0.1:{args.metrics_port}/metrics')
+    if args.concurrent or events:
+        server.serve()
+    else:
+        server.loop()
+    print(f'[INFO] Directory index: {server.index.counters()}')
+    print(f'[INFO] Content cache: {server.cache.counters()}')
     print('DONE')
 
 
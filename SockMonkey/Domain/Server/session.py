@@ -0,0 +1,56 @@
+"""
+Per-connection state kept by the ftp server
+Each control connection gets its own session, so concurrent clients never share state
+"""
+
+import itertools
+import socket
+import time
+import typing
+
+from SockMonkey.Domain.Server.metrics import measurement
+from SockMonkey.Domain.Server.throttle import token_bucket
+
+
+class ftp_session:
+    # sessions are numbered in the order they are accepted
+    _identifiers = itertools.count(1)
+
+    def __init__(self, control: socket.socket, address: typing.Tuple[str, int]):
+        self.identifier = next(ftp_session._identifiers)
+        self.control = control
+        self.address = address
+        self.opened = time.monotonic()
+        self.commands = 0
+        # the 'data' channel kept open between transfers in persistent mode
+        self.data: typing.Optional[socket.socket] = None
+        # the bandwidth limit shared by the session's transfers and their share of the global one
+        self.bucket: typing.Optional[token_bucket] = None
+        self.priority = 1
+        # the checksum algorithm of the session's transfers, None until one is agreed on
+        self.checksum: typing.Optional[str] = None
+        # the command being run, measured for the metrics
+        self.measurement: typing.Optional[measurement] = None
+
+    def __repr__(self) -> str:
+        return f'ftp_session({self.identifier}, {self.address})'
+
+    def disconnect(self) -> None:
+        """
+        Wakes up a handler blocked on the control channel.
+        The handler sees the channel close once its current command finishes
+        """
+        try:
+            self.control.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # the client already hung up
+            pass
+
+    def close(self) -> None:
+        """terminates the control connection and any persistent 'data' channel"""
+        self.disconnect()
+        self.control.close()
+
+        if self.data is not None:
+            self.data.close()
+            self.data = None
@@ -0,0 +1,54 @@
+"""
+Reports the throughput against ratio trade-off of every compression codec
+Each codec streams the corpus through compress_chunks and back through
+decompress_chunks, the way a transfer does. The corpus file is repeated up to
+the requested size with its lines shuffled in every copy, so codecs with a
+large window do not simply match whole copies
+
+Usage: python -m benchmarks.compression [size in MB] [corpus file]
+"""
+
+import io
+import random
+import sys
+import time
+import typing
+
+from SockMonkey.Domain.Client import compression
+
+
+def main(argv: typing.List[str] = ["compression.py"]):
+    if not(argv):
+        argv = sys.argv
+    megabytes = int(argv[1]) if len(argv) > 1 else 16
+    corpus_path = argv[2] if len(argv) > 2 else 'united_states_constitution.txt'
+
+    with open(corpus_path, "rb") as fp:
+        lines = fp.readlines()
+
+    rng = random.Random(471)
+    corpus = bytearray()
+    while len(corpus) < megabytes * 2 ** 20:
+        corpus += b''.join(rng.sample(lines, len(lines)))
+    corpus = bytes(corpus[:megabytes * 2 ** 20])
+
+    print(f'{megabytes} MB of {corpus_path}, '
+          f'{compression.entropy(corpus[:compression.CHUNK_SIZE]):.2f} bits per byte, '
+          f'auto codec: {compression.choose_codec(list(compression.CODECS), corpus_path)}')
+    print(f'{"codec":>6}{"ratio":>8}{"compress MB/s":>15}{"decompress MB/s":>17}')
+
+    for codec in ['none', *compression.CODECS]:
+        start = time.perf_counter()
+        compressed = list(compression.compress_chunks(io.BytesIO(corpus), codec))
+        compressed_at = time.perf_counter()
+        size = sum(len(chunk) for chunk in compression.decompress_chunks(compressed, codec))
+        decompressed_at = time.perf_counter()
+
+        assert size == len(corpus)
+        print(f'{codec:>6}{len(corpus) / sum(map(len, compressed)):>7.1f}x'
+              f'{megabytes / (compressed_at - start):>15.1f}'
+              f'{megabytes / (decompressed_at - compressed_at):>17.1f}')
+
+
+if __name__ == '__main__':
+    main([])
@@ -0,0 +1,73 @@
+"""
+Measures the block level delta on synthetic files with a controlled share of edits
+The edits are scattered 512 byte overwrites. Wire bytes count the receiver's
+signatures plus the sender's ops, against sending the whole file
+
+Usage: python -m benchmarks.delta_sync [size in MB] [percent edited ...]
+"""
+
+import io
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import typing
+
+from SockMonkey.Domain.Client import delta
+
+# size of every synthetic edit
+EDIT_SIZE = 512
+
+
+def edit(data: bytearray, percent: float, rng: random.Random) -> bytearray:
+    """overwrites scattered runs of EDIT_SIZE bytes until percent of the file changed"""
+    edited = bytearray(data)
+    for _ in range(int(len(data) * percent / 100 / EDIT_SIZE)):
+        offset = rng.randrange(0, len(data) - EDIT_SIZE)
+        edited[offset:offset + EDIT_SIZE] = rng.randbytes(EDIT_SIZE)
+    return edited
+
+
+def main(argv: typing.List[str] = ["delta_sync.py"]):
+    if not(argv):
+        argv = sys.argv
+    megabytes = int(argv[1]) if len(argv) > 1 else 32
+    percents = list(map(float, argv[2:])) or [0, 0.1, 1, 10]
+
+    rng = random.Random(471)
+    workspace = pathlib.Path(tempfile.mkdtemp())
+    basis_path, new_path = workspace / 'basis.bin', workspace / 'new.bin'
+    basis = bytearray(rng.randbytes(megabytes * 2 ** 20))
+    basis_path.write_bytes(basis)
+    block_size = delta.block_size_for(len(basis))
+
+    print(f'{megabytes} MB, {block_size} byte blocks')
+    print(f'{"edited %":>9}{"wire MB":>10}{"of file":>9}{"signature s":>13}{"delta s":>9}{"patch s":>9}')
+
+    for percent in percents:
+        new_path.write_bytes(edit(basis, percent, rng))
+
+        start = time.perf_counter()
+        signatures = list(delta.signature(basis_path, block_size))
+        signed = time.perf_counter()
+        ops = list(delta.delta(new_path, delta.load_signature(signatures), block_size))
+        diffed = time.perf_counter()
+        rebuilt = io.BytesIO()
+        with open(basis_path, "rb") as fp:
+            delta.patch(fp, ops, block_size, rebuilt)
+        patched = time.perf_counter()
+
+        assert rebuilt.getvalue() == new_path.read_bytes()
+        wire = sum(map(len, signatures)) + sum(map(len, ops))
+        print(f'{percent:>9}{wire / 2 ** 20:>10.2f}{wire / len(basis):>8.1%}'
+              f'{signed - start:>13.2f}{diffed - signed:>9.2f}{patched - diffed:>9.2f}')
+
+    for path in (basis_path, new_path):
+        os.unlink(path)
+    workspace.rmdir()
+
+
+if __name__ == '__main__':
+    main([])
@@ -0,0 +1,53 @@
+"""
+A local TCP proxy that models a long fat network without tc
+Every chunk is held for the one-way delay before it is forwarded and each
+direction keeps at most one window in flight, so a single connection tops
+out at window / delay bytes per second, like TCP limited by its window
+"""
+
+import socket
+import threading
+import typing
+
+
+class latency_proxy:
+    def __init__(self, target: typing.Tuple[str, int], delay: float,
+                 window: int = 64 * 1024):
+        self.target = target
+        self.delay = delay
+        self.window = window
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.stopping = threading.Event()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        """forwards every accepted connection to the target"""
+        while not self.stopping.is_set():
+            try:
+                downstream, _ = self.listener.accept()
+            except OSError:
+                break
+            upstream = socket.create_connection(self.target)
+            for sock in (downstream, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.pump, args=(downstream, upstream), daemon=True).start()
+            threading.Thread(target=self.pump, args=(upstream, downstream), daemon=True).start()
+
+    def pump(self, source: socket.socket, destination: socket.socket) -> None:
+        """copies one direction of a connection, one delayed window at a time"""
+        try:
+            while data := source.recv(self.window):
+                self.stopping.wait(self.delay)
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        self.stopping.set()
+        self.listener.close()
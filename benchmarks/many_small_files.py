@@ -0,0 +1,73 @@
+"""
+Measures files per second when a tree of small files is uploaded
+with one put per file, with mput and with put -r
+
+Usage: python -m benchmarks.many_small_files [number of files] [file size in bytes]
+"""
+
+import contextlib
+import io
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+from SockMonkey.Domain.Client.cli import command_line_interface
+from SockMonkey.Domain.Server.server import ftp_server
+
+# files per sub-directory of the tree
+FILES_PER_DIRECTORY = 1000
+
+
+def main(argv: typing.List[str] = ["many_small_files.py"]):
+    if not(argv):
+        argv = sys.argv
+    count, size = (list(map(int, argv[1:3])) + [10000, 1024][len(argv[1:3]):])
+
+    server_dir = pathlib.Path(tempfile.mkdtemp())
+    client_dir = pathlib.Path(tempfile.mkdtemp())
+    tree = client_dir / 'tree'
+    for i in range(count):
+        directory = tree / f'{i // FILES_PER_DIRECTORY:04}'
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f'{i:06}.bin').write_bytes(os.urandom(size))
+    paths = sorted(str(path.relative_to(client_dir)) for path in tree.rglob('*.bin'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ftp_server(server_port=0, directory=server_dir)
+        # listening before the thread starts, the client may connect first
+        server.welcome_sock.listen(server.backlog)
+        threading.Thread(target=server.serve, daemon=True).start()
+        client = command_line_interface(server_port=server.welcome_sock.getsockname()[1],
+                                         directory=client_dir)
+
+    os.chdir(client_dir)
+    print(f'{count} files of {size} bytes')
+    print(f'{"method":>10}{"seconds":>10}{"files/s":>10}')
+
+    # put and mput flatten the tree, put -r keeps it
+    for method, upload in (('put', lambda: [client.put(path) for path in paths]),
+                           ('mput', lambda: client.run(client.client.send_files(paths))),
+                           ('put -r', lambda: client.rput('tree'))):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            upload()
+            elapsed = time.perf_counter() - start
+
+        print(f'{method:>10}{elapsed:>10.2f}{count / elapsed:>10.0f}')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        del client
+        server.shutdown()
+    assert len(list((server_dir / 'tree').rglob('*.bin'))) == count
+
+    for directory in (server_dir, client_dir):
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main([])
@@ -0,0 +1,82 @@
+"""
+Measures how a parallel get scales with the number of connections
+The client reaches the server through a latency_proxy, so every
+connection is limited by window / delay like a single TCP stream on a WAN link
+
+Usage: python -m benchmarks.parallel_get [size in MB] [one-way delay in ms]
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+from benchmarks.latency_proxy import latency_proxy
+from SockMonkey.Domain.Client.client import ftp_client
+from SockMonkey.Domain.Server.server import ftp_server
+
+
+class proxied_client(ftp_client):
+    """routes the control connection and every 'data' connection through latency proxies"""
+
+    def __init__(self, server_port: int, delay: float):
+        super().__init__(server_port=server_port)
+        self.delay = delay
+        self.proxies: typing.List[latency_proxy] = []
+
+    async def open_connection(self, port: int):
+        self.proxies.append(latency_proxy(('127.0.0.1', port), self.delay))
+        return await super().open_connection(self.proxies[-1].port)
+
+
+async def measure(server_port: int, delay: float, client_dir: pathlib.Path, megabytes: int) -> None:
+    """gets the payload over more and more connections"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        client = await proxied_client(server_port, delay).connect()
+
+    for connections in (1, 2, 4, 8, 16):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            await client.pget('payload.bin', connections)
+            elapsed = time.perf_counter() - start
+
+        assert (client_dir / 'payload.bin').stat().st_size == megabytes * 2 ** 20
+        print(f'{connections:>12}{elapsed:>10.2f}{megabytes / elapsed:>10.1f}')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        await client.close()
+
+
+def main(argv: typing.List[str] = ["parallel_get.py"]):
+    if not(argv):
+        argv = sys.argv
+    megabytes, delay_ms = (list(map(int, argv[1:3])) + [16, 10][len(argv[1:3]):])
+
+    server_dir = pathlib.Path(tempfile.mkdtemp())
+    client_dir = pathlib.Path(tempfile.mkdtemp())
+    (server_dir / 'payload.bin').write_bytes(os.urandom(megabytes * 2 ** 20))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ftp_server(server_port=0, directory=server_dir)
+        # listening before the thread starts, the client may connect first
+        server.welcome_sock.listen(server.backlog)
+        threading.Thread(target=server.serve, daemon=True).start()
+
+    os.chdir(client_dir)
+    print(f'{megabytes} MB with {delay_ms} ms of one-way delay')
+    print(f'{"connections":>12}{"seconds":>10}{"MB/s":>10}')
+
+    asyncio.run(measure(server.welcome_sock.getsockname()[1], delay_ms / 1000, client_dir, megabytes))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main([])
@@ -0,0 +1,71 @@
+"""
+Compares the receive engine against the original concatenating receive_bytes
+Both sides of a loopback socket pair live in this process, the sender runs on a thread
+
+Usage: python -m benchmarks.receive_bytes [size in MB ...]
+"""
+
+import socket
+import sys
+import threading
+import time
+import typing
+
+from SockMonkey.Domain.Client.helpers import iter_bytes, receive_bytes
+
+
+def legacy_receive_bytes(socket: socket.socket, buffer_size: int) -> str:
+    """receive_bytes as it was before the receive engine, kept for comparison"""
+    receiver_buffer: bytes = b''
+
+    while len(receiver_buffer) < buffer_size:
+        if not (t := socket.recv(buffer_size)):
+            break
+        receiver_buffer += t
+
+    return receiver_buffer.decode('utf-8')
+
+
+def drain(sock: socket.socket, size: int) -> None:
+    """consumes the payload with the streaming iterator, as a file writer would"""
+    for _ in iter_bytes(sock, size):
+        pass
+
+
+def measure(receiver: typing.Callable, size: int) -> float:
+    """sends size bytes over a socket pair and returns the receiver's MB/s"""
+    reader, writer = socket.socketpair()
+    payload = b'x' * size
+    sender = threading.Thread(target=writer.sendall, args=(payload,))
+
+    start = time.perf_counter()
+    sender.start()
+    receiver(reader, size)
+    elapsed = time.perf_counter() - start
+
+    sender.join()
+    reader.close()
+    writer.close()
+
+    return size / elapsed / 2 ** 20
+
+
+def main(argv: typing.List[str] = ["receive_bytes.py"]):
+    if not(argv):
+        argv = sys.argv
+    sizes = argv[1:] or ["1", "16", "64"]
+
+    engines = {
+        'legacy': legacy_receive_bytes,
+        'receive_bytes': receive_bytes,
+        'iter_bytes': drain,
+    }
+
+    print(f'{"MB":>6}' + ''.join(f'{name:>16}' for name in engines))
+    for megabytes in map(int, sizes):
+        rates = [measure(engine, megabytes * 2 ** 20) for engine in engines.values()]
+        print(f'{megabytes:>6}' + ''.join(f'{rate:>11.1f} MB/s' for rate in rates))
+
+
+if __name__ == '__main__':
+    main([])
@@ -0,0 +1,323 @@
+"""
+Reproducible benchmark suite of the protocol over loopback
+Starts a server in this process or as a subprocess, drives it with scripted
+clients and measures get and put throughput from 1 KB up to several GB,
+small files per second, ls latency on a large directory and how the total
+throughput scales with concurrent clients. The results are written to JSON,
+a run can be compared with an earlier one to catch regressions.
+With --delay every connection goes through a latency_proxy to model a WAN link
+
+Usage: python -m benchmarks.suite [--sizes 1K,1M,64M,4G] [--delay ms]
+                                  [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import pathlib
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+from benchmarks.parallel_get import proxied_client
+from SockMonkey.Domain.Client.client import ftp_client
+from SockMonkey.Domain.Client.throttle import parse_rate
+from SockMonkey.Domain.Server.server import ftp_server
+
+# payloads are written by repeating one random block, so even a 4 GB file is made quickly
+BLOCK_SIZE = 2 ** 20
+# the scenarios of a full run, in order
+SCENARIOS = ('throughput', 'small_files', 'ls', 'concurrency')
+
+# one measurement: scenario, name, value, unit and whether 'higher' or 'lower' is better
+result = typing.Dict[str, typing.Any]
+
+
+def parse_size(text: str) -> int:
+    """reads a size in bytes with an optional K, M or G suffix, like the bandwidth limits"""
+    return int(parse_rate(text))
+
+
+def write_payload(path: pathlib.Path, size: int, block: bytes) -> None:
+    """writes size bytes made of the same random block"""
+    with open(path, 'wb') as fp:
+        for start in range(0, size, len(block)):
+            fp.write(block[:size - start])
+
+
+def free_port() -> int:
+    """a loopback port nobody listens on right now"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class server_process:
+    """the server under test, in this process on a thread or as a subprocess"""
+
+    def __init__(self, directory: pathlib.Path, subprocess_mode: bool = False):
+        self.server: typing.Optional[ftp_server] = None
+        self.process: typing.Optional[subprocess.Popen] = None
+
+        if not subprocess_mode:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.server = ftp_server(server_port=0, directory=directory, max_connections=64, backlog=64)
+            # listening before the thread starts, the client may connect first
+            self.server.welcome_sock.listen(self.server.backlog)
+            threading.Thread(target=self.server.serve, daemon=True).start()
+            self.port = self.server.welcome_sock.getsockname()[1]
+            return
+
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [sys.executable, 'server.py', str(self.port), '--concurrent', '--directory', str(directory),
+             '--max-connections', '64', '--backlog', '64', '--log-level', 'off'],
+            cwd=pathlib.Path(__file__).resolve().parent.parent, stdout=subprocess.DEVNULL)
+
+        # the port is open once the server is ready
+        deadline = time.monotonic() + 10
+        while True:
+            with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', self.port), 0.1):
+                break
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f'the server did not start on port {self.port}')
+            time.sleep(0.05)
+
+    def close(self) -> None:
+        if self.server is not None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.server.shutdown()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+class suite:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.server_dir = pathlib.Path(tempfile.mkdtemp())
+        self.client_dir = pathlib.Path(tempfile.mkdtemp())
+        self.results: typing.List[result] = []
+        self.port = 0
+
+    def client(self) -> ftp_client:
+        """a new client, behind latency proxies when a delay was asked for"""
+        if self.args.delay:
+            return proxied_client(self.port, self.args.delay / 1000)
+        return ftp_client(server_port=self.port)
+
+    def record(self, scenario: str, name: str, value: float, unit: str, better: str = 'higher') -> None:
+        self.results.append({'scenario': scenario, 'name': name, 'value': value,
+                             'unit': unit, 'better': better})
+        print(f'{scenario:>12}  {name:<28}{value:>12.3f} {unit}')
+
+    def prepare(self) -> None:
+        """writes every file the scenarios need before the server indexes its directory"""
+        block = os.urandom(BLOCK_SIZE)
+        for size in self.args.sizes:
+            write_payload(self.client_dir / f'payload-{size}.bin', size, block)
+
+        small = self.client_dir / 'small'
+        small.mkdir()
+        for i in range(self.args.files):
+            (small / f'{i:06}.bin').write_bytes(os.urandom(self.args.file_size))
+
+        # the listing is made of empty files, only their number matters
+        for i in range(self.args.entries):
+            (self.server_dir / f'entry-{i:07}').touch()
+
+        write_payload(self.server_dir / 'shared.bin', self.args.shared_size, block)
+
+    async def timed(self, command: typing.Awaitable) -> float:
+        """the seconds a command took"""
+        start = time.perf_counter()
+        await command
+        return time.perf_counter() - start
+
+    async def throughput(self) -> None:
+        """put and get of one file at every size, the median of the repeats"""
+        async with self.client() as client:
+            for size in self.args.sizes:
+                name = f'payload-{size}.bin'
+                puts, gets = [], []
+
+                for _ in range(self.args.repeat):
+                    # the no-op returns once the server has written the whole file,
+                    # without it the last bytes could still sit in the socket buffers
+                    puts.append(await self.timed(self.put_and_wait(client, name)))
+                    gets.append(await self.timed(client.get(name)))
+
+                if (self.client_dir / name).stat().st_size != size:
+                    raise RuntimeError(f'{name} came back with the wrong size')
+
+                label = format_size(size)
+                self.record('throughput', f'put {label}', size / statistics.median(puts) / 2 ** 20, 'MB/s')
+                self.record('throughput', f'get {label}', size / statistics.median(gets) / 2 ** 20, 'MB/s')
+
+    async def put_and_wait(self, client: ftp_client, name: str) -> None:
+        await client.put(name)
+        await client.noop()
+
+    async def small_files(self) -> None:
+        """files per second of one put per file, mput and mget"""
+        paths = sorted(str(path.relative_to(self.client_dir)) for path in (self.client_dir / 'small').iterdir())
+        count = len(paths)
+
+        async with self.client() as client:
+            async def each() -> None:
+                for path in paths:
+                    await client.put(path)
+                await client.noop()
+
+            async def batch() -> None:
+                await client.send_files(paths)
+                await client.noop()
+
+            self.record('small_files', 'put per file', count / await self.timed(each()), 'files/s')
+            self.record('small_files', 'mput', count / await self.timed(batch()), 'files/s')
+            os.chdir(self.client_dir / 'small')
+            try:
+                self.record('small_files', 'mget', count / await self.timed(client.mget(['0*.bin'])), 'files/s')
+            finally:
+                os.chdir(self.client_dir)
+
+    async def ls(self) -> None:
+        """latency of listing the whole directory and of a pattern matching a single entry"""
+        async with self.client() as client:
+            for name, pattern in (('ls all', '*'), ('ls one', 'entry-0000001')):
+                seconds = [await self.timed(client.ls(pattern)) for _ in range(self.args.repeat * 3)]
+                self.record('ls', f'{name} median', statistics.median(seconds) * 1000, 'ms', 'lower')
+                self.record('ls', f'{name} worst', max(seconds) * 1000, 'ms', 'lower')
+
+    async def concurrency(self) -> None:
+        """total get throughput of 1, 2, 4... clients fetching the same file at once"""
+        for count in self.args.clients:
+            clients = [await self.client().connect() for _ in range(count)]
+            try:
+                # every client writes the same local file, only the time counts here
+                start = time.perf_counter()
+                await asyncio.gather(*(client.get('shared.bin') for client in clients))
+                elapsed = time.perf_counter() - start
+            finally:
+                await asyncio.gather(*(client.close() for client in clients))
+
+            total = count * self.args.shared_size / elapsed / 2 ** 20
+            self.record('concurrency', f'{count} clients', total, 'MB/s')
+
+    async def run(self) -> None:
+        for scenario in self.args.scenarios:
+            await getattr(self, scenario)()
+
+
+def format_size(size: int) -> str:
+    for unit in ('G', 'M', 'K'):
+        if size >= (scale := 1024 ** ' KMG'.index(unit)) and size % scale == 0:
+            return f'{size // scale}{unit}'
+    return f'{size}B'
+
+
+def compare(results: typing.List[result], baseline: typing.List[result],
+            tolerance: float) -> typing.List[str]:
+    """
+    the measurements that got worse than the baseline by more than tolerance percent
+    @return - one line per regression
+    """
+    previous = {(entry['scenario'], entry['name']): entry for entry in baseline}
+    regressions = []
+
+    for entry in results:
+        if not (before := previous.get((entry['scenario'], entry['name']))) or not before['value']:
+            continue
+
+        change = (entry['value'] - before['value']) / before['value'] * 100
+        if entry['better'] == 'lower':
+            change = -change
+        if change < -tolerance:
+            regressions.append(f'{entry["scenario"]} {entry["name"]}: {before["value"]:.3f} -> '
+                               f'{entry["value"]:.3f} {entry["unit"]} ({change:+.1f}%)')
+
+    return regressions
+
+
+def main(argv: typing.List[str] = ["suite.py"]):
+    if not(argv):
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite')
+    parser.add_argument('--scenarios', type=lambda text: text.split(','), default=list(SCENARIOS),
+                        help=f'comma separated scenarios to run, of {",".join(SCENARIOS)}')
+    parser.add_argument('--sizes', type=lambda text: [parse_size(size) for size in text.split(',')],
+                        default='1K,64K,1M,16M,64M',
+                        help='comma separated file sizes of the throughput scenario, up to e.g. 4G')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every measurement, the median is kept')
+    parser.add_argument('--files', type=int, default=1000, help='number of small files')
+    parser.add_argument('--file-size', type=parse_size, default='1K', help='size of every small file')
+    parser.add_argument('--entries', type=int, default=50_000, help='entries of the directory listed by ls')
+    parser.add_argument('--clients', type=lambda text: [int(count) for count in text.split(',')],
+                        default='1,2,4,8,16', help='comma separated numbers of concurrent clients')
+    parser.add_argument('--shared-size', type=parse_size, default='16M',
+                        help='size of the file every concurrent client gets')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='one-way delay in ms added by a local proxy to every connection')
+    parser.add_argument('--subprocess', action='store_true',
+                        help='run the server as a separate process instead of a thread of this one')
+    parser.add_argument('--output', default='benchmark-results.json', help='where the results are written')
+    parser.add_argument('--compare', metavar='BASELINE', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=10,
+                        help='percent a measurement may get worse than the baseline before it is reported')
+    args = parser.parse_args(argv[1:])
+
+    if unknown := set(args.scenarios) - set(SCENARIOS):
+        parser.error(f'unknown scenarios {", ".join(sorted(unknown))}')
+    if not args.sizes or not args.clients or min(args.clients) < 1 or args.repeat < 1:
+        parser.error('expected at least one size, one client count and one repeat')
+    # the scenarios run in a temporary directory
+    output = pathlib.Path(args.output).resolve()
+    baseline = json.loads(pathlib.Path(args.compare).read_text())['results'] if args.compare else None
+
+    runner = suite(args)
+    try:
+        runner.prepare()
+        server = server_process(runner.server_dir, args.subprocess)
+        runner.port = server.port
+        os.chdir(runner.client_dir)
+
+        try:
+            asyncio.run(runner.run())
+        finally:
+            server.close()
+    finally:
+        shutil.rmtree(runner.server_dir, ignore_errors=True)
+        shutil.rmtree(runner.client_dir, ignore_errors=True)
+
+    report = {
+        'started': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'machine': {'system': platform.platform(), 'python': platform.python_version(),
+                    'cpus': os.cpu_count()},
+        'options': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': runner.results,
+    }
+    output.write_text(json.dumps(report, indent=2))
+    print(f'results written to {output}')
+
+    if baseline is not None:
+        if regressions := compare(runner.results, baseline, args.tolerance):
+            print(f'{len(regressions)} measurements got worse by more than {args.tolerance}%:')
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print(f'no measurement got worse by more than {args.tolerance}%')
+
+
+if __name__ == '__main__':
+    main([])
@@ -0,0 +1,136 @@
+"""
+Compares the peak memory and throughput of the ways a put sends its file
+The original put read the whole file with readlines, joined the lines and encoded
+the rest of the message again on every partial send. The checksummed put then read
+a chunk at a time, and now writes windows of a memory map. Every engine runs in
+its own process so its peak resident size is its own, the file goes over a
+loopback socket pair to a thread that throws it away
+
+Usage: python -m benchmarks.upload_memory [size in MB]
+"""
+
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+from SockMonkey.Domain.Client import checksum
+from SockMonkey.Domain.Client.client import write_file
+from SockMonkey.Domain.Client.helpers import CHUNK_SIZE, pad_str
+
+# the checksum of the engines that hash the file, the cheapest one
+ALGORITHM = 'crc32'
+
+
+def legacy_put(sock: socket.socket, path: str) -> None:
+    """the body of put as it was in the original client, kept for comparison"""
+    with open(path, "r") as fp:
+        data = ''.join(fp.readlines())
+
+    msg = pad_str(str(len(data))) + data
+    bytes_sent = 0
+    while len(msg) > bytes_sent:
+        bytes_sent += sock.send(msg[bytes_sent:].encode('utf-8'))
+
+
+async def read_chunks(writer: asyncio.StreamWriter, fp: typing.BinaryIO, size: int) -> None:
+    """the checksummed write_file as it was before the memory map, a read per chunk"""
+    digest = checksum.new(ALGORITHM)
+    writer.write(pad_str(str(size)).encode('ascii'))
+    for start in range(0, size, CHUNK_SIZE):
+        chunk = fp.read(min(CHUNK_SIZE, size - start))
+        digest.update(chunk)
+        writer.write(chunk)
+        await writer.drain()
+
+
+async def send_async(sock: socket.socket, path: str, engine: str) -> None:
+    """sends the file with one of the write_file engines"""
+    _, writer = await asyncio.open_connection(sock=sock)
+    with open(path, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if engine == 'read':
+            await read_chunks(writer, fp, size)
+        else:
+            await write_file(writer, fp, size, digest=checksum.new(ALGORITHM) if engine == 'mmap' else None)
+    writer.close()
+    await writer.wait_closed()
+
+
+def discard(sock: socket.socket) -> None:
+    """reads until the sender hangs up"""
+    buffer = bytearray(1 << 20)
+    while sock.recv_into(buffer):
+        pass
+
+
+def measure(engine: str, path: str) -> typing.Tuple[float, float]:
+    """
+    sends the file with engine, run in a process of its own by main
+    @return - MB/s and the growth of the peak resident size in MB
+    """
+    receiver, sender = socket.socketpair()
+    drain = threading.Thread(target=discard, args=(receiver,), daemon=True)
+    drain.start()
+    # the interpreter and the imports are not the engine's
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    if engine == 'legacy':
+        legacy_put(sender, path)
+        sender.close()
+    else:
+        asyncio.run(send_async(sender, path, engine))
+    drain.join()
+    elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    receiver.close()
+    # ru_maxrss is in kilobytes on Linux
+    return os.path.getsize(path) / elapsed / 2 ** 20, (peak - baseline) / 1024
+
+
+def main(argv: typing.List[str] = ["upload_memory.py"]):
+    if not(argv):
+        argv = sys.argv
+
+    if argv[1:2] == ['--engine']:
+        print(*measure(argv[2], argv[3]))
+        return
+
+    megabytes = int(argv[1]) if argv[1:] else 256
+    engines = {
+        'legacy': 'readlines, join and encode',
+        'read': 'read per chunk, checksummed',
+        'mmap': 'memory mapped windows, checksummed',
+        'sendfile': 'sendfile, unchecked',
+    }
+
+    # text, the legacy engine decodes and encodes it
+    with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as fp:
+        line = b'abcdefghijklmnopqrstuvwxyz0123456789' * 2 + b'\n'
+        for _ in range(megabytes * 2 ** 20 // len(line)):
+            fp.write(line)
+        path = fp.name
+
+    try:
+        print(f'{megabytes} MB file')
+        print(f'{"engine":<10}{"MB/s":>10}{"peak RSS":>12}  ')
+        for engine, description in engines.items():
+            result = subprocess.run([sys.executable, '-m', 'benchmarks.upload_memory', '--engine', engine, path],
+                                    capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            rate, growth = map(float, result.stdout.split())
+            print(f'{engine:<10}{rate:>10.1f}{growth:>9.1f} MB  {description}')
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main([])